@@ -0,0 +1,174 @@
+"""
+Peak RSS of the orchestrator receiving a payload of posts, against the size of the payload: /save_data (the body is
+decoded whole, then turned into bulk actions) vs /save_data_stream (NDJSON decoded and written line by line), with and
+without write-behind (the ingest log is drained before the peak is read).
+
+Every measure is made by a new server process, the peak RSS of a process never goes down (Linux only: read from
+/proc). Elasticsearch is stood in by a client answering the bulk requests without sending them anywhere: the code of
+the orchestrator runs from the request to the bodies of the bulk requests. Needs the requirements of the orchestrator
+and requests, ex:
+
+    python bench_ingest.py --posts 1000 10000 50000 100000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import requests
+
+WORDS = ["the", "breaking", "news", "report", "война", "новости", "сегодня", "заявил", "президент", "україна",
+         "attack", "official", "source", "🔥", "⚡️", "video", "photo", "update", "https://t.me/channel_42",
+         "https://www.reuters.com/world/article-12345"]
+CHAN_ID = 1234567890
+
+
+class BulkClient:
+    """Answers the bulk requests of BaseElasticInteractor.bulk_index as if every document was indexed."""
+
+    @staticmethod
+    def bulk(operations: bytes):
+        return {"items": [{"index": {"status": 201}}] * (operations.count(b"\n") // 2)}
+
+
+class GraphClient:
+    @staticmethod
+    def add_channels_info_and_fwd_channels(channels):
+        pass
+
+
+def peak_rss() -> int:
+    """
+    Peak RSS of the process in bytes. Not getrusage's ru_maxrss: it is kept through fork and exec, the server would
+    start with the peak of the benchmark that made the payload.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("No VmHWM in /proc/self/status")
+
+
+def serve(port, write_behind):
+    """Orchestrator of the benchmark, run in its own process."""
+    import server
+    from dbpool import DatabasePool
+    from esinter import BaseElasticInteractor
+    from ingestlog import IngestLog
+
+    app = server.app
+    # no database to connect to: the pool is made by hand
+    app.before_serving_funcs.clear()
+    app.after_serving_funcs.clear()
+    # /save_data refuses bodies over 16 MiB by default. /save_data_stream doesn't keep its body, the limit only applies
+    # to the part received but not read yet
+    app.config["MAX_CONTENT_LENGTH"] = None
+    pool = DatabasePool.__new__(DatabasePool)
+    pool.elastic_db = BaseElasticInteractor(elastic_host="127.0.0.1", elastic_port=9, elastic_username="",
+                                            elastic_password="", http_cert_path=None)
+    pool.elastic_db.client = BulkClient()
+    pool.neo4j_db = GraphClient()
+    pool.on_queue_changed = None
+    pool.ingest_log = None
+    if write_behind:
+        pool.ingest_log = IngestLog(path=os.path.join(tempfile.mkdtemp(), "ingest_log.sqlite3"), claim_timeout=600,
+                                    key_ttl=3600)
+        pool._ingest_owner = "bench"
+    app.db_pool = pool
+
+    @app.route("/bench/rss")
+    async def rss():
+        if pool.ingest_log is not None:
+            while await asyncio.to_thread(pool.drain_ingest_log) > 0:
+                pass
+        return {"max_rss": peak_rss()}
+
+    app.run(host="127.0.0.1", port=port, use_reloader=False)
+
+
+def make_posts(rng, nb_posts) -> dict:
+    return {post_id: {"text": " ".join(rng.choices(WORDS, k=rng.randint(10, 100))),
+                      "forwards": rng.randint(0, 500),
+                      "views": rng.randint(0, 200000),
+                      "reply": False,
+                      "id": post_id,
+                      "forwarded_from": "",
+                      "urls": ["https://www.reuters.com/world/article-12345"],
+                      "domains": ["www.reuters.com"],
+                      "tme_links": ["channel_42"],
+                      "mentions": [],
+                      "hashtags": [],
+                      "date": 1700000000 + post_id}
+            for post_id in range(nb_posts)}
+
+
+def ndjson(posts: dict, piece_size=2 ** 16):
+    """Pieces of the NDJSON body, a post per line, as the reporter streams them"""
+    piece = bytearray()
+    for post_id, post in posts.items():
+        piece += json.dumps({CHAN_ID: {post_id: post}}, ensure_ascii=False).encode() + b"\n"
+        if len(piece) >= piece_size:
+            yield bytes(piece)
+            piece.clear()
+    yield bytes(piece)
+
+
+def measure(port, write_behind, route, posts) -> tuple:
+    """:return: (bytes of the body, RSS of the server before, peak RSS of the server)"""
+    proc = subprocess.Popen([sys.executable, __file__, "--serve", str(port)] + (["--write-behind"] * write_behind),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                before = requests.get(f"{url}/bench/rss", timeout=1).json()["max_rss"]
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            sys.exit("The server didn't start")
+        if route == "save_data":
+            body = json.dumps({CHAN_ID: posts}, ensure_ascii=False).encode()
+            size = len(body)
+            resp = requests.post(f"{url}/save_data", data=body, headers={"Content-Type": "application/json"})
+        else:
+            size = sum(len(piece) for piece in ndjson(posts))
+            resp = requests.post(f"{url}/save_data_stream", data=ndjson(posts),
+                                 headers={"Content-Type": "application/x-ndjson"})
+        resp.raise_for_status()
+        peak = requests.get(f"{url}/bench/rss").json()["max_rss"]
+    finally:
+        proc.terminate()
+        proc.wait()
+    return size, before, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Ingest memory benchmark',
+                                     description='Peak RSS of the orchestrator against the size of the payload.')
+    parser.add_argument('--posts', type=int, nargs="+", default=[1000, 10000, 50000, 100000],
+                        help='Posts per payload.')
+    parser.add_argument('--port', type=int, default=33921)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--write-behind', action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(port=args.serve, write_behind=args.write_behind)
+        sys.exit()
+
+    print(f"{'mode':<13} {'route':<17} {'posts':>7} {'body MB':>8} {'base MB':>8} {'peak MB':>8} {'growth MB':>10}")
+    for write_behind in (False, True):
+        for nb_posts in args.posts:
+            posts = make_posts(random.Random(42), nb_posts)
+            for route in ("save_data", "save_data_stream"):
+                size, before, peak = measure(args.port, write_behind, route, posts)
+                print(f"{'write-behind' if write_behind else 'direct':<13} {'/' + route:<17} {nb_posts:>7} "
+                      f"{size / 2 ** 20:>8.1f} {before / 2 ** 20:>8.1f} {peak / 2 ** 20:>8.1f} "
+                      f"{(peak - before) / 2 ** 20:>10.1f}")
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from logging import getLogger
+
+from elasticsearch import helpers, ApiError, TransportError
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+
+from esinter import (ElasticInteractor, ELASTIC_HOST, ELASTIC_PORT, ELASTIC_PASSWORD, ELASTIC_USERNAME,
+                     ELASTIC_HTTP_CERT_PATH)
+from neoperations import (GraphDB, NEO4J_AUTH, NEO4J_URI)
+from ingestlog import IngestLog, decode_payload
+
+log = getLogger("dbpool")
+log.setLevel(logging.DEBUG)
+
+# Time (in seconds) between two background checks of the databases connectivity.
+DB_HEALTH_CHECK_INTERVAL = int(os.getenv("DB_HEALTH_CHECK_INTERVAL", default=30))
+# Time (in seconds) between two full reloads of the queue index into the scheduler. Catches the changes made by the
+# other workers.
+QUEUE_RESYNC_INTERVAL = int(os.getenv("QUEUE_RESYNC_INTERVAL", default=300))
+# Time (in seconds) between two searches for expired leases (channels whose spider stopped sending heartbeats).
+LEASE_REAPER_INTERVAL = int(os.getenv("LEASE_REAPER_INTERVAL", default=60))
+# "true": /save_data and /save_data_xposted only append the payload to the ingest log stored at INGEST_LOG_PATH, it is
+# written to the databases in the background (see IngestLog). "false": the request waits for the databases.
+INGEST_WRITE_BEHIND = json.loads(os.getenv("INGEST_WRITE_BEHIND", default="true"))
+INGEST_LOG_PATH = os.getenv("INGEST_LOG_PATH", default="ingest_log.sqlite3")
+# Maximum number of payloads written to the databases at once (all their posts go in the same bulk_index call), and
+# maximum size of their bodies (a single bigger payload is still written).
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", default=50))
+INGEST_BATCH_MAX_BYTES = int(os.getenv("INGEST_BATCH_MAX_BYTES", default=8 * 2 ** 20))
+# Time (in seconds) the drainer waits when the ingest log is empty, and after a failure.
+INGEST_DRAIN_INTERVAL = float(os.getenv("INGEST_DRAIN_INTERVAL", default=0.5))
+INGEST_ERROR_BACKOFF = float(os.getenv("INGEST_ERROR_BACKOFF", default=5))
+# Entries claimed by a drainer that didn't finish with them after INGEST_CLAIM_TIMEOUT seconds are claimed again.
+INGEST_CLAIM_TIMEOUT = int(os.getenv("INGEST_CLAIM_TIMEOUT", default=600))
+# Entries the databases refused INGEST_MAX_ATTEMPTS times (not counting the times they couldn't be reached) are moved to
+# the dead letters of the ingest log.
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", default=5))
+# Time (in seconds) the idempotency keys of the payloads are remembered: a payload sent again with the same key within
+# INGEST_KEY_TTL seconds isn't ingested twice. Expired keys are removed every INGEST_KEY_EXPIRY_INTERVAL seconds.
+INGEST_KEY_TTL = int(os.getenv("INGEST_KEY_TTL", default=7 * 24 * 3600))
+INGEST_KEY_EXPIRY_INTERVAL = int(os.getenv("INGEST_KEY_EXPIRY_INTERVAL", default=600))
+
+
+class DatabasePool:
+    """
+    Holds the Elasticsearch and Neo4j clients of the process. They are created once (indices are bootstrapped at the
+    same time) and shared by every request: both clients are thread safe and keep their own pool of connections.
+
+    Connectivity is checked by a background thread instead of on every request. Both clients reconnect by themselves,
+    the health check is only here to report the state of the databases. Other threads regularly reload the queue
+    index into the scheduler of the ElasticInteractor (and save the filter of crawled channels) and put back in the
+    queue the channels whose lease expired.
+
+    With write-behind, the payloads of the reporters are appended to the ingest log and a drainer thread writes them to
+    both databases. `on_queue_changed` is called after channels were added to the queue.
+    """
+
+    def __init__(self, health_check_interval=DB_HEALTH_CHECK_INTERVAL, queue_resync_interval=QUEUE_RESYNC_INTERVAL,
+                 lease_reaper_interval=LEASE_REAPER_INTERVAL, write_behind=INGEST_WRITE_BEHIND,
+                 on_queue_changed=None):
+        self.elastic_db = ElasticInteractor(elastic_host=ELASTIC_HOST,
+                                            elastic_port=ELASTIC_PORT,
+                                            elastic_username=ELASTIC_USERNAME,
+                                            elastic_password=ELASTIC_PASSWORD,
+                                            http_cert_path=ELASTIC_HTTP_CERT_PATH)
+        self.neo4j_db = GraphDB(uri=NEO4J_URI, auth=NEO4J_AUTH)
+        self.neo4j_db.create_schema()
+        log.info("Database clients created!")
+
+        self.health_check_interval = health_check_interval
+        self.healthy = {"elastic": True, "neo4j": True}
+        self._stop_event = threading.Event()
+        self._health_thread = threading.Thread(target=self._health_check_loop, name="db-health-check", daemon=True)
+
+        self.queue_resync_interval = queue_resync_interval
+        self._resync_thread = threading.Thread(target=self._queue_resync_loop, name="queue-resync", daemon=True)
+
+        self.lease_reaper_interval = lease_reaper_interval
+        self._reaper_thread = threading.Thread(target=self._lease_reaper_loop, name="lease-reaper", daemon=True)
+
+        self.on_queue_changed = on_queue_changed
+        self.ingest_log = None
+        self._drain_thread = None
+        if write_behind is True:
+            self.ingest_log = IngestLog(path=INGEST_LOG_PATH, claim_timeout=INGEST_CLAIM_TIMEOUT,
+                                        key_ttl=INGEST_KEY_TTL)
+            # claim token of this process
+            self._ingest_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self._drain_thread = threading.Thread(target=self._ingest_drain_loop, name="ingest-drain", daemon=True)
+
+    def start(self):
+        self._health_thread.start()
+        self._resync_thread.start()
+        self._reaper_thread.start()
+        if self._drain_thread is not None:
+            self._drain_thread.start()
+
+    def check_health(self) -> dict:
+        """Checks the connectivity of both databases, logs any change of state and returns the state."""
+        state = {"elastic": self.elastic_db.check_connection(),
+                 "neo4j": self.neo4j_db.check_connection()}
+        for db_name, is_healthy in state.items():
+            if is_healthy != self.healthy[db_name]:
+                if is_healthy is True:
+                    log.info(f"Connection to {db_name} is back!")
+                else:
+                    log.error(f"Lost connection to {db_name}!")
+        self.healthy = state
+        return state
+
+    def _health_check_loop(self):
+        while not self._stop_event.wait(self.health_check_interval):
+            try:
+                self.check_health()
+            except Exception as err:
+                log.error(f"Database health check failed: {err}")
+
+    def _queue_resync_loop(self):
+        while not self._stop_event.wait(self.queue_resync_interval):
+            try:
+                self.elastic_db.load_queue_into_scheduler()
+                self.elastic_db.sync_seen_channels()
+            except Exception as err:
+                log.error(f"Couldn't reload the queue into the scheduler: {err}")
+
+    def _lease_reaper_loop(self):
+        while not self._stop_event.wait(self.lease_reaper_interval):
+            try:
+                self.elastic_db.reclaim_expired_leases()
+            except Exception as err:
+                log.error(f"Couldn't reclaim the expired leases: {err}")
+
+    def _ingest_drain_loop(self):
+        keys_expired_at = time.monotonic()
+        while not self._stop_event.is_set():
+            if time.monotonic() - keys_expired_at >= INGEST_KEY_EXPIRY_INTERVAL:
+                keys_expired_at = time.monotonic()
+                try:
+                    log.debug(f"{self.ingest_log.expire_keys()} idempotency keys expired")
+                except Exception as err:
+                    log.error(f"Couldn't remove the expired idempotency keys: {err}")
+            try:
+                drained = self.drain_ingest_log()
+            except Exception as err:
+                log.error(f"Couldn't write the ingest log to the databases: {err}")
+                self._stop_event.wait(INGEST_ERROR_BACKOFF)
+                continue
+            if drained == 0:
+                self._stop_event.wait(INGEST_DRAIN_INTERVAL)
+
+    def drain_ingest_log(self) -> int:
+        """
+        Claims up to INGEST_BATCH_SIZE entries (INGEST_BATCH_MAX_BYTES bytes) of the ingest log and writes them to the
+        databases (see _write_entries). Entries are removed once written.
+
+        An entry the databases refuse doesn't hold back the others: when the batch fails, its entries left are written
+        one by one, the ones failing again are given back with one more attempt counted and moved to the dead letters
+        of the log after INGEST_MAX_ATTEMPTS attempts (see IngestLog.fail). Entries that aren't valid payloads are moved
+        there right away. If a database can't be reached, the entries left are released and the error is raised.
+        :return: number of entries written
+        """
+        entries = self.ingest_log.claim(owner=self._ingest_owner, limit=INGEST_BATCH_SIZE,
+                                        max_bytes=INGEST_BATCH_MAX_BYTES)
+        if not entries:
+            return 0
+        decoded = []
+        for entry_id, kind, payload in entries:
+            if kind == IngestLog.POSTS_NDJSON:
+                # decoded line by line as the posts are indexed, the lines were checked when received
+                decoded.append((entry_id, kind, payload))
+                continue
+            try:
+                data = decode_payload(kind=kind, payload=payload)
+            except ValueError as err:
+                log.error(f"Entry {entry_id} of the ingest log isn't a valid {kind} payload, moved to the dead "
+                          f"letters: {err}")
+                self.ingest_log.dead_letter(owner=self._ingest_owner, entry_ids=[entry_id], error=str(err))
+                continue
+            decoded.append((entry_id, kind, data))
+
+        pending = {entry_id for entry_id, _, _ in decoded}
+        failed = 0
+        try:
+            try:
+                self._write_entries(decoded, pending=pending)
+            except Exception as err:
+                if self._is_unavailable(err):
+                    raise
+                log.warning(f"Couldn't write a batch of the ingest log ({err!r}), writing its {len(pending)} entries "
+                            f"left one by one")
+                for entry in [entry for entry in decoded if entry[0] in pending]:
+                    try:
+                        self._write_entries([entry], pending=pending)
+                    except Exception as entry_err:
+                        if self._is_unavailable(entry_err):
+                            raise
+                        dead = self.ingest_log.fail(owner=self._ingest_owner, entry_ids=[entry[0]],
+                                                    error=repr(entry_err), max_attempts=INGEST_MAX_ATTEMPTS)
+                        pending.discard(entry[0])
+                        failed += 1
+                        log.error(f"Couldn't write entry {entry[0]} of the ingest log: {entry_err!r}"
+                                  f"{', moved to the dead letters' if dead else ''}")
+        except BaseException:
+            self.ingest_log.release(owner=self._ingest_owner, entry_ids=list(pending))
+            raise
+        written = len(decoded) - failed
+        log.debug(f"{written} entries of the ingest log written to the databases")
+        return written
+
+    def _write_entries(self, entries: list, pending: set):
+        """
+        Writes entries of the ingest log to the databases: the posts of all the entries in one bulk_index call first,
+        then the channels (a channel is marked crawled after its posts are saved, see IngestLog.claim for the posts
+        drained by the other workers), written to the graph in one transaction. The entries written are acknowledged
+        and removed from `pending`.
+        :param entries: [(id, kind, decoded payload), ...]
+        """
+        posts_entries = [(entry_id, kind, data) for entry_id, kind, data in entries
+                         if kind in (IngestLog.POSTS, IngestLog.POSTS_NDJSON)]
+        if posts_entries:
+            try:
+                self.elastic_db.save_data_batch(payloads=self._iter_posts_payloads(posts_entries))
+            except helpers.BulkIndexError as err:
+                if self._is_unavailable(err):
+                    raise
+                # rejected by Elasticsearch itself (ex: mapping), sending them again wouldn't change anything
+                log.error(f"Dropping {len(err.errors)} posts that can't be indexed:")
+                for error in err.errors:
+                    log.error(error)
+            posts_ids = [entry_id for entry_id, _, _ in posts_entries]
+            self.ingest_log.ack(owner=self._ingest_owner, entry_ids=posts_ids)
+            pending.difference_update(posts_ids)
+
+        xposted_entries = [(entry_id, data) for entry_id, kind, data in entries if kind == IngestLog.XPOSTED]
+        if xposted_entries:
+            # save_data_xposted changes the channel info (spider_id removed...), an entry written again after the batch
+            # failed keeps its payload as received
+            channel_infos = [dict(data["channel_info"]) for _, data in xposted_entries]
+            for channel_info, (_, data) in zip(channel_infos, xposted_entries):
+                self.elastic_db.save_data_xposted(channel_info=channel_info, fwd_chan_list=data["fwd_chan_dict"])
+            # all the channels of the batch are written to the graph in one transaction
+            # payloads of spiders older than the t.me links don't have linked_chan_dict
+            self.neo4j_db.add_channels_info_and_fwd_channels(channels=[(channel_info, data["fwd_chan_dict"],
+                                                                        data.get("linked_chan_dict", []))
+                                                                       for channel_info, (_, data)
+                                                                       in zip(channel_infos, xposted_entries)])
+            self.ingest_log.ack(owner=self._ingest_owner, entry_ids=[entry_id for entry_id, _ in xposted_entries])
+            pending.difference_update(entry_id for entry_id, _ in xposted_entries)
+            if self.on_queue_changed is not None:
+                self.on_queue_changed()
+
+    @staticmethod
+    def _is_unavailable(err: Exception) -> bool:
+        """True if `err` means a database can't be reached or is overloaded, rather than refusing what is written"""
+        if isinstance(err, helpers.BulkIndexError):
+            return any(error.get("index", {}).get("status") == 429 for error in err.errors)
+        if isinstance(err, ApiError):
+            return err.status_code in (429, 502, 503, 504)
+        return isinstance(err, (TransportError, ServiceUnavailable, SessionExpired, TransientError))
+
+    @staticmethod
+    def _iter_posts_payloads(posts_entries: list):
+        """{chan_id: {post_id: post}} payloads of the entries of posts, one per line for the NDJSON ones"""
+        for _, kind, data in posts_entries:
+            if kind == IngestLog.POSTS_NDJSON:
+                yield from (json.loads(line) for line in data.split(b"\n") if line.strip())
+            else:
+                yield data
+
+    def close(self):
+        self._stop_event.set()
+        if self._drain_thread is not None and self._drain_thread.is_alive():
+            # lets the current batch finish, its entries would be drained again after INGEST_CLAIM_TIMEOUT otherwise
+            self._drain_thread.join(timeout=60)
+        self.elastic_db.close()
+        self.neo4j_db.close()
@@ -1,11 +1,18 @@
 import logging
 import os
 import json
+import time
 import datetime
+import threading
 from enum import Enum
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
-from elasticsearch import Elasticsearch, NotFoundError, helpers
+from elasticsearch import Elasticsearch, NotFoundError, ConflictError, BadRequestError, ApiError, helpers
+
+from scheduler import QueueScheduler
+from seenfilter import SeenChannels
 
 from logging import getLogger
 
@@ -17,6 +24,8 @@ ELASTIC_PASSWORD = os.environ['ELASTIC_PASSWORD']
 ELASTIC_PORT = os.environ["ES_PORT"]
 ELASTIC_HOST = "es01"
 ELASTIC_HTTP_CERT_PATH = "/certs/ca/ca.crt"
+# Size of the HTTP connection pool kept open to each Elasticsearch node, shared by all the requests of the process.
+ELASTIC_CONNECTIONS_PER_NODE = int(os.getenv("ELASTIC_CONNECTIONS_PER_NODE", default=10))
 
 SERVER_HOST = os.environ['HOST_CHANNEL']
 SERVER_PORT = int(os.environ['PORT_CHANNEL'])
@@ -27,6 +36,35 @@ CHANNEL_INDEX = os.getenv("CHANNEL_INDEX")
 QUEUE_INDEX = os.getenv("QUEUE_INDEX")
 MAX_CHANNEL_CRAWLED = int(os.getenv("MAX_CHANNEL_CRAWLED"))
 MIN_CRAWL_INTERVAL = int(os.getenv("MIN_CRAWL_INTERVAL"))
+# Page size used when loading the whole queue index in memory (see QueueScheduler)
+QUEUE_SCAN_PAGE_SIZE = int(os.getenv("QUEUE_SCAN_PAGE_SIZE", default=5000))
+# When the scheduler has nothing to crawl, the `to_crawl` channels are reloaded from the queue index (they may have been
+# added by another worker or by diagnostics.py), at most once every QUEUE_REFRESH_INTERVAL seconds.
+QUEUE_REFRESH_INTERVAL = int(os.getenv("QUEUE_REFRESH_INTERVAL", default=5))
+# Filter of the crawled channels (see seenfilter.py): where it is saved, amount of channels it is sized for, wanted rate
+# of false positives and number of exact answers from Elasticsearch kept in memory.
+SEEN_FILTER_PATH = os.getenv("SEEN_FILTER_PATH", default="seen_channels.bloom")
+SEEN_FILTER_CAPACITY = int(os.getenv("SEEN_FILTER_CAPACITY", default=1000000))
+SEEN_FILTER_ERROR_RATE = float(os.getenv("SEEN_FILTER_ERROR_RATE", default=0.01))
+SEEN_FILTER_LRU_SIZE = int(os.getenv("SEEN_FILTER_LRU_SIZE", default=100000))
+# A channel handed to a spider is leased for LEASE_DURATION seconds. The spider renews the lease with heartbeats, if it
+# doesn't the channel goes back to `to_crawl` so another spider can crawl it.
+LEASE_DURATION = int(os.getenv("LEASE_DURATION", default=600))
+# Number of candidates /next tries to claim before giving up (they may all be claimed by other workers meanwhile).
+MAX_CLAIM_ATTEMPTS = int(os.getenv("MAX_CLAIM_ATTEMPTS", default=10))
+
+# Posts are indexed in bulk requests of at most BULK_MAX_BYTES bytes (posts vary a lot in size, a number of posts
+# doesn't bound the size of a request), BULK_THREADS requests at a time. Posts rejected because the cluster is
+# overloaded (429) are sent again up to BULK_MAX_RETRIES times, after BULK_INITIAL_BACKOFF seconds, then twice as long
+# each time, at most BULK_MAX_BACKOFF seconds.
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", default=5 * 1024 * 1024))
+BULK_THREADS = int(os.getenv("BULK_THREADS", default=4))
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", default=5))
+BULK_INITIAL_BACKOFF = float(os.getenv("BULK_INITIAL_BACKOFF", default=1))
+BULK_MAX_BACKOFF = float(os.getenv("BULK_MAX_BACKOFF", default=30))
+
+# "priority" is mapped as a short
+MAX_PRIORITY = 32767
 
 # https://www.elastic.co/guide/en/elasticsearch/reference/current/explicit-mapping.html
 # Used integer for channel ID, this caused problem as channel ID can exceed the max value of an integer.
@@ -37,7 +75,11 @@ MAPPING_QUEUE = {
         "time_added": {"type": "date"},
         "time_crawling_started": {"type": "date"},
         "username": {"type": "keyword"},
-        "chan_id": {"type": "long"}
+        "chan_id": {"type": "long"},
+        "lease_expires": {"type": "date"},
+        "spider_id": {"type": "keyword"},
+        # highest message ID ingested (watermark): the next crawl only fetches the messages after it
+        "max_msg_id": {"type": "long"}
     }
 }
 
@@ -48,10 +90,16 @@ MAPPING_CHANNELS = {
         "title": {"type": "text"},
         "username": {"type": "keyword"},
         "verified": {"type": "keyword"},  # either true or false.
+        # range of the message IDs crawled
+        "min_msg_id": {"type": "long"},
+        "max_msg_id": {"type": "long"},
         # Using this documentation page, seems like we need "nested" even though it's expensive.
         # https://www.elastic.co/guide/en/elasticsearch/reference/current/nested.html#nested-fields-array-objects
-        "x_posted_channels": {"type": "nested"}  # inside: {"username": key,
-        #                                                   "xposts": val}
+        "x_posted_channels": {"type": "nested"},  # inside: {"username": key,
+        #                                                    "xposts": val}
+        # forwards per range of message IDs crawled, x_posted_channels is their sum. Not searched: not indexed.
+        "xposts_ranges": {"type": "object", "enabled": False}  # [{"min_msg_id": int, "max_msg_id": int,
+        #                                                          "x_posted_channels": [...]}, ...]
     }
 }
 
@@ -59,11 +107,15 @@ MAPPING_POSTS = {
     "properties": {
         "text": {"type": "text"},
         "forwards": {"type": "integer"},
+        "views": {"type": "integer"},
         "reply": {"type": "boolean"},
         "id": {"type": "long"},
         "forwarded_from": {"type": "keyword"},
         "urls": {"type": "keyword"},
         "domains": {"type": "keyword"},
+        "tme_links": {"type": "keyword"},
+        "mentions": {"type": "keyword"},
+        "hashtags": {"type": "keyword"},
         "date": {"type": "date"},
         "channel": {"type": "long"}
     }
@@ -120,12 +172,137 @@ class BaseElasticInteractor:
             "match_all": {}
         }
 
+    # priority 0: the forwards were already counted (channel info saved again), the channel is only added if missing
+    MERGE_PRIORITY_SCRIPT = """
+        if (params.priority == 0) {
+            ctx.op = 'noop';
+        } else {
+            ctx._source.priority = (int) Math.min(params.max_priority, ctx._source.priority + params.priority);
+        }
+        """
+
+    RENEW_LEASE_SCRIPT = """
+        if (ctx._source.status == params.status
+            && (params.spider_id == null || ctx._source.spider_id == params.spider_id)) {
+            ctx._source.lease_expires = params.lease_expires;
+        } else {
+            ctx.op = 'noop';
+        }
+        """
+
+    # the watermark never goes back, ex: two crawls of the channel finishing in the wrong order. The status isn't
+    # changed if the channel was leased to another spider meanwhile (lease expired while the crawl was being reported):
+    # that spider is crawling it.
+    MARK_CRAWLED_SCRIPT = """
+        if (params.spider_id == null || ctx._source.status != params.being_crawled
+            || ctx._source.spider_id == null || ctx._source.spider_id == params.spider_id) {
+            ctx._source.status = params.status;
+            ctx._source.lease_expires = 0;
+        }
+        if (ctx._source.max_msg_id == null || ctx._source.max_msg_id < params.max_msg_id) {
+            ctx._source.max_msg_id = params.max_msg_id;
+        }
+        """
+
+    # The forwards are kept per range of message IDs crawled (xposts_ranges), merged like the ranges of the graph DB
+    # (see neoperations.RANGE_COUNT_SUBQUERY): a crawl replaces the ranges it contains, then is trimmed to the messages
+    # the other ones don't count yet, its forwards being scaled down to what is left of it. x_posted_channels is the sum
+    # of the ranges. A crawl whose range is already covered changes nothing (noop): saving the same channel info twice
+    # doesn't count its forwards twice. Without new message (max_msg_id 0 and no forwards) only the channel fields are
+    # updated. Data of older spiders (no range) is counted as the range [0, 0], replaced by each save.
+    MERGE_CHANNEL_INFO_SCRIPT = """
+        def lo = params.doc.min_msg_id == null ? 0 : params.doc.min_msg_id;
+        def hi = params.doc.max_msg_id == null ? 0 : params.doc.max_msg_id;
+        List ranges = ctx._source.xposts_ranges;
+        if (ranges == null) {
+            // saved before the ranges were kept: all its forwards in one range
+            ranges = new ArrayList();
+            if (ctx._source.max_msg_id != null
+                || (ctx._source.x_posted_channels != null && !ctx._source.x_posted_channels.isEmpty())) {
+                ranges.add(['min_msg_id': ctx._source.min_msg_id == null ? 0 : ctx._source.min_msg_id,
+                            'max_msg_id': ctx._source.max_msg_id == null ? 0 : ctx._source.max_msg_id,
+                            'x_posted_channels': ctx._source.x_posted_channels]);
+            }
+        }
+        boolean covered = false;
+        for (def range : ranges) {
+            if (range.min_msg_id <= lo && hi <= range.max_msg_id && hi != 0) {
+                covered = true;
+            }
+        }
+        if (covered) {
+            ctx.op = 'noop';
+        } else if (hi == 0 && params.doc.x_posted_channels.isEmpty()) {
+            for (def entry : params.doc.entrySet()) {
+                if (entry.getKey() != 'x_posted_channels' && entry.getKey() != 'min_msg_id'
+                    && entry.getKey() != 'max_msg_id') {
+                    ctx._source[entry.getKey()] = entry.getValue();
+                }
+            }
+            if (ctx._source.x_posted_channels == null) {
+                ctx._source.x_posted_channels = new ArrayList();
+            }
+        } else {
+            List kept = new ArrayList();
+            for (def range : ranges) {
+                if (!(lo <= range.min_msg_id && range.max_msg_id <= hi)) {
+                    kept.add(range);
+                }
+            }
+            def new_lo = lo;
+            def new_hi = hi;
+            for (def range : kept) {
+                if (range.min_msg_id <= lo && lo <= range.max_msg_id) {
+                    new_lo = range.max_msg_id + 1;
+                }
+                if (range.min_msg_id <= hi && hi <= range.max_msg_id) {
+                    new_hi = range.min_msg_id - 1;
+                }
+            }
+            if (new_lo <= new_hi) {
+                double ratio = (double) (new_hi - new_lo + 1) / (hi - lo + 1);
+                List xposts = new ArrayList();
+                for (def xpost : params.doc.x_posted_channels) {
+                    long nb = Math.round(xpost.xposts * ratio);
+                    if (nb > 0) {
+                        xposts.add(['username': xpost.username, 'xposts': nb]);
+                    }
+                }
+                kept.add(['min_msg_id': new_lo, 'max_msg_id': new_hi, 'x_posted_channels': xposts]);
+            }
+            Map totals = new HashMap();
+            def min_msg_id = lo;
+            def max_msg_id = hi;
+            for (def range : kept) {
+                if (range.min_msg_id < min_msg_id) {
+                    min_msg_id = range.min_msg_id;
+                }
+                if (range.max_msg_id > max_msg_id) {
+                    max_msg_id = range.max_msg_id;
+                }
+                for (def xpost : range.x_posted_channels) {
+                    totals[xpost.username] = totals.getOrDefault(xpost.username, 0L) + xpost.xposts;
+                }
+            }
+            ctx._source.putAll(params.doc);
+            ctx._source.min_msg_id = min_msg_id;
+            ctx._source.max_msg_id = max_msg_id;
+            ctx._source.xposts_ranges = kept;
+            List merged = new ArrayList();
+            for (def entry : totals.entrySet()) {
+                merged.add(['username': entry.getKey(), 'xposts': entry.getValue()]);
+            }
+            ctx._source.x_posted_channels = merged;
+        }
+        """
+
     def __init__(self, elastic_host, elastic_port, elastic_username, elastic_password, http_cert_path, post_index=None,
-                 channel_index=None, queue_index=None):
+                 channel_index=None, queue_index=None, connections_per_node=ELASTIC_CONNECTIONS_PER_NODE):
         self.client = Elasticsearch(
             f"https://{elastic_host}:{elastic_port}",
             ca_certs=http_cert_path,
-            basic_auth=(elastic_username, elastic_password)
+            basic_auth=(elastic_username, elastic_password),
+            connections_per_node=connections_per_node
         )
         log.info("Elastic search client started!")
 
@@ -144,6 +321,17 @@ class BaseElasticInteractor:
         else:
             self.queue_index = queue_index
 
+        # only filled by load_queue_into_scheduler, the orchestrator does it at startup.
+        self.scheduler = QueueScheduler()
+        self._last_scheduler_refresh = 0
+        # filter of the crawled channels, only used by the orchestrator (see ElasticInteractor)
+        self.seen_channels = None
+
+        # bulk requests of bulk_index are sent from these threads, each one uses its own connection of the pool
+        self._bulk_executor = ThreadPoolExecutor(max_workers=BULK_THREADS, thread_name_prefix="es-bulk")
+        self._bulk_stats_lock = threading.Lock()
+        self.bulk_stats = {"requests": 0, "docs": 0, "bytes": 0, "retried_docs": 0, "failed_docs": 0}
+
     def check_and_create_indices(self, indices: list[str]):
         log.info("Checking for indices!")
         for index in indices:
@@ -157,6 +345,15 @@ class BaseElasticInteractor:
                     self.client.indices.create(index=index, mappings=MAPPING_POSTS)
                 else:
                     self.client.indices.create(index=index)
+            elif index in (self.queue_index, self.channel_index, self.post_index):
+                # adds the fields that were added to the mapping since the index was created
+                mapping = {self.queue_index: MAPPING_QUEUE,
+                           self.channel_index: MAPPING_CHANNELS,
+                           self.post_index: MAPPING_POSTS}[index]
+                try:
+                    self.client.indices.put_mapping(index=index, properties=mapping["properties"])
+                except BadRequestError as err:
+                    log.error(f"Couldn't update the mapping of {index}: {err}")
 
     def save_data_xposted(self, channel_info: dict, fwd_chan_list: list):
         """
@@ -166,23 +363,34 @@ class BaseElasticInteractor:
                                        "title": "Channel Title Example",
                                        "username": "channel_username_example",
                                        "verified": True,
-                                       "nb_participants": 2626}
+                                       "nb_participants": 2626,
+                                       "min_msg_id": 1,
+                                       "max_msg_id": 5321}
+                            min/max_msg_id: range of the messages crawled this time, 0 if there was no new message
+                            spider_id (optional): spider that crawled the channel, holder of its lease. Removed from
+                            channel_info, it isn't saved with the channel.
         :param fwd_chan_list (dict): ex: {"(xposted_channel_username_1, xposted_channel_id_1)": 11,
                                           "(xposted_channel_username_2, xposted_channel_id_2)": 2}
         :return:
         """
         channel_info["chan_id"] = int(channel_info["chan_id"])
+        spider_id = channel_info.pop("spider_id", None)
         channel_id = channel_info["chan_id"]
         channel_username = channel_info["username"]
         resp_channel_index = self._save_channel_info(channel_id, channel_info, fwd_chan_list)
         # ---------------------------------------------------------------------------------------------------
         log.debug(f"Adding crossposted channels of channel {channel_username}({channel_id}) to {self.queue_index}")
-        responses_queue = self._add_channels_to_queue(fwd_chan_list)
+        # noop: this crawl was already saved (payload processed again after a failure, see IngestLog), its forwards are
+        # already in the priorities. If the previous attempt failed before adding them, they are missing: undercounted
+        # rather than counted twice.
+        responses_queue = self._add_channels_to_queue(fwd_chan_list,
+                                                      add_priority=resp_channel_index['result'] != "noop")
 
         # This method is called when a channel is finished crawling. We can mark it as crawled
         log.debug(f"Marking {channel_username} as {ChannelStatus.crawled}.")
         # self._change_channel_crawling_status_to_crawled(channel_username)
-        self._change_channel_crawling_status_to_crawled(channel_id)
+        self._change_channel_crawling_status_to_crawled(channel_id, max_msg_id=channel_info.get("max_msg_id", 0),
+                                                        spider_id=spider_id)
 
         return resp_channel_index, responses_queue
 
@@ -196,15 +404,30 @@ class BaseElasticInteractor:
             document['x_posted_channels'].append({"username": fwd_chan["chan_username"],
                                                   "xposts": fwd_chan["nb_of_forwards"]})
 
-        # TODO what if channel already exists?
-
-        resp_post_channel = self.client.index(index=self.channel_index,
-                                              id=channel_id,
-                                              document=document)
+        resp_post_channel = self.client.update(index=self.channel_index,
+                                               id=channel_id,
+                                               script={"source": self.MERGE_CHANNEL_INFO_SCRIPT,
+                                                       "params": {"doc": document}},
+                                               upsert={},
+                                               scripted_upsert=True,
+                                               retry_on_conflict=3)
         log.debug(f"Response for adding {channel_id} to {self.channel_index}: {resp_post_channel['result']}")
+        if self.seen_channels is not None:
+            self.seen_channels.add(channel_id)
         return resp_post_channel
 
-    def _add_channels_to_queue(self, fwd_chan_list: list, force=False):
+    def _add_channels_to_queue(self, fwd_chan_list: list, force=False, add_priority=True):
+        """
+        Adds the forwarded channels that were never crawled to the queue, whatever their number it costs one mget (to
+        find the channels already crawled) and one bulk request.
+
+        A channel already in the queue keeps its status and `time_added`, the new forwards are added to its priority.
+        :param fwd_chan_list: [{"chan_username": str, "chan_id": int, "nb_of_forwards": int}, ...]
+        :param force: adds the channels even if MAX_CHANNEL_CRAWLED is reached
+        :param add_priority: False if the forwards were already counted: only the channels missing in the queue are
+        added, the priority of the others doesn't change
+        :return: result of each upsert ("created", "updated" or "noop")
+        """
         crawl_queue_reps = list()
 
         log.debug(f"fwd_chan_list: {fwd_chan_list}")
@@ -216,27 +439,50 @@ class BaseElasticInteractor:
                         f"). Not adding forwarded chans in the queue.")
             return {}
 
+        # a channel may appear several times (ex: under different usernames), its forwards are summed up
+        fwd_channels = {}
         for fwd_chan_info in fwd_chan_list:
-            # checking if channels hasn't already been crawled
-            xpost_chan_username = fwd_chan_info["chan_username"]
-            xpost_chan_id = fwd_chan_info["chan_id"]
-            priority = fwd_chan_info["nb_of_forwards"]
-            # TODO DO WE REALLY NEED THAT ?????????????????
-            chan_info = self.get_channel_by_id(chan_id=xpost_chan_id)
-            if chan_info:
-                log.info(f"Not adding {xpost_chan_username} to the queue, already crawled.")
-                log.debug(chan_info)
+            xpost_chan_id = int(fwd_chan_info["chan_id"])
+            if xpost_chan_id in fwd_channels:
+                fwd_channels[xpost_chan_id]["nb_of_forwards"] += fwd_chan_info["nb_of_forwards"]
+            else:
+                fwd_channels[xpost_chan_id] = dict(fwd_chan_info)
+        if not fwd_channels:
+            return crawl_queue_reps
+
+        # checking if channels haven't already been crawled
+        already_crawled = self.get_crawled_channel_ids(chan_ids=list(fwd_channels))
+        for xpost_chan_id in already_crawled:
+            log.info(f"Not adding {fwd_channels.pop(xpost_chan_id)['chan_username']} to the queue, already crawled.")
+
+        now = int(datetime.datetime.now().timestamp())
+        actions = []
+        for xpost_chan_id, fwd_chan_info in fwd_channels.items():
+            priority = min(int(fwd_chan_info["nb_of_forwards"]), MAX_PRIORITY)
+            actions.append({"_op_type": "update",
+                            "_index": self.queue_index,
+                            "_id": xpost_chan_id,
+                            "_source": True,
+                            "retry_on_conflict": 3,
+                            "script": {"source": self.MERGE_PRIORITY_SCRIPT,
+                                       "params": {"priority": priority if add_priority else 0,
+                                                  "max_priority": MAX_PRIORITY}},
+                            "upsert": {"priority": priority,
+                                       "status": ChannelStatus.to_crawl,
+                                       "time_added": now,
+                                       "time_crawling_started": 0,
+                                       "username": fwd_chan_info["chan_username"],
+                                       "chan_id": xpost_chan_id}})
+
+        for ok, item in helpers.streaming_bulk(client=self.client, actions=actions, raise_on_error=False):
+            result = item['update']
+            if not ok:
+                log.error(f"Couldn't add {result['_id']} to {self.queue_index}: {result.get('error')}")
                 continue
-            resp_crawl = self.client.index(index=self.queue_index,
-                                           id=xpost_chan_id,
-                                           document={"priority": priority,
-                                                     "status": ChannelStatus.to_crawl,
-                                                     "time_added": int(datetime.datetime.now().timestamp()),
-                                                     "time_crawling_started": 0,
-                                                     "username":xpost_chan_username,
-                                                     "chan_id":xpost_chan_id})
-            log.debug(f"Adding TO QUEUE {xpost_chan_username} to {self.queue_index}: {resp_crawl['result']}")
-            crawl_queue_reps.append(resp_crawl['result'])
+            if 'get' in result:
+                self.scheduler.upsert(int(result['_id']), result['get']['_source'])
+            log.debug(f"Adding TO QUEUE {result['_id']} to {self.queue_index}: {result['result']}")
+            crawl_queue_reps.append(result['result'])
 
         return crawl_queue_reps
 
@@ -250,112 +496,409 @@ class BaseElasticInteractor:
                 log.error(i)
             raise err
 
-    def _save_posts_bulk(self, channel_username, posts: dict):
+    def save_data_batch(self, payloads) -> int:
+        """
+        Adding the posts of several /save_data payloads to the POST_INDEX with a single bulk_index call.
+        :param payloads: [{channel_id: {post_id: post, ...}}, ...], or any iterable of them (consumed as the posts are
+        indexed)
+        :return: number of posts indexed
         """
-        Save posts using the bulk API.
+        nb_payloads = 0
+
+        def actions():
+            nonlocal nb_payloads
+            for payload in payloads:
+                nb_payloads += 1
+                for channel_id, posts in payload.items():
+                    yield from self.__generate_action_bulk_index(index=self.post_index,
+                                                                 channel_username=int(channel_id), posts=posts)
 
-        Modeled after: https://github.com/elastic/elasticsearch-py/blob/main/examples/bulk-ingest/bulk-ingest.py
+        successes = self.bulk_index(actions=actions())
+        log.info(f"Indexed {successes} posts from {nb_payloads} payloads")
+        return successes
+
+    def _save_posts_bulk(self, channel_username, posts: dict):
+        """
+        Save posts using the bulk API, see bulk_index.
 
         :param channel_username:
         :param posts:
         :return:
         """
-
-        successes = 0
-        for ok, action in helpers.streaming_bulk(client=self.client,
-                                                 index=self.post_index,
-                                                 actions=self.__generate_action_bulk_index(channel_username=channel_username,
-                                                                                           posts=posts)):
-            # doesn't work, the streaming_bulk raises an exception thus we don't get to see this
-            if not ok:
-                log.error('Failed indexing posts: info below')
-                log.error(action)
-
-            successes += ok
+        successes = self.bulk_index(actions=self.__generate_action_bulk_index(index=self.post_index,
+                                                                             channel_username=channel_username,
+                                                                             posts=posts))
         log.info("Indexed %d/%d posts" % (successes, len(posts)))
 
     @staticmethod
-    def __generate_action_bulk_index(channel_username, posts: dict):
-        action = {}
+    def __generate_action_bulk_index(index, channel_username, posts: dict):
         for id_post, post_info in posts.items():
-            action["_id"] = f"{channel_username}:{id_post}"
-            action['channel'] = channel_username
-            for k, v in post_info.items():
-                action[k] = v
-            yield action
+            yield {"_index": index,
+                   "_id": f"{channel_username}:{id_post}",
+                   "_source": {**post_info, "channel": channel_username}}
 
+    def bulk_index(self, actions) -> int:
+        """
+        Indexes documents with bulk requests of at most BULK_MAX_BYTES bytes, sent in parallel over BULK_THREADS
+        connections. Documents rejected with a 429 are retried with an exponential backoff (see _send_bulk_chunk).
+        :param actions: iterable of {"_index": str, "_id": str, "_source": dict}
+        :return: number of documents indexed. Raises helpers.BulkIndexError if some couldn't be.
+        """
+        indexed = 0
+        errors = []
+        pending = deque()
+        for chunk in self._iter_bulk_chunks(actions, max_bytes=BULK_MAX_BYTES):
+            # at most 2 * BULK_THREADS chunks in flight (BULK_THREADS being sent, as many waiting for a thread): the
+            # actions are read and serialized as the requests are sent, not all at once
+            if len(pending) >= 2 * BULK_THREADS:
+                chunk_indexed, chunk_errors = pending.popleft().result()
+                indexed += chunk_indexed
+                errors += chunk_errors
+            pending.append(self._bulk_executor.submit(self._send_bulk_chunk, chunk))
+        while pending:
+            chunk_indexed, chunk_errors = pending.popleft().result()
+            indexed += chunk_indexed
+            errors += chunk_errors
+        if errors:
+            raise helpers.BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        return indexed
 
-    def get_next_channel_to_be_crawled(self):
+    @staticmethod
+    def _iter_bulk_chunks(actions, max_bytes):
         """
-                Get all channels in queue:
+        Serializes each action once and groups them in chunks whose NDJSON body is at most max_bytes bytes (a single
+        bigger document still gets its own chunk).
+        :return: chunks, lists of the serialized actions (header and source lines).
+        """
+        chunk = []
+        chunk_size = 0
+        for action in actions:
+            line = (json.dumps({"index": {"_index": action["_index"], "_id": action["_id"]}}) + "\n" +
+                    json.dumps(action["_source"]) + "\n").encode("utf8")
+            if chunk and chunk_size + len(line) > max_bytes:
+                yield chunk
+                chunk = []
+                chunk_size = 0
+            chunk.append(line)
+            chunk_size += len(line)
+        if chunk:
+            yield chunk
+
+    def _send_bulk_chunk(self, chunk: list):
+        """
+        Sends one chunk of _iter_bulk_chunks. The documents rejected with a 429 (or the whole request) are sent again,
+        up to BULK_MAX_RETRIES times.
+        :return: (number of documents indexed, errors of the documents that couldn't be)
+        """
+        indexed = 0
+        errors = []
+        backoff = BULK_INITIAL_BACKOFF
+        for attempt in range(BULK_MAX_RETRIES + 1):
+            body = b"".join(chunk)
+            start = time.monotonic()
+            retry = []
+            nb_indexed = 0
+            try:
+                resp = self.client.bulk(operations=body)
+            except ApiError as err:
+                if err.status_code != 429 or attempt == BULK_MAX_RETRIES:
+                    raise
+                retry = chunk
+            else:
+                for line, item in zip(chunk, resp['items']):
+                    status = item['index']['status']
+                    if status < 300:
+                        nb_indexed += 1
+                    elif status == 429 and attempt < BULK_MAX_RETRIES:
+                        retry.append(line)
+                    else:
+                        errors.append(item)
+            elapsed = max(time.monotonic() - start, 1e-6)
+            log.debug(f"Bulk request: {nb_indexed} docs indexed, {len(body)} bytes in {elapsed:.3f}s "
+                      f"({nb_indexed / elapsed:.0f} docs/s, {len(body) / elapsed / 1024 / 1024:.2f} MB/s)")
+            indexed += nb_indexed
+            with self._bulk_stats_lock:
+                self.bulk_stats["requests"] += 1
+                self.bulk_stats["docs"] += nb_indexed
+                self.bulk_stats["bytes"] += len(body)
+                self.bulk_stats["retried_docs"] += len(retry)
+
+            if not retry:
+                break
+            log.warning(f"{len(retry)} docs rejected by Elasticsearch (429), retrying in {backoff}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, BULK_MAX_BACKOFF)
+            chunk = retry
+
+        if errors:
+            with self._bulk_stats_lock:
+                self.bulk_stats["failed_docs"] += len(errors)
+        return indexed, errors
+
+
+    def get_next_channel_to_be_crawled(self, spider_id=None):
+        """
+                Picks the next channel in the queue (see QueueScheduler.pop_next):
                     1. Any channel with status `to_crawl`? If so => return one with highest prio (normal way of operating)
                     2. Any channel with status `crawled`? If so => return the one with the oldest `time_crawling_started`
                         property
                     3. Only channels with status `being_crawled`? If so => return wait flag.
+                The channel is then claimed in the queue index, see _change_channel_crawling_status_to_being_crawled.
+                :param spider_id: ID of the spider asking, holder of the lease on the channel.
                 :return:
                 """
+        return self.get_next_channels_to_be_crawled(n=1, spider_id=spider_id)[0]["chan_id"]
 
-        # we sort channels between the ones that have been crawled and the ones that are to be crawled
-        channels_to_crawl = []
-        channels_crawled = []
-
-        resp = self.client.search(index=self.queue_index, size=10000)
-        # print(resp)
-        for doc in resp['hits']['hits']:
-            document = doc['_source']
-            chan_id = document['chan_id']
-            if document['status'] == ChannelStatus.to_crawl:
-                channels_to_crawl.append((chan_id, document))
-            elif document['status'] == ChannelStatus.crawled:
-                channels_crawled.append((chan_id, document))
-
-        log.info(f"Total channel {ChannelStatus.to_crawl}: {len(channels_to_crawl)}")
-        log.info(f"Total channel {ChannelStatus.crawled}: {len(channels_crawled)}")
-
-        # If there are more channels to crawl, we return the highest prio (same method we had before)
-        if len(channels_to_crawl) > 0:
-            resp = max(channels_to_crawl, key=lambda y: y[1]["priority"])
-        elif len(channels_crawled) > 0:
-            resp = min(channels_crawled, key=lambda y: int(y[1]["time_crawling_started"]))
-            if int(datetime.datetime.now().timestamp()) - resp[1]["time_crawling_started"] < MIN_CRAWL_INTERVAL:
-                raise EmptyQueueException
-        else:
+    def get_next_channels_to_be_crawled(self, n, spider_id=None) -> list[dict]:
+        """
+        Leases up to `n` channels, picked in the same order as get_next_channel_to_be_crawled. Whatever `n`, it costs
+        one mget and one bulk request per attempt.
+        :param n: maximum amount of channels to lease
+        :param spider_id: ID of the spider asking, holder of the leases.
+        :return: [{"chan_id": int, "lease_expires": int, "max_msg_id": int}, ...]. Raises EmptyQueueException if no
+        channel was leased.
+        """
+        now = int(datetime.datetime.now().timestamp())
+        leases = []
+        for _ in range(MAX_CLAIM_ATTEMPTS):
+            candidates = self._pop_candidates(n=n - len(leases), now=now)
+            if not candidates:
+                break
+            log.debug(f"Queue content: {self.scheduler.count_by_status()}")
+            try:
+                leases += self._change_channel_crawling_status_to_being_crawled(
+                    chan_ids=[document["chan_id"] for document in candidates], now=now, spider_id=spider_id)
+            except Exception:
+                # the candidates were marked `being_crawled` in memory only, they must be picked again
+                for document in candidates:
+                    self.scheduler.upsert(document["chan_id"], document)
+                raise
+            if len(leases) == n:
+                break
+            # the other candidates were claimed by another worker meanwhile, trying the next ones
+
+        if not leases:
             raise EmptyQueueException
+        return leases
+
+    def _pop_candidates(self, n, now) -> list[dict]:
+        """:return: the queue documents of up to `n` channels (each once), marked `being_crawled` in the scheduler."""
+        candidates = []
+        chan_ids = set()
+        while len(candidates) < n:
+            document = self.scheduler.pop_next(min_crawl_interval=MIN_CRAWL_INTERVAL, now=now)
+            if document is None and now - self._last_scheduler_refresh >= QUEUE_REFRESH_INTERVAL:
+                self.refresh_scheduler_to_crawl()
+                document = self.scheduler.pop_next(min_crawl_interval=MIN_CRAWL_INTERVAL, now=now)
+            if document is None:
+                break
+            if document["chan_id"] in chan_ids:
+                continue
+            chan_ids.add(document["chan_id"])
+            candidates.append(document)
+        return candidates
 
-        chan_id = resp[0]
-
+    def _iter_documents(self, index, query=None, source=True):
+        """
+        Yields every document of the queue or channel index, paginated with search_after (no 10 000 hits limit).
+        :param source: passed to the search as _source (fields to return)
+        """
+        search_after = None
         while True:
-            resp = self._change_channel_crawling_status_to_being_crawled(chan_id=chan_id)
-            if resp['result'] == "updated":
-                log.debug(f"Successfully changed status of chan {chan_id}")
-                return chan_id
-            else:
-                log.warning(f"Couldn't change the status of chan {chan_id}. Trying again.")
+            resp = self.client.search(index=index,
+                                      query=query if query is not None else self.MATCH_ALL_IN_INDEX,
+                                      size=QUEUE_SCAN_PAGE_SIZE,
+                                      sort=[{"chan_id": "asc"}],
+                                      source=source,
+                                      search_after=search_after)
+            hits = resp['hits']['hits']
+            for doc in hits:
+                yield doc['_source']
+            if len(hits) < QUEUE_SCAN_PAGE_SIZE:
+                return
+            search_after = hits[-1]['sort']
+
+    def load_queue_into_scheduler(self):
+        """Rebuilds the in-memory scheduler from the whole queue index."""
+        self._last_scheduler_refresh = int(datetime.datetime.now().timestamp())
+        self.scheduler.replace_all(self._iter_documents(index=self.queue_index))
+
+    def refresh_scheduler_to_crawl(self):
+        """
+        Adds to the scheduler the channels `to_crawl` of the queue index it doesn't know about yet. The channels picked
+        or changed by the requests served while the index is read (concurrent claims...) aren't overwritten, see
+        QueueScheduler.refresh.
+        """
+        self._last_scheduler_refresh = int(datetime.datetime.now().timestamp())
+        since = self.scheduler.snapshot()
+        self.scheduler.refresh(self._iter_documents(index=self.queue_index, query=self.GET_NEXT_CHANNEL_QUERY),
+                               since=since)
 
-    def _change_channel_crawling_status_to_being_crawled(self, chan_id):
+    def load_seen_channels(self):
         """
-        Not to be used outside of get_next_channel_to_be_crawled. This doesn't change the status of the channel
-        retrieved!
-        :param chan_id: ID of the channel that must be updated
-        :return:
+        Loads the filter of crawled channels saved on disk, or builds it from the channel index. Then adds the channels
+        crawled according to the queue (in memory, already loaded in the scheduler): crawls that finished since the
+        filter was saved.
         """
-        resp = self.client.update(index=self.queue_index,
-                                  id=chan_id,
-                                  doc={"status": ChannelStatus.being_crawled,
-                                       "time_crawling_started": int(datetime.datetime.now().timestamp())})
+        if not self.seen_channels.load() or self.seen_channels.needs_rebuild():
+            log.info(f"Building the seen channels filter from {self.channel_index}")
+            self.seen_channels.replace_bloom(doc['chan_id'] for doc in self._iter_documents(index=self.channel_index,
+                                                                                         source=["chan_id"]))
+        self.sync_seen_channels()
+
+    def sync_seen_channels(self):
+        """Adds the channels crawled according to the scheduler to the filter and saves it to disk."""
+        self.seen_channels.add_many(self.scheduler.chan_ids(status=ChannelStatus.crawled))
+        self.seen_channels.save()
+        log.info(f"Seen channels filter: {self.seen_channels.stats()}")
+
+    def _change_channel_crawling_status_to_being_crawled(self, chan_ids: list, now, spider_id=None) -> list[dict]:
+        """
+        Not to be used outside of get_next_channels_to_be_crawled. Claims the channels for `spider_id` with a lease of
+        LEASE_DURATION seconds.
+
+        The claim is atomic: each update only goes through if the document wasn't modified since we read it
+        (if_seq_no/if_primary_term), so two workers or orchestrators can never hand the same channel to two spiders.
+        :param chan_ids: IDs of the channels that must be updated
+        :param now: timestamp of the start of the crawl, same as the one given to the scheduler
+        :param spider_id: ID of the spider the channels are handed to
+        :return: leases of the channels that were claimed: [{"chan_id": int, "lease_expires": int, "max_msg_id": int},
+        ...], max_msg_id being the highest message ID already ingested (0 if none)
+        """
+        document = {"status": ChannelStatus.being_crawled,
+                    "time_crawling_started": now,
+                    "lease_expires": now + LEASE_DURATION,
+                    "spider_id": spider_id}
+
+        resp = self.client.mget(index=self.queue_index, ids=chan_ids)
+        current_sources = {}
+        actions = []
+        for doc in resp['docs']:
+            chan_id = int(doc['_id'])
+            if doc.get('found') is not True:
+                log.warning(f"{chan_id} isn't in {self.queue_index} anymore.")
+                self.scheduler.remove(chan_id)
+                continue
+            if not self._is_claimable(doc['_source'], now=now):
+                log.info(f"{chan_id} can't be crawled now (status: {doc['_source']['status']}).")
+                self.scheduler.upsert(chan_id, doc['_source'])
+                continue
+            current_sources[chan_id] = doc['_source']
+            actions.append({"_op_type": "update",
+                            "_index": self.queue_index,
+                            "_id": chan_id,
+                            "if_seq_no": doc['_seq_no'],
+                            "if_primary_term": doc['_primary_term'],
+                            "doc": document})
+
+        leases = []
+        for ok, item in helpers.streaming_bulk(client=self.client, actions=actions, raise_on_error=False):
+            chan_id = int(item['update']['_id'])
+            if not ok:
+                log.info(f"{chan_id} was modified while claiming it, most likely claimed by another worker.")
+                # back to what we read: if it is still claimable, the next claim tells us its current state
+                self.scheduler.upsert(chan_id, current_sources[chan_id])
+                continue
+            self.scheduler.upsert(chan_id, {**current_sources[chan_id], **document})
+            leases.append({"chan_id": chan_id, "lease_expires": document["lease_expires"],
+                           "max_msg_id": current_sources[chan_id].get("max_msg_id") or 0})
+            log.info(f"{chan_id} status changed to being crawled: {item['update']['result']}")
+        return leases
 
-        log.info(f"{chan_id} status changed to being crawled: {resp['result']}")
-        return resp.raw
+    @staticmethod
+    def _is_claimable(document: dict, now: int) -> bool:
+        if document['status'] == ChannelStatus.to_crawl:
+            return True
+        if document['status'] == ChannelStatus.crawled:
+            return now - int(document['time_crawling_started']) >= MIN_CRAWL_INTERVAL
+        # being crawled: only if the spider crawling it stopped renewing its lease
+        return BaseElasticInteractor._lease_expiry(document) < now
+
+    @staticmethod
+    def _lease_expiry(document: dict) -> int:
+        # channels dispatched before leases existed don't have a `lease_expires` field
+        lease_expires = document.get('lease_expires')
+        if lease_expires is None:
+            return int(document['time_crawling_started']) + LEASE_DURATION
+        return int(lease_expires)
+
+    def renew_leases(self, chan_ids: list, spider_id=None) -> dict:
+        """
+        Heartbeat of a spider: extends the lease of the channels it is crawling, in a single bulk request.
+        A lease is only renewed if the channel is still `being_crawled` by that spider.
+        :return: {"renewed": [chan_id, ...], "lost": [chan_id, ...]}
+        """
+        lease_expires = int(datetime.datetime.now().timestamp()) + LEASE_DURATION
+        actions = ({"_op_type": "update",
+                    "_index": self.queue_index,
+                    "_id": chan_id,
+                    "script": {"source": self.RENEW_LEASE_SCRIPT,
+                               "params": {"status": ChannelStatus.being_crawled,
+                                          "spider_id": spider_id,
+                                          "lease_expires": lease_expires}}}
+                   for chan_id in chan_ids)
+        result = {"renewed": [], "lost": []}
+        for ok, item in helpers.streaming_bulk(client=self.client, actions=actions, raise_on_error=False):
+            chan_id = int(item['update']['_id'])
+            if ok and item['update']['result'] == "updated":
+                result["renewed"].append(chan_id)
+                self.scheduler.update(chan_id, lease_expires=lease_expires)
+            else:
+                result["lost"].append(chan_id)
+        if result["lost"]:
+            log.warning(f"Spider {spider_id} lost its lease on {result['lost']}")
+        return result
+
+    def reclaim_expired_leases(self) -> list:
+        """
+        Puts back `to_crawl` the channels `being_crawled` whose lease expired (spider dead or stuck). Each channel is
+        updated with if_seq_no/if_primary_term, so this can run on every orchestrator at the same time.
+        :return: IDs of the reclaimed channels
+        """
+        now = int(datetime.datetime.now().timestamp())
+        query = {"bool": {"must": [{"term": {"status": ChannelStatus.being_crawled}}],
+                          "should": [{"range": {"lease_expires": {"lt": now}}},
+                                     {"bool": {"must_not": [{"exists": {"field": "lease_expires"}}],
+                                               "must": [{"range": {"time_crawling_started":
+                                                                       {"lt": now - LEASE_DURATION}}}]}}],
+                          "minimum_should_match": 1}}
+        resp = self.client.search(index=self.queue_index, query=query, size=QUEUE_SCAN_PAGE_SIZE,
+                                  seq_no_primary_term=True)
+        reclaimed = []
+        for doc in resp['hits']['hits']:
+            chan_id = doc['_source']['chan_id']
+            document = {"status": ChannelStatus.to_crawl, "lease_expires": 0, "spider_id": None}
+            try:
+                self.client.update(index=self.queue_index, id=doc['_id'], doc=document,
+                                   if_seq_no=doc['_seq_no'], if_primary_term=doc['_primary_term'])
+            except ConflictError:
+                # heartbeat received or reclaimed by another orchestrator meanwhile
+                continue
+            self.scheduler.upsert(chan_id, {**doc['_source'], **document})
+            reclaimed.append(chan_id)
+        if reclaimed:
+            log.warning(f"Lease expired, channels put back in the queue: {reclaimed}")
+        return reclaimed
 
-    def _change_channel_crawling_status_to_crawled(self, chan_id: int):
+    def _change_channel_crawling_status_to_crawled(self, chan_id: int, max_msg_id: int = 0, spider_id=None):
         """
                 Not to be used outside of save_data_xposted.
                 :param chan_id: Username of the channel that must be updated
+                :param max_msg_id: highest message ID crawled, raises the watermark of the channel
+                :param spider_id: spider that crawled the channel, the status is left as is if the channel is now
+                `being_crawled` by another spider. None (older spiders): always marked crawled.
                 :return:
                 """
         resp = self.client.update(index=self.queue_index,
                                   id=chan_id,
-                                  doc={"status": ChannelStatus.crawled})
+                                  script={"source": self.MARK_CRAWLED_SCRIPT,
+                                          "params": {"status": ChannelStatus.crawled, "max_msg_id": max_msg_id,
+                                                     "being_crawled": ChannelStatus.being_crawled,
+                                                     "spider_id": spider_id}},
+                                  source=True)
+        # the updated document comes with the response, the scheduler gets the right time_crawling_started even if
+        # the crawl was dispatched by another worker
+        self.scheduler.upsert(chan_id, resp['get']['_source'])
 
         log.info(f"{chan_id} status changed to {ChannelStatus.crawled}: {resp['result']}")
         return resp.raw
@@ -403,6 +946,29 @@ class BaseElasticInteractor:
         return chan_info
 
 
+    def get_crawled_channel_ids(self, chan_ids: list) -> set:
+        """
+        Returns the IDs, among chan_ids, of the channels present in CHANNEL_INDEX. Only the channels the seen channels
+        filter can't decide on are looked up, with a single mget.
+        """
+        crawled = set()
+        to_check = []
+        for chan_id in chan_ids:
+            known = self.seen_channels.check(chan_id) if self.seen_channels is not None else None
+            if known is None:
+                to_check.append(chan_id)
+            elif known is True:
+                crawled.add(chan_id)
+        if not to_check:
+            return crawled
+
+        resp = self.client.mget(index=self.channel_index, ids=to_check, source=False)
+        found = {int(doc['_id']) for doc in resp['docs'] if doc.get('found') is True}
+        if self.seen_channels is not None:
+            for chan_id in to_check:
+                self.seen_channels.remember(chan_id, crawled=chan_id in found)
+        return crawled | found
+
     def get_channel_by_id(self, chan_id):
         chan_id_query = self.GET_CHANNEL_BY_ID_QUERY.copy()
         chan_id_query["match_phrase"]["chan_id"]["query"] = chan_id
@@ -418,6 +984,10 @@ class BaseElasticInteractor:
     def check_connection(self):
         return self.client.ping()
 
+    def close(self):
+        self._bulk_executor.shutdown(wait=True)
+        self.client.close()
+
 
 class ElasticInteractor(BaseElasticInteractor):
 
@@ -425,6 +995,14 @@ class ElasticInteractor(BaseElasticInteractor):
         # creating the indices that we need if they aren't there
         super().__init__(*args, **kwargs)
         self.check_and_create_indices(indices=[self.post_index, self.queue_index, self.channel_index])
+        self.load_queue_into_scheduler()
+        self.seen_channels = SeenChannels(capacity=SEEN_FILTER_CAPACITY, error_rate=SEEN_FILTER_ERROR_RATE,
+                                          lru_size=SEEN_FILTER_LRU_SIZE, path=SEEN_FILTER_PATH)
+        self.load_seen_channels()
+
+    def close(self):
+        self.seen_channels.save()
+        super().close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,339 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+from logging import getLogger
+
+log = getLogger("ingestlog")
+log.setLevel(logging.DEBUG)
+
+
+def _check_id(value, name):
+    try:
+        int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} {value!r} isn't an integer")
+
+
+def _check_fields(item: dict, name: str, fields: dict):
+    """Raises ValueError if `item` isn't a dict or is missing one of `fields` ({key: type}), or has the wrong type"""
+    if not isinstance(item, dict):
+        raise ValueError(f"{name} isn't an object")
+    for key, value_type in fields.items():
+        if key not in item:
+            raise ValueError(f"{name} has no {key}")
+        if value_type is int and key.endswith("id"):
+            _check_id(item[key], f"{key} of {name}")
+        elif not isinstance(item[key], value_type) or (value_type is int and isinstance(item[key], bool)):
+            raise ValueError(f"{key} of {name} isn't a {value_type.__name__}")
+
+
+def validate_posts_payload(data):
+    """
+    Raises ValueError if `data` isn't a {chan_id: {post_id: post}} payload the drainers can write. Only the structure is
+    checked, the posts themselves are indexed as they are.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("not a {chan_id: {post_id: post}} object")
+    for chan_id, posts in data.items():
+        _check_id(chan_id, "channel ID")
+        if not isinstance(posts, dict) or not all(isinstance(post, dict) for post in posts.values()):
+            raise ValueError(f"posts of channel {chan_id} aren't a {{post_id: post}} object")
+
+
+def validate_xposted_payload(data):
+    """
+    Raises ValueError if `data` isn't a channel info payload (see shared/datachecker.py TEMPLATE_CHANNEL_INFO) the
+    drainers can write: every field read by the databases is there, with the right type.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("not a {channel_info, fwd_chan_dict, linked_chan_dict} object")
+    # the title, verification and number of participants are saved as they are (None if Telegram didn't give them)
+    _check_fields(data.get("channel_info"), "channel_info", {"chan_id": int, "username": str, "title": object,
+                                                              "verified": object, "nb_participants": object})
+    # payloads of spiders older than the message IDs ranges don't have them
+    _check_fields(data["channel_info"], "channel_info", {key: int for key in ("min_msg_id", "max_msg_id")
+                                                         if key in data["channel_info"]})
+    # payloads of spiders older than the t.me links don't have linked_chan_dict
+    for key, fields in (("fwd_chan_dict", {"chan_username": str, "chan_id": int, "nb_of_forwards": int}),
+                        ("linked_chan_dict", {"chan_username": str, "nb_of_links": int})):
+        items = data.get(key, []) if key == "linked_chan_dict" else data.get(key)
+        if not isinstance(items, list):
+            raise ValueError(f"{key} isn't a list")
+        for item in items:
+            _check_fields(item, f"an item of {key}", fields)
+
+
+def decode_payload(kind: str, payload: bytes):
+    """
+    Decodes the body of a /save_data (IngestLog.POSTS) or /save_data_xposted (IngestLog.XPOSTED) request, raises
+    ValueError if it isn't valid JSON or not a payload the drainers can write.
+    """
+    data = json.loads(payload)
+    if kind == IngestLog.XPOSTED:
+        validate_xposted_payload(data)
+    else:
+        validate_posts_payload(data)
+    return data
+
+
+class IngestLog:
+    """
+    Durable queue of the payloads received by /save_data and /save_data_xposted, waiting to be written to the
+    databases (write-behind). The request is acknowledged as soon as its payload is appended, background drainers
+    (see DatabasePool) write the entries to Elasticsearch and Neo4j in batches.
+
+    Entries are stored in a SQLite database in WAL mode, shared by all the worker processes of the orchestrator. A
+    drainer claims entries with its own token before processing them, a claim expires after `claim_timeout` seconds
+    so the entries of a crashed drainer are processed by another one. An entry is processed again if anything fails
+    before it is acknowledged: posts are indexed under fixed IDs, a channel info saved again is a noop (its range of
+    messages is already covered, see esinter.MERGE_CHANNEL_INFO_SCRIPT) and its forwards aren't added to the priorities
+    of the queue again, the graph DB keys its counts by the same ranges.
+
+    A payload appended with an idempotency key is appended once: the key is remembered for `key_ttl` seconds, a
+    payload sent again with it (the reporter retrying after a timeout, its response lost...) isn't appended again.
+
+    The bodies of /save_data_stream are appended in several entries as they are received (see stage and publish), the
+    drainers only see them once the whole body was received.
+
+    An entry the databases keep refusing (see fail) is moved to the dead_letters table after a few attempts, where it
+    waits to be looked at by hand: it doesn't hold back the entries received after it.
+    """
+    POSTS = "posts"
+    XPOSTED = "xposted"
+    # NDJSON, a {chan_id: {post_id: post}} object per line
+    POSTS_NDJSON = "posts_ndjson"
+
+    def __init__(self, path: str, claim_timeout: int, key_ttl: int):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self.key_ttl = key_ttl
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+        self._connection().execute("CREATE TABLE IF NOT EXISTS entries ("
+                                   "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                   "kind TEXT NOT NULL, "
+                                   "payload BLOB NOT NULL, "
+                                   "received_at REAL NOT NULL, "
+                                   "claimed_by TEXT, "
+                                   "claimed_at REAL, "
+                                   "attempts INTEGER NOT NULL DEFAULT 0)")
+        # logs created before the attempts were counted
+        if "attempts" not in [column[1] for column in self._connection().execute("PRAGMA table_info(entries)")]:
+            self._connection().execute("ALTER TABLE entries ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self._connection().execute("CREATE TABLE IF NOT EXISTS dead_letters ("
+                                   "id INTEGER PRIMARY KEY, "
+                                   "kind TEXT NOT NULL, "
+                                   "payload BLOB NOT NULL, "
+                                   "received_at REAL NOT NULL, "
+                                   "attempts INTEGER NOT NULL, "
+                                   "failed_at REAL NOT NULL, "
+                                   "error TEXT)")
+        self._connection().execute("CREATE TABLE IF NOT EXISTS idempotency_keys ("
+                                   "key TEXT PRIMARY KEY, "
+                                   "received_at REAL NOT NULL)")
+        self._connection().execute("CREATE INDEX IF NOT EXISTS idempotency_keys_received_at "
+                                   "ON idempotency_keys (received_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit mode, transactions are opened explicitly where needed
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # the WAL is synced at every commit: an acknowledged payload survives a power loss
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, kind: str, payload: bytes, key: str = None):
+        """
+        Adds a payload (raw JSON body of the request) at the end of the log.
+        :param key: idempotency key of the payload, None: always appended
+        :return: ID of the entry, None if a payload with the same key was already appended
+        """
+        now = time.time()
+        conn = self._connection()
+        # the key and the entry are added together, or not at all
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if key is not None:
+                cursor = conn.execute("INSERT OR IGNORE INTO idempotency_keys (key, received_at) VALUES (?, ?)",
+                                      (key, now))
+                if cursor.rowcount == 0:
+                    conn.execute("COMMIT")
+                    return None
+            cursor = conn.execute("INSERT INTO entries (kind, payload, received_at) VALUES (?, ?, ?)",
+                                  (kind, payload, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.lastrowid
+
+    def stage(self, kind: str, payload: bytes, owner: str) -> int:
+        """
+        Adds a payload the drainers can't claim yet: it is claimed by `owner` until published (or removed with ack).
+        The claim of the entries already staged by `owner` is renewed, the claim of the entries of a request that
+        never finished (crash of the worker) expires after claim_timeout seconds and they are drained anyway.
+        :return: ID of the entry
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute("INSERT INTO entries (kind, payload, received_at, claimed_by, claimed_at) "
+                                  "VALUES (?, ?, ?, ?, ?)", (kind, payload, now, owner, now))
+            conn.execute("UPDATE entries SET claimed_at = ? WHERE claimed_by = ?", (now, owner))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.lastrowid
+
+    def publish(self, owner: str, entry_ids: list, key: str = None) -> bool:
+        """
+        Gives the entries staged by `owner` to the drainers, all at once. If a payload with the same idempotency key
+        was already appended, they are removed instead.
+        :return: False if the payload was a duplicate
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            duplicate = key is not None and conn.execute("INSERT OR IGNORE INTO idempotency_keys (key, received_at) "
+                                                         "VALUES (?, ?)", (key, time.time())).rowcount == 0
+            if duplicate:
+                conn.executemany("DELETE FROM entries WHERE id = ? AND claimed_by = ?",
+                                 [(entry_id, owner) for entry_id in entry_ids])
+            else:
+                conn.executemany("UPDATE entries SET claimed_by = NULL, claimed_at = NULL "
+                                 "WHERE id = ? AND claimed_by = ?", [(entry_id, owner) for entry_id in entry_ids])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return not duplicate
+
+    def expire_keys(self) -> int:
+        """Forgets the idempotency keys received more than key_ttl seconds ago, returns the number of keys removed."""
+        cursor = self._connection().execute("DELETE FROM idempotency_keys WHERE received_at < ?",
+                                            (time.time() - self.key_ttl,))
+        return cursor.rowcount
+
+    def depth(self) -> int:
+        """Number of entries not written to the databases yet (claimed or not)."""
+        return self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def claim(self, owner: str, limit: int, max_bytes: int = None) -> list[tuple]:
+        """
+        Claims the oldest entries that aren't claimed (or whose claim expired) for `owner`: `limit` entries at most,
+        and max_bytes bytes of payloads at most (at least one entry whatever its size).
+
+        XPOSTED entries received after posts entries still claimed by someone else (another drainer, or a body still
+        being received) are left for later: a channel is marked crawled once its posts are written, whichever worker
+        drains them.
+        :return: [(id, kind, payload), ...] in the order they were received.
+        """
+        now = time.time()
+        conn = self._connection()
+        # IMMEDIATE: takes the write lock right away, two drainers can't select the same entries
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # the payloads are only read once the entries are picked
+            candidates = conn.execute("SELECT id, kind, length(payload) FROM entries "
+                                      "WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY id LIMIT ?",
+                                      (now - self.claim_timeout, limit)).fetchall()
+            oldest_posts_in_flight = conn.execute("SELECT MIN(id) FROM entries WHERE kind != ? AND claimed_by != ? "
+                                                  "AND claimed_at >= ?",
+                                                  (self.XPOSTED, owner, now - self.claim_timeout)).fetchone()[0]
+            entry_ids = []
+            total_bytes = 0
+            for entry_id, kind, size in candidates:
+                if kind == self.XPOSTED and oldest_posts_in_flight is not None and entry_id > oldest_posts_in_flight:
+                    continue
+                if entry_ids and max_bytes is not None and total_bytes + size > max_bytes:
+                    break
+                entry_ids.append(entry_id)
+                total_bytes += size
+            conn.executemany("UPDATE entries SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                             [(owner, now, entry_id) for entry_id in entry_ids])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if not entry_ids:
+            return []
+        return conn.execute(f"SELECT id, kind, payload FROM entries WHERE id IN ({', '.join('?' * len(entry_ids))}) "
+                            f"AND claimed_by = ? ORDER BY id", (*entry_ids, owner)).fetchall()
+
+    def ack(self, owner: str, entry_ids: list):
+        """Removes entries written to the databases."""
+        self._connection().executemany("DELETE FROM entries WHERE id = ? AND claimed_by = ?",
+                                       [(entry_id, owner) for entry_id in entry_ids])
+
+    def release(self, owner: str, entry_ids: list):
+        """Gives back entries that couldn't be written, they will be claimed again."""
+        self._connection().executemany("UPDATE entries SET claimed_by = NULL, claimed_at = NULL "
+                                       "WHERE id = ? AND claimed_by = ?",
+                                       [(entry_id, owner) for entry_id in entry_ids])
+
+    def fail(self, owner: str, entry_ids: list, error: str, max_attempts: int) -> list:
+        """
+        Gives back entries the databases refused (because of their content, not because they couldn't be reached): one
+        more attempt is counted, the entries that failed max_attempts times are moved to the dead letters instead.
+        :return: IDs of the entries moved to the dead letters
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            params = [(entry_id, owner) for entry_id in entry_ids]
+            conn.executemany("UPDATE entries SET attempts = attempts + 1 WHERE id = ? AND claimed_by = ?", params)
+            dead = [entry_id for entry_id, in conn.execute(
+                f"SELECT id FROM entries WHERE id IN ({', '.join('?' * len(entry_ids))}) AND claimed_by = ? "
+                f"AND attempts >= ?", (*entry_ids, owner, max_attempts))]
+            self._move_to_dead_letters(conn, owner=owner, entry_ids=dead, error=error)
+            conn.executemany("UPDATE entries SET claimed_by = NULL, claimed_at = NULL WHERE id = ? AND claimed_by = ?",
+                             params)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return dead
+
+    def dead_letter(self, owner: str, entry_ids: list, error: str):
+        """Moves entries that will never be written (ex: not a valid payload) to the dead letters right away."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._move_to_dead_letters(conn, owner=owner, entry_ids=entry_ids, error=error)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _move_to_dead_letters(conn: sqlite3.Connection, owner: str, entry_ids: list, error: str):
+        now = time.time()
+        params = [(entry_id, owner) for entry_id in entry_ids]
+        conn.executemany("INSERT OR REPLACE INTO dead_letters (id, kind, payload, received_at, attempts, failed_at, "
+                         "error) SELECT id, kind, payload, received_at, attempts, ?, ? FROM entries "
+                         "WHERE id = ? AND claimed_by = ?", [(now, error, *param) for param in params])
+        conn.executemany("DELETE FROM entries WHERE id = ? AND claimed_by = ?", params)
+
+    def dead_letters(self) -> list[tuple]:
+        """:return: [(id, kind, payload, attempts, error), ...] of the entries moved to the dead letters"""
+        return self._connection().execute("SELECT id, kind, payload, attempts, error FROM dead_letters "
+                                          "ORDER BY id").fetchall()
+
+    def stats(self) -> dict:
+        conn = self._connection()
+        depth, claimed, oldest = conn.execute("SELECT COUNT(*), COUNT(claimed_by), MIN(received_at) "
+                                              "FROM entries").fetchone()
+        keys = conn.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0]
+        dead_letters = conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        return {"depth": depth,
+                "claimed": claimed,
+                "oldest_entry_age": round(time.time() - oldest, 3) if oldest is not None else 0,
+                "idempotency_keys": keys,
+                "dead_letters": dead_letters}
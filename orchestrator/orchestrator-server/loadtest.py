@@ -0,0 +1,145 @@
+#!/usr/local/bin/python
+"""
+Small load generator for the orchestrator, only relying on the standard library so it can be run from the orchestrator
+image or from any machine with Python.
+
+Run it once against the server started with SERVER_DEV_MODE=true (the single process development server) and once
+against the worker processes to compare them. Ex:
+
+    python loadtest.py --url http://127.0.0.1:33445 --endpoint save_data --concurrency 16 --duration 30
+
+WARNING: the save_data and save_data_xposted endpoints really write into the indices of the orchestrator. The posts are
+saved under a fake channel ID (see --channel-id) so they can be removed afterward.
+"""
+
+import json
+import time
+import argparse
+import threading
+import statistics
+import http.client
+from urllib.parse import urlparse
+
+
+def build_posts_payload(channel_id, nb_posts):
+    """Posts following the format of shared/datachecker.py TEMPLATE_POSTS"""
+    now = int(time.time())
+    posts = {}
+    for post_id in range(nb_posts):
+        posts[post_id] = {"text": f"Load test post #{post_id} https://example.com/some/path?x={post_id}",
+                          "forwards": post_id % 7,
+                          "views": post_id * 3,
+                          "reply": False,
+                          "id": post_id,
+                          "forwarded_from": "",
+                          "urls": [f"https://example.com/some/path?x={post_id}"],
+                          "domains": ["example.com"],
+                          "tme_links": [],
+                          "mentions": [],
+                          "hashtags": ["loadtest"],
+                          "date": now}
+    return {channel_id: posts}
+
+
+def build_xposted_payload(channel_id):
+    return {"channel_info": {"chan_id": channel_id,
+                             "title": "Load test channel",
+                             "username": "load_test_channel",
+                             "verified": False,
+                             "nb_participants": 0,
+                             "min_msg_id": 0,
+                             "max_msg_id": 0},
+            "fwd_chan_dict": [],
+            "linked_chan_dict": []}
+
+
+class LoadWorker(threading.Thread):
+    def __init__(self, url, method, path, body, deadline):
+        super().__init__(daemon=True)
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.method = method
+        self.path = path
+        self.body = body
+        self.deadline = deadline
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        # one keep-alive connection per worker, like a spider would do
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = {"Content-Type": "application/json"}
+        while time.monotonic() < self.deadline:
+            start = time.monotonic()
+            try:
+                conn.request(self.method, self.path, body=self.body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status >= 400:
+                    self.errors += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+                continue
+            self.latencies.append(time.monotonic() - start)
+        conn.close()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_load_test(url, endpoint, concurrency, duration, nb_posts, channel_id):
+    if endpoint == "next":
+        method, path, body = "GET", "/next", None
+    elif endpoint == "save_data":
+        method, path = "POST", "/save_data"
+        body = json.dumps(build_posts_payload(channel_id=channel_id, nb_posts=nb_posts)).encode("utf8")
+    else:
+        method, path = "POST", "/save_data_xposted"
+        body = json.dumps(build_xposted_payload(channel_id=channel_id)).encode("utf8")
+
+    deadline = time.monotonic() + duration
+    workers = [LoadWorker(url=url, method=method, path=path, body=body, deadline=deadline)
+               for _ in range(concurrency)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+
+    latencies = [lat for worker in workers for lat in worker.latencies]
+    return {"endpoint": path,
+            "concurrency": concurrency,
+            "requests": len(latencies),
+            "errors": sum(worker.errors for worker in workers),
+            "requests_per_sec": round(len(latencies) / elapsed, 2),
+            "posts_per_sec": round(len(latencies) * nb_posts / elapsed, 2) if endpoint == "save_data" else None,
+            "latency_ms": {"mean": round(statistics.mean(latencies) * 1000, 2) if latencies else 0.0,
+                           "p50": round(percentile(latencies, 50) * 1000, 2),
+                           "p95": round(percentile(latencies, 95) * 1000, 2),
+                           "p99": round(percentile(latencies, 99) * 1000, 2)}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Orchestrator load test',
+                                     description='Measures how many requests per second the orchestrator handles.')
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:33445", help='Base URL of the orchestrator.')
+    parser.add_argument('-e', '--endpoint', type=str, choices=['next', 'save_data', 'save_data_xposted'],
+                        default='save_data', help='Endpoint to hammer.')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Number of concurrent clients.')
+    parser.add_argument('-d', '--duration', type=int, default=30, help='Duration of the test (in seconds).')
+    parser.add_argument('-p', '--posts', type=int, default=200, help='Posts per save_data request (CHUNK_SIZE).')
+    parser.add_argument('--channel-id', type=int, default=-424242, help='Fake channel ID used for the saved data.')
+    args = parser.parse_args()
+
+    result = run_load_test(url=args.url, endpoint=args.endpoint, concurrency=args.concurrency,
+                           duration=args.duration, nb_posts=args.posts, channel_id=args.channel_id)
+    print(json.dumps(result, indent=4))
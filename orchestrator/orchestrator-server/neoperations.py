@@ -1,6 +1,10 @@
 import os
+from logging import getLogger
+
 from neo4j import GraphDatabase
 
+log = getLogger("neoperations")
+
 
 PASSWORD = os.getenv("NEO4J_PASSWORD")
 USERNAME = os.getenv("NEO4J_USERNAME")
@@ -8,13 +12,23 @@ NEO4J_HOSTNAME = os.getenv("GRAPHDB_HOSTNAME")
 
 NEO4J_URI = f"neo4j://{NEO4J_HOSTNAME}"
 NEO4J_AUTH = (USERNAME, PASSWORD)
+# Maximum number of connections the driver keeps open, shared by all the requests of the process.
+NEO4J_MAX_POOL_SIZE = int(os.getenv("NEO4J_MAX_POOL_SIZE", default=50))
 
 
 class GraphDB:
-    def __init__(self, uri, auth):
-        self.driver = GraphDatabase.driver(uri=uri, auth=auth)
+    def __init__(self, uri, auth, max_connection_pool_size=NEO4J_MAX_POOL_SIZE):
+        self.driver = GraphDatabase.driver(uri=uri, auth=auth, max_connection_pool_size=max_connection_pool_size)
         self.driver.verify_connectivity()
 
+    def check_connection(self):
+        try:
+            self.driver.verify_connectivity()
+        except Exception as err:
+            log.warning(f"Neo4j connectivity check failed: {err}")
+            return False
+        return True
+
     def create_db(self, db_name):
         """Not possible with the community edition apparently. Let's limit ourselves with one DB.
         https://stackoverflow.com/questions/60429947/error-occurs-when-creating-a-new-database-under-neo4j-4-0"""
@@ -40,78 +54,141 @@ class GraphDB:
 
         return False
 
-    def _add_channel(self, chan_info):
+    # Schema created at startup: MERGE on the username and lookups by chan_id use an index instead of scanning every
+    # Channel node.
+    USERNAME_CONSTRAINT_QUERY = "CREATE CONSTRAINT channel_username IF NOT EXISTS FOR (n:Channel) REQUIRE n.username " \
+                                "IS UNIQUE"
+    USERNAME_INDEX_QUERY = "CREATE INDEX channel_username_index IF NOT EXISTS FOR (n:Channel) ON (n.username)"
+    CHAN_ID_INDEX_QUERY = "CREATE INDEX channel_chan_id IF NOT EXISTS FOR (n:Channel) ON (n.chan_id)"
+    # Telegram usernames are case-insensitive, they are saved in lower case (see _channel_row). Nodes created before
+    # that are renamed at startup.
+    LOWER_USERNAMES_QUERY = "MATCH (n:Channel) WHERE n.username <> toLower(n.username) " \
+                            "SET n.username = toLower(n.username)"
+
+    # Relationships counting something per range of message IDs crawled (parallel lists range_min, range_max and
+    # range_count), `value` is their sum. The ranges never overlap: a new range replaces the ranges it contains, then is
+    # trimmed to the messages the other ones don't count yet (they can only overlap one of its ends), its count being
+    # scaled down to what is left of it. Saving the same crawl twice, or crawling the same messages again, doesn't
+    # change the count.
+    # REL_TYPE and ROW_LIST are replaced by the relationship type and the list of the row holding the counts.
+    RANGE_COUNT_SUBQUERY = """
+        CALL {
+          WITH n, row
+          UNWIND row.ROW_LIST AS counted
+          MERGE (target:Channel {username: counted.username})
+          MERGE (n)-[rel:REL_TYPE]->(target)
+          WITH rel, counted, row,
+               coalesce(rel.range_min, []) AS mins,
+               coalesce(rel.range_max, []) AS maxs,
+               coalesce(rel.range_count, []) AS counts
+          WITH rel, counted, row, mins, maxs, counts,
+               [i IN range(0, size(mins) - 1)
+                WHERE NOT (row.min_msg_id <= mins[i] AND maxs[i] <= row.max_msg_id)] AS kept
+          WITH rel, counted, row, mins, maxs, counts, kept,
+               reduce(lo = row.min_msg_id, i IN kept |
+                      CASE WHEN mins[i] <= row.min_msg_id AND row.min_msg_id <= maxs[i] THEN maxs[i] + 1 ELSE lo END
+               ) AS lo,
+               reduce(hi = row.max_msg_id, i IN kept |
+                      CASE WHEN mins[i] <= row.max_msg_id AND row.max_msg_id <= maxs[i] THEN mins[i] - 1 ELSE hi END
+               ) AS hi
+          WITH rel, mins, maxs, counts, kept, lo, hi, lo <= hi AS added,
+               toInteger(round(toFloat(counted.value) * (hi - lo + 1) / (row.max_msg_id - row.min_msg_id + 1)))
+               AS trimmed_count
+          WITH rel,
+               [i IN kept | mins[i]] + CASE WHEN added THEN [lo] ELSE [] END AS new_mins,
+               [i IN kept | maxs[i]] + CASE WHEN added THEN [hi] ELSE [] END AS new_maxs,
+               [i IN kept | counts[i]] + CASE WHEN added THEN [trimmed_count] ELSE [] END AS new_counts
+          SET
+            rel.range_min = new_mins,
+            rel.range_max = new_maxs,
+            rel.range_count = new_counts,
+            rel.value = reduce(total = 0, nb IN new_counts | total + nb)
+        }
         """
 
-
-
-        Doc: https://neo4j.com/docs/python-manual/current/
-
-        :param chan_info:
-        :return:
+    # One row per channel: the channel node, its FORWARDS relationships (forwards of the posts of the other channels)
+    # and its LINKS relationships (t.me links to the other channels) are written by the same query, in a single
+    # transaction whatever the number of channels.
+    ADD_CHANNELS_QUERY = """
+        UNWIND $rows AS row
+        MERGE (n:Channel {username: row.username})
+        SET
+          n.chan_id = row.chan_id,
+          n.nb_participants = row.nb_participants,
+          n.verified = row.verified,
+          n.title = row.title
+        WITH n, row
+        """ + RANGE_COUNT_SUBQUERY.replace("REL_TYPE", "FORWARDS").replace("ROW_LIST", "forwards") \
+        + RANGE_COUNT_SUBQUERY.replace("REL_TYPE", "LINKS").replace("ROW_LIST", "links")
+
+    def create_schema(self):
+        """Creates the constraint and indexes of the Channel nodes if they don't exist yet."""
+        try:
+            self.driver.execute_query(self.LOWER_USERNAMES_QUERY)
+        except Exception as err:
+            # a channel saved under two cases: both nodes must be merged by hand
+            log.error(f"Couldn't save the usernames of the Channel nodes in lower case: {err}")
+        try:
+            self.driver.execute_query(self.USERNAME_CONSTRAINT_QUERY)
+        except Exception as err:
+            # most likely duplicated usernames created before the constraint existed, an index still avoids the scans
+            log.error(f"Couldn't create the uniqueness constraint on Channel.username, creating an index: {err}")
+            self.driver.execute_query(self.USERNAME_INDEX_QUERY)
+        self.driver.execute_query(self.CHAN_ID_INDEX_QUERY)
+        log.info("Graph DB schema ready")
+
+    @staticmethod
+    def _username_key(username):
+        return username.lower() if username is not None else None
+
+    @classmethod
+    def _channel_row(cls, channel_info: dict, fwd_chan_list: list, linked_chan_list: list = ()) -> dict:
         """
-
-        resp = self.driver.execute_query(query_="""
-        MERGE (n:Channel {username: $username})
-        ON CREATE
-          SET
-            n.chan_id = $chan_id,
-            n.nb_participants = $nb_participants,
-            n.verified = $verified,
-            n.title = $title
-        ON MATCH
-          SET
-            n.chan_id = $chan_id,
-            n.nb_participants = $nb_participants,
-            n.verified = $verified,
-            n.title = $title
-        RETURN n.username""",
-                                         title=chan_info['title'],
-                                         username=chan_info['username'],
-                                         verified=chan_info['verified'],
-                                         chan_id=chan_info['chan_id'],
-                                         nb_participants=chan_info['nb_participants'])
-
-        return resp.summary.summary_notifications
-
-    def _update_forward_info(self, chan_info: dict, fwd_chan_list: dict):
+        Parameters of ADD_CHANNELS_QUERY for one channel.
+        :param channel_info: see shared/datachecker.py TEMPLATE_CHANNEL_INFO. Data sent by older spiders has no message
+        IDs range, it is then counted as the range [0, 0] (each save replaces the previous one).
+        Usernames are case-insensitive (t.me/Name and t.me/name are the same channel): the nodes are merged on the
+        username in lower case.
+        :param fwd_chan_list: [{"chan_username": str, "chan_id": int, "nb_of_forwards": int}, ...]
+        :param linked_chan_list: [{"chan_username": str, "nb_of_links": int}, ...]
+        """
+        return {"username": cls._username_key(channel_info['username']),
+                "chan_id": channel_info['chan_id'],
+                "nb_participants": channel_info['nb_participants'],
+                "verified": channel_info['verified'],
+                "title": channel_info['title'],
+                "min_msg_id": channel_info.get('min_msg_id', 0),
+                "max_msg_id": channel_info.get('max_msg_id', 0),
+                "forwards": [{"username": cls._username_key(fwd_chan["chan_username"]),
+                              "value": fwd_chan["nb_of_forwards"]}
+                             for fwd_chan in fwd_chan_list],
+                "links": [{"username": cls._username_key(linked_chan["chan_username"]),
+                           "value": linked_chan["nb_of_links"]}
+                          for linked_chan in linked_chan_list]}
+
+    @classmethod
+    def _write_channels(cls, tx, rows: list):
+        return tx.run(cls.ADD_CHANNELS_QUERY, rows=rows).consume()
+
+    def add_channels_info_and_fwd_channels(self, channels: list):
         """
-        Warning: this may lead to false numbers, if the messages forwarded are crawled twice, they will be added twice
-        in the relationship as well!
-        :param parent_chan_info:
-        :return:
+        Adds the information of several channels to the graph DB, their forwards to the relationships with the
+        forwarded channels and their t.me links to the relationships with the linked channels, in one transaction
+        (retried by the driver on transient errors).
+        :param channels: [(channel_info, fwd_chan_list, linked_chan_list), ...]
         """
-        usernames = [k["chan_username"] for k in fwd_chan_list]
-        chan_id_par = chan_info['chan_id']
-        for usern in usernames:
-            # Need the "*" on the second WITH, else, the parent variable isn't carried over.
-            qv3 = """
-            MATCH (parent:Channel {chan_id: $chan_id_par})
-            WITH parent 
-            MERGE (fwdchan:Channel {username: $username_fwd})
-            WITH *
-            MERGE (parent)-[rel:FORWARDS]->(fwdchan)
-            ON CREATE
-              SET rel.value = $val_rel
-            ON MATCH
-              SET rel.value= rel.value + $val_rel
-            """
-
-            resp = self.driver.execute_query(query_=qv3,
-                                             chan_id_par=chan_id_par,
-                                             username_fwd=usern,
-                                             val_rel=fwd_chan_list[usern])
-
-        # return resp.summary.summary_notifications
-
-    def add_channel_info_and_fwd_channels(self, channel_info: dict, fwd_chan_list: dict):
+        rows = [self._channel_row(channel_info=channel_info, fwd_chan_list=fwd_chan_list,
+                                  linked_chan_list=linked_chan_list)
+                for channel_info, fwd_chan_list, linked_chan_list in channels]
+        with self.driver.session() as session:
+            summary = session.execute_write(self._write_channels, rows=rows)
+        log.debug(f"{len(rows)} channels written to the graph DB: {summary.counters}")
+        return summary
+
+    def add_channel_info_and_fwd_channels(self, channel_info: dict, fwd_chan_list: list, linked_chan_list=()):
         """Adds a channel information to the graph DB and adds its fwd to the relationships with the forwarded channel.
         """
-
-        # TODO do some errors reporting by reading the returns of the following methods, at least raise exception when
-        # isn't added to DB correctly: https://neo4j.com/docs/python-manual/current/result-summary/
-        self._add_channel(chan_info=channel_info)
-        self._update_forward_info(chan_info=channel_info, fwd_chan_list=fwd_chan_list)
+        return self.add_channels_info_and_fwd_channels(channels=[(channel_info, fwd_chan_list, linked_chan_list)])
 
     def delete_all_channels(self):
         self.driver.execute_query("""MATCH (n:Channel)
@@ -121,6 +198,9 @@ class GraphDB:
         self.driver.execute_query("""MATCH (n)
                                      DETACH DELETE n""")
 
+    def close(self):
+        self.driver.close()
+
     def __del__(self):
         self.driver.close()
 
@@ -0,0 +1,222 @@
+import heapq
+import logging
+import threading
+from logging import getLogger
+
+log = getLogger("scheduler")
+log.setLevel(logging.DEBUG)
+
+# Same values as esinter.ChannelStatus, not imported from there as esinter imports this module.
+TO_CRAWL = "to_crawl"
+BEING_CRAWLED = "being_crawled"
+CRAWLED = "crawled"
+
+
+class QueueScheduler:
+    """
+    In-memory index of the queue index, used to pick the next channel to be crawled without searching Elasticsearch.
+
+    Channels `to_crawl` are kept in a heap ordered by priority (highest first, oldest `time_added` on ties) and channels
+    `crawled` in a heap ordered by `time_crawling_started` (oldest first). Channels `being_crawled` are only kept in the
+    entries dict.
+
+    Heaps are never searched: when a channel changes, a new heap item is pushed with a new version and the old one is
+    dropped lazily, when it reaches the top of its heap. Every operation is O(log n).
+
+    The queue index stays the reference: every change is written to Elasticsearch by the caller, the scheduler only
+    mirrors it. It is thread safe, changes made while replace_all rebuilds the index are replayed on the new one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._to_crawl = []     # items: (-priority, time_added, chan_id, version)
+        self._crawled = []      # items: (time_crawling_started, chan_id, version)
+        self._entries = {}      # chan_id: (version, queue document)
+        self._version = 0
+        self._status_count = {TO_CRAWL: 0, BEING_CRAWLED: 0, CRAWLED: 0}
+        # while replace_all runs: chan_id: queue document (None if removed) of the channels changed meanwhile
+        self._changes = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, chan_id):
+        return chan_id in self._entries
+
+    def count_by_status(self) -> dict:
+        return dict(self._status_count)
+
+    def chan_ids(self, status) -> list:
+        """IDs of the channels with the given status."""
+        with self._lock:
+            return [chan_id for chan_id, (_, document) in self._entries.items() if document["status"] == status]
+
+    def get(self, chan_id):
+        """Returns a copy of the queue document of a channel, None if it isn't in the queue."""
+        entry = self._entries.get(chan_id)
+        return dict(entry[1]) if entry is not None else None
+
+    def upsert(self, chan_id, document: dict):
+        """Adds a channel or replaces what we know about it. `document` follows esinter.MAPPING_QUEUE"""
+        with self._lock:
+            self._upsert(chan_id, document)
+
+    def update(self, chan_id, **fields):
+        """Updates some fields of a channel already in the queue. Returns False if the channel isn't known."""
+        with self._lock:
+            entry = self._entries.get(chan_id)
+            if entry is None:
+                return False
+            document = dict(entry[1])
+            document.update(fields)
+            self._upsert(chan_id, document)
+            return True
+
+    def remove(self, chan_id):
+        with self._lock:
+            self._remove(chan_id)
+
+    def snapshot(self) -> int:
+        """Marks the state of the index before the queue index is read, see refresh."""
+        with self._lock:
+            return self._version
+
+    def refresh(self, documents, since: int) -> int:
+        """
+        Adds or replaces channels with queue documents read after snapshot returned `since`. A channel changed since
+        then (what was read is older) or `being_crawled` (picked by a request, its claim may not be written yet) is kept
+        as it is.
+        :param documents: iterable of queue documents (with their `chan_id`), read one at a time.
+        :return: number of channels added or replaced
+        """
+        nb_upserts = 0
+        for document in documents:
+            chan_id = document["chan_id"]
+            with self._lock:
+                entry = self._entries.get(chan_id)
+                if entry is not None and (entry[0] > since or entry[1]["status"] == BEING_CRAWLED):
+                    continue
+                self._upsert(chan_id, document)
+                nb_upserts += 1
+        return nb_upserts
+
+    def replace_all(self, documents):
+        """
+        Rebuilds the index from scratch in O(n). The changes made while `documents` is read (upserts of the requests
+        served meanwhile) are applied to the new index before it replaces the current one: they are at least as recent
+        as what was read.
+        :param documents: iterable of queue documents (with their `chan_id`).
+        """
+        with self._lock:
+            self._changes = {}
+        entries = {}
+        to_crawl = []
+        crawled = []
+        status_count = {TO_CRAWL: 0, BEING_CRAWLED: 0, CRAWLED: 0}
+        # versions of the new index all start after the ones of the current index, old heap items can't match them
+        version = self._version
+        try:
+            for document in documents:
+                version += 1
+                chan_id = document["chan_id"]
+                previous = entries.get(chan_id)
+                if previous is not None:
+                    status_count[previous[1]["status"]] -= 1
+                entries[chan_id] = (version, document)
+                status_count[document["status"]] += 1
+                self._push_item(document, chan_id, version, to_crawl=to_crawl, crawled=crawled)
+        except BaseException:
+            # the current index is kept
+            with self._lock:
+                self._changes = None
+            raise
+        heapq.heapify(to_crawl)
+        heapq.heapify(crawled)
+
+        with self._lock:
+            changes, self._changes = self._changes, None
+            self._entries = entries
+            self._to_crawl = to_crawl
+            self._crawled = crawled
+            self._status_count = status_count
+            self._version = max(self._version, version)
+            for chan_id, document in changes.items():
+                if document is None:
+                    self._remove(chan_id)
+                else:
+                    self._upsert(chan_id, document)
+            status_count = dict(self._status_count)
+        log.info(f"Queue scheduler rebuilt: {status_count} ({len(changes)} changes made meanwhile replayed)")
+
+    def pop_next(self, min_crawl_interval: int, now: int):
+        """
+        Picks the next channel to be crawled and marks it `being_crawled` (in memory only):
+            1. The `to_crawl` channel with the highest priority.
+            2. Else, the `crawled` channel with the oldest `time_crawling_started`, if it was crawled at least
+               `min_crawl_interval` seconds ago.
+        :return: a copy of the queue document of the channel (before the status change), None if nothing is to be
+        crawled.
+        """
+        with self._lock:
+            item = self._peek_valid(self._to_crawl, chan_id_pos=2)
+            if item is not None:
+                heapq.heappop(self._to_crawl)
+                chan_id = item[2]
+            else:
+                item = self._peek_valid(self._crawled, chan_id_pos=1)
+                if item is None or now - item[0] < min_crawl_interval:
+                    return None
+                heapq.heappop(self._crawled)
+                chan_id = item[1]
+
+            document = self._entries[chan_id][1]
+            new_document = dict(document)
+            new_document["status"] = BEING_CRAWLED
+            new_document["time_crawling_started"] = now
+            self._upsert(chan_id, new_document)
+            return dict(document)
+
+    def _peek_valid(self, heap, chan_id_pos):
+        """Drops the outdated items at the top of the heap and returns the first valid one (without popping it)."""
+        while heap:
+            item = heap[0]
+            entry = self._entries.get(item[chan_id_pos])
+            if entry is not None and entry[0] == item[-1]:
+                return item
+            heapq.heappop(heap)
+        return None
+
+    def _remove(self, chan_id):
+        entry = self._entries.pop(chan_id, None)
+        if entry is not None:
+            self._status_count[entry[1]["status"]] -= 1
+        if self._changes is not None:
+            self._changes[chan_id] = None
+
+    def _upsert(self, chan_id, document):
+        if self._changes is not None:
+            self._changes[chan_id] = document
+        previous = self._entries.get(chan_id)
+        if previous is not None:
+            self._status_count[previous[1]["status"]] -= 1
+        self._version += 1
+        self._entries[chan_id] = (self._version, document)
+        self._status_count[document["status"]] += 1
+        self._push_item(document, chan_id, self._version, to_crawl=self._to_crawl, crawled=self._crawled,
+                        push=heapq.heappush)
+        self._compact_if_needed()
+
+    @staticmethod
+    def _push_item(document, chan_id, version, to_crawl, crawled, push=list.append):
+        if document["status"] == TO_CRAWL:
+            push(to_crawl, (-int(document["priority"]), int(document["time_added"]), chan_id, version))
+        elif document["status"] == CRAWLED:
+            push(crawled, (int(document["time_crawling_started"]), chan_id, version))
+
+    def _compact_if_needed(self):
+        """Outdated items are dropped lazily, we still don't want them to pile up in heaps that are rarely popped."""
+        for heap, status, chan_id_pos in ((self._to_crawl, TO_CRAWL, 2), (self._crawled, CRAWLED, 1)):
+            if len(heap) > 2 * self._status_count[status] + 1024:
+                heap[:] = [item for item in heap
+                           if item[-1] == self._entries.get(item[chan_id_pos], (None,))[0]]
+                heapq.heapify(heap)
@@ -0,0 +1,190 @@
+import os
+import math
+import struct
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from logging import getLogger
+
+log = getLogger("seenfilter")
+log.setLevel(logging.DEBUG)
+
+
+class BloomFilter:
+    """
+    Set of integers answering "definitely not in the set" or "probably in the set", in a fixed amount of memory.
+    Sized for `capacity` items at `error_rate` false positives, the rate grows if more items are added.
+    """
+    # magic, version, capacity, nb of bits, nb of hash functions, nb of items added
+    HEADER = struct.Struct("<4sBQQQQ")
+    MAGIC = b"TVBF"
+    VERSION = 1
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.nb_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nb_hashes = max(1, round(self.nb_bits / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.nb_bits / 8))
+        # items that set at least one bit: approximately the number of distinct items added
+        self.count = 0
+
+    def _positions(self, item: int):
+        # double hashing: k positions out of two 64 bits hashes
+        digest = hashlib.blake2b(str(item).encode("utf8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        for i in range(self.nb_hashes):
+            yield (h1 + i * h2) % self.nb_bits
+
+    def add(self, item: int):
+        new = False
+        for pos in self._positions(item):
+            byte, bit = divmod(pos, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, item: int):
+        for pos in self._positions(item):
+            byte, bit = divmod(pos, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def false_positive_rate(self) -> float:
+        """Expected rate of false positives for the amount of items added so far."""
+        return (1 - math.exp(-self.nb_hashes * self.count / self.nb_bits)) ** self.nb_hashes
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+    def to_bytes(self) -> bytes:
+        return self.HEADER.pack(self.MAGIC, self.VERSION, self.capacity, self.nb_bits, self.nb_hashes,
+                                self.count) + self.bits
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        magic, version, capacity, nb_bits, nb_hashes, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("Not a bloom filter file, or unsupported version")
+        bloom = cls.__new__(cls)
+        bloom.capacity = capacity
+        bloom.nb_bits = nb_bits
+        bloom.nb_hashes = nb_hashes
+        bloom.bits = bytearray(data[cls.HEADER.size:])
+        bloom.count = count
+        if len(bloom.bits) != math.ceil(nb_bits / 8):
+            raise ValueError("Truncated bloom filter file")
+        return bloom
+
+
+class SeenChannels:
+    """
+    IDs of the channels already crawled, consulted before asking Elasticsearch.
+
+    check() answers:
+        - False: never crawled, for sure (the bloom filter has no false negatives). No need to ask Elasticsearch.
+        - True: crawled, for sure (exact answer remembered in the LRU cache).
+        - None: probably crawled, Elasticsearch has to confirm. Its answer is then remembered with remember().
+
+    The bloom filter is saved to disk so a restart doesn't need to scan the channel index again.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, lru_size: int, path: str = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lru_size = lru_size
+        self.path = path
+        self.bloom = BloomFilter(capacity=capacity, error_rate=error_rate)
+        self._lru = OrderedDict()    # chan_id: crawled (bool)
+        self._lock = threading.Lock()
+        self.stats_counter = {"definitely_new": 0, "lru_hits": 0, "es_lookups": 0}
+
+    def add(self, chan_id: int):
+        """Marks a channel as crawled."""
+        with self._lock:
+            self.bloom.add(chan_id)
+            self._remember(chan_id, True)
+
+    def add_many(self, chan_ids):
+        with self._lock:
+            for chan_id in chan_ids:
+                self.bloom.add(chan_id)
+
+    def check(self, chan_id: int):
+        with self._lock:
+            if chan_id not in self.bloom:
+                self.stats_counter["definitely_new"] += 1
+                return False
+            crawled = self._lru.get(chan_id)
+            if crawled is not None:
+                self._lru.move_to_end(chan_id)
+                self.stats_counter["lru_hits"] += 1
+                return crawled
+            self.stats_counter["es_lookups"] += 1
+            return None
+
+    def remember(self, chan_id: int, crawled: bool):
+        """Remembers the answer of Elasticsearch for a channel check() couldn't decide on."""
+        with self._lock:
+            if crawled:
+                self.bloom.add(chan_id)
+            self._remember(chan_id, crawled)
+
+    def _remember(self, chan_id, crawled):
+        self._lru[chan_id] = crawled
+        self._lru.move_to_end(chan_id)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def needs_rebuild(self) -> bool:
+        """True once more channels were added than the filter was sized for (false positives rate degrades)."""
+        return self.bloom.count > self.bloom.capacity
+
+    def replace_bloom(self, chan_ids):
+        """Rebuilds the bloom filter from scratch, sized for at least twice the amount of channels given."""
+        chan_ids = list(chan_ids)
+        bloom = BloomFilter(capacity=max(self.capacity, 2 * len(chan_ids)), error_rate=self.error_rate)
+        for chan_id in chan_ids:
+            bloom.add(chan_id)
+        with self._lock:
+            self.bloom = bloom
+
+    def stats(self) -> dict:
+        return {"channels": self.bloom.count,
+                "capacity": self.bloom.capacity,
+                "false_positive_rate": self.bloom.false_positive_rate(),
+                "bloom_memory_bytes": self.bloom.memory_bytes,
+                "lru_entries": len(self._lru),
+                **self.stats_counter}
+
+    def save(self):
+        if self.path is None:
+            return
+        # same as the crawler: written under a temporary name then renamed, a crash never leaves half a file. Every
+        # worker process saves its own filter, the last one wins.
+        temp_path = f"{self.path}.{os.getpid()}.TEMP"
+        with self._lock:
+            data = self.bloom.to_bytes()
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+        log.debug(f"Seen channels filter saved at {self.path} ({len(data)} bytes)")
+
+    def load(self) -> bool:
+        """Loads the bloom filter saved by save(). Returns False if there is none or it can't be read."""
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                bloom = BloomFilter.from_bytes(f.read())
+        except (OSError, ValueError, struct.error) as err:
+            log.error(f"Couldn't load the seen channels filter from {self.path}: {err}")
+            return False
+        with self._lock:
+            self.bloom = bloom
+        log.info(f"Seen channels filter loaded from {self.path}: {bloom.count} channels")
+        return True
@@ -1,12 +1,23 @@
 import os
+import zlib
+import json
+import uuid
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, jsonify, g
+from quart import Quart, Request, request, jsonify
+from quart.asgi import ASGIHTTPConnection
+from quart.wrappers import Body
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from hypercorn.config import Config
+from hypercorn.run import run as hypercorn_run
+import zstandard
 
-from esinter import (ElasticInteractor, EmptyQueueException, ELASTIC_HOST, ELASTIC_PORT, ELASTIC_PASSWORD,
-                     ELASTIC_USERNAME, ELASTIC_HTTP_CERT_PATH, SERVER_PORT, SERVER_HOST, WAIT_FLAG)
+from esinter import (EmptyQueueException, SERVER_PORT, SERVER_HOST, WAIT_FLAG, QUEUE_REFRESH_INTERVAL)
 
-from neoperations import (GraphDB, NEO4J_AUTH, NEO4J_URI)
+from dbpool import DatabasePool
+from ingestlog import IngestLog, decode_payload, validate_posts_payload
 
 # def config_logging(level, format_log, datefmt, filename):
 #     logging.basicConfig(filename=filename, level=level, format=format_log, datefmt=datefmt)
@@ -32,95 +43,500 @@ log.addHandler(stream_handler)
 log.addHandler(file_handler)
 
 
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", default=4))
+# Threads running the (blocking) database calls in each worker process.
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", default=32))
+# "true" runs the single process development server with the reloader instead of the worker processes.
+SERVER_DEV_MODE = json.loads(os.getenv("SERVER_DEV_MODE", default="false"))
+# Longest time (in seconds) a /next request can be held when nothing is to be crawled.
+LONG_POLL_MAX_WAIT = int(os.getenv("LONG_POLL_MAX_WAIT", default=60))
+# With write-behind, once INGEST_HIGH_WATER_MARK payloads are waiting in the ingest log, new ones are refused (429) and
+# the reporters are asked to come back after INGEST_RETRY_AFTER seconds.
+INGEST_HIGH_WATER_MARK = int(os.getenv("INGEST_HIGH_WATER_MARK", default=5000))
+INGEST_RETRY_AFTER = int(os.getenv("INGEST_RETRY_AFTER", default=10))
+# /save_data_stream writes the posts as they are received, in batches of INGEST_STREAM_BATCH_BYTES bytes of NDJSON (an
+# entry of the ingest log with write-behind, a bulk_index call without). Lines longer than INGEST_STREAM_MAX_LINE_BYTES
+# are refused (413).
+INGEST_STREAM_BATCH_BYTES = int(os.getenv("INGEST_STREAM_BATCH_BYTES", default=2 ** 20))
+INGEST_STREAM_MAX_LINE_BYTES = int(os.getenv("INGEST_STREAM_MAX_LINE_BYTES", default=2 ** 20))
+# Data of a body read as it is received (/save_data_stream) waiting to be read, above which the server stops receiving it
+# until it is read: a reporter can't send faster than the posts are written.
+INGEST_STREAM_BUFFER_BYTES = int(os.getenv("INGEST_STREAM_BUFFER_BYTES", default=2 ** 20))
+# A few KB of gzip or zstd can decompress to GB: bodies (except the ones of /save_data_stream, read as they are
+# received) larger than INGEST_MAX_BODY_BYTES once decompressed are refused (413).
+INGEST_MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", default=256 * 2 ** 20))
+
 # log = config_logging(level=log_level, format_log=log_formatting, datefmt=log_datefmt, filename="orchestrator.logs")
 
 
-class Orchestrator(Flask):
+class UnsupportedContentEncoding(Exception):
+    "Raised when the body of a request is compressed with an algorithm the server doesn't know"
+    pass
+
+
+class BoundedDecompressor:
+    """
+    Decompresses a body (Content-Encoding gzip or zstd) as it is received, in pieces of at most `piece_size` bytes, so
+    the output is never all in memory at once. RequestEntityTooLarge is raised as soon as the output goes past
+    `max_size` bytes (None: no limit).
+
+    A zstd decompression can't be stopped after a given output size: the input is decompressed by slices of
+    ZSTD_INPUT_SLICE bytes, and a slice decompressing to more than `max_slice_output` bytes is refused.
+    """
+    ZSTD_INPUT_SLICE = 4096
+
+    def __init__(self, encoding, max_size=None, piece_size=2 ** 16, max_slice_output=INGEST_STREAM_MAX_LINE_BYTES):
+        self.max_size = max_size
+        self.piece_size = piece_size
+        self.max_slice_output = max_slice_output
+        self.size = 0
+        self._zlib = None
+        self._zstd = None
+        if encoding == "gzip":
+            self._zlib = zlib.decompressobj(wbits=31)
+        elif encoding == "zstd":
+            # streamed by the reporter: the size of the content isn't in the frame header, a stream doesn't need it
+            self._zstd = zstandard.ZstdDecompressor().stream_writer(self, write_size=piece_size)
+        else:
+            raise UnsupportedContentEncoding(encoding)
+        # output of the zstd slice being decompressed
+        self._pieces = []
+        self._slice_output = 0
+
+    def decompress(self, data: bytes):
+        """Yields the decompressed pieces of `data`, the next part of the body."""
+        if self._zlib is not None:
+            while data:
+                piece = self._zlib.decompress(data, self.piece_size)
+                data = self._zlib.unconsumed_tail
+                self._count(len(piece))
+                if piece:
+                    yield piece
+            return
+        for start in range(0, len(data), self.ZSTD_INPUT_SLICE):
+            self._pieces = []
+            self._slice_output = 0
+            # calls write with the output
+            self._zstd.write(data[start:start + self.ZSTD_INPUT_SLICE])
+            yield from self._pieces
+
+    def write(self, piece) -> int:
+        self._slice_output += len(piece)
+        if self.max_slice_output is not None and self._slice_output > self.max_slice_output:
+            raise RequestEntityTooLarge(f"{self.ZSTD_INPUT_SLICE} bytes decompressing to more than "
+                                        f"{self.max_slice_output} bytes")
+        self._count(len(piece))
+        self._pieces.append(bytes(piece))
+        return len(piece)
+
+    def _count(self, size):
+        self.size += size
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge(f"Body larger than {self.max_size} bytes once decompressed")
+
+
+class StreamedBody(Body):
+    """
+    Body of a request that stops receiving data while INGEST_STREAM_BUFFER_BYTES bytes are waiting to be read, once the
+    handler started reading it piece by piece (async for). The bodies awaited whole are received as usual.
+    """
+
+    def __init__(self, expected_content_length, max_content_length):
+        super().__init__(expected_content_length, max_content_length)
+        self._streamed = False
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    def append(self, data: bytes):
+        super().append(data)
+        if len(self._data) >= INGEST_STREAM_BUFFER_BYTES:
+            self._drained.clear()
+
+    async def __anext__(self) -> bytes:
+        self._streamed = True
+        data = await super().__anext__()
+        self._drained.set()
+        return data
+
+    async def wait_drained(self):
+        if self._streamed:
+            await self._drained.wait()
+
+
+class StreamingRequest(Request):
+    body_class = StreamedBody
+
+
+class StreamingHTTPConnection(ASGIHTTPConnection):
+    async def handle_messages(self, request, receive):
+        while True:
+            # while the handler doesn't read the body, the messages wait in the queue of Hypercorn and once it is full
+            # Hypercorn stops reading the socket: the client waits too
+            await request.body.wait_drained()
+            message = await receive()
+            if message["type"] == "http.request":
+                request.body.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    request.body.set_complete()
+            elif message["type"] == "http.disconnect":
+                return
+
+
+class Orchestrator(Quart):
+    request_class = StreamingRequest
+    asgi_http_class = StreamingHTTPConnection
+
     def __init__(self, import_name, check_db_connection=True):
-        if check_db_connection is True:
+        super().__init__(import_name)
+        self.check_db_connection = check_db_connection
+        self.db_pool = None
+        self.queue_changed = asyncio.Event()
+        self.before_serving(self.open_db_pool)
+        self.after_serving(self.close_db_pool)
+
+    async def open_db_pool(self):
+        """
+        Runs once per worker process, before it accepts requests. The database drivers are blocking: every call is
+        sent to a thread of the default executor so the event loop keeps serving other requests in the meantime.
+        """
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=SERVER_THREADS,
+                                                                           thread_name_prefix="db"))
+        # clients are created once for the whole process, requests only borrow connections from their pools
+        loop = asyncio.get_running_loop()
+        self.db_pool = await asyncio.to_thread(DatabasePool,
+                                               on_queue_changed=lambda: loop.call_soon_threadsafe(
+                                                   self.notify_queue_changed))
+        if self.check_db_connection is True:
             # test DB access
-            try:
-                assert ElasticInteractor(elastic_host=ELASTIC_HOST,
-                                         elastic_port=ELASTIC_PORT,
-                                         elastic_username=ELASTIC_USERNAME,
-                                         elastic_password=ELASTIC_PASSWORD,
-                                         http_cert_path=ELASTIC_HTTP_CERT_PATH).check_connection()
+            state = await asyncio.to_thread(self.db_pool.check_health)
+            if state["elastic"] is True:
                 log.info("Test connection to ElasticSearch successful!")
-            except AssertionError:
+            else:
                 log.error("Cannot connect to Elastic database! Quitting!")
-        super().__init__(import_name)
+        self.db_pool.start()
+
+    async def close_db_pool(self):
+        if self.db_pool is not None:
+            await asyncio.to_thread(self.db_pool.close)
+
+    def notify_queue_changed(self):
+        """Wakes up the /next requests of this worker waiting for channels to be added to the queue."""
+        self.queue_changed.set()
+        self.queue_changed = asyncio.Event()
+
+    async def lease_channels(self, n, spider_id, wait) -> list[dict]:
+        """
+        Leases up to n channels. If none is available, waits until channels are added to the queue, for `wait` seconds
+        at most. Channels added through another worker or orchestrator are found by retrying every
+        QUEUE_REFRESH_INTERVAL seconds (the scheduler then reloads the `to_crawl` channels).
+        :return: list of leases, empty if nothing is to be crawled.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        db = self.get_elastic_db()
+        while True:
+            # taken before looking at the queue, so a notification arriving in the meantime isn't missed
+            queue_changed = self.queue_changed
+            try:
+                return await asyncio.to_thread(db.get_next_channels_to_be_crawled, n=n, spider_id=spider_id)
+            except EmptyQueueException:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return []
+            try:
+                await asyncio.wait_for(queue_changed.wait(), timeout=min(remaining, QUEUE_REFRESH_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
 
     @staticmethod
-    def get_elastic_db():
-        if "elastic_db" not in g:
-            g.elastic_db = ElasticInteractor(elastic_host=ELASTIC_HOST,
-                                             elastic_port=ELASTIC_PORT,
-                                             elastic_username=ELASTIC_USERNAME,
-                                             elastic_password=ELASTIC_PASSWORD,
-                                             http_cert_path=ELASTIC_HTTP_CERT_PATH)
-        return g.elastic_db
+    async def get_body() -> bytes:
+        """
+        Body of the request, decompressed if the reporter compressed it (Content-Encoding: gzip or zstd). Refused (413)
+        above INGEST_MAX_BODY_BYTES bytes once decompressed.
+        """
+        body = await request.get_data()
+        encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+        if encoding == "identity":
+            return body
+        decompressor = BoundedDecompressor(encoding, max_size=INGEST_MAX_BODY_BYTES, max_slice_output=None)
+        return await asyncio.to_thread(lambda: b"".join(decompressor.decompress(body)))
 
     @staticmethod
-    def get_neo4j_db():
-        if "neo4j_db" not in g:
-            g.neo4j_db = GraphDB(uri=NEO4J_URI, auth=NEO4J_AUTH)
-        return g.neo4j_db
+    def check_payload(kind, body: bytes):
+        """
+        Decodes the body of a /save_data (IngestLog.POSTS) or /save_data_xposted (IngestLog.XPOSTED) request. Refused
+        (400) if it isn't a payload the databases can be given, see ingestlog.decode_payload.
+        """
+        try:
+            return decode_payload(kind=kind, payload=body)
+        except ValueError as err:
+            raise BadRequest(f"Not a valid {kind} payload: {err}")
+
+    async def get_payload(self, kind):
+        return await asyncio.to_thread(self.check_payload, kind, await self.get_body())
 
-    def teardown_appcontext(self, f):
-        db = g.pop('elastic_db', None)
-        if db is not None:
-            db.close()
+    @staticmethod
+    async def iter_body_lines():
+        """
+        Yields the lines of the body of the request as it is received, decompressed on the fly (Content-Encoding: gzip
+        or zstd, see BoundedDecompressor). Only the line being received is kept in memory.
+        """
+        encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+        decompressor = BoundedDecompressor(encoding) if encoding != "identity" else None
+        buffer = bytearray()
+        async for data in request.body:
+            for piece in decompressor.decompress(data) if decompressor is not None else (data,):
+                buffer += piece
+                end = buffer.rfind(b"\n")
+                if end >= 0:
+                    for line in bytes(buffer[:end]).split(b"\n"):
+                        if line.strip():
+                            yield line
+                    del buffer[:end + 1]
+                if len(buffer) > INGEST_STREAM_MAX_LINE_BYTES:
+                    raise RequestEntityTooLarge(f"Line longer than {INGEST_STREAM_MAX_LINE_BYTES} bytes")
+        if bytes(buffer).strip():
+            yield bytes(buffer)
+
+    async def ingest_stream(self):
+        """
+        Posts sent as NDJSON, one {chan_id: {post_id: post}} object per line. Every line is decoded as it is received,
+        the posts are written in batches of INGEST_STREAM_BATCH_BYTES bytes while the next batch is received: the
+        memory used doesn't depend on the size of the body.
+
+        With write-behind, the batches are staged in the ingest log and published together once the whole body was
+        received and checked (see IngestLog.stage). The body is then ingested once per Idempotency-Key, like with
+        write_behind. Without, the posts are indexed batch by batch: a body that fails midway is partly indexed,
+        sending it again indexes the same posts under the same IDs.
+        """
+        ingest_log = self.db_pool.ingest_log
+        if ingest_log is not None:
+            depth = await asyncio.to_thread(ingest_log.depth)
+            if depth >= INGEST_HIGH_WATER_MARK:
+                log.warning(f"Ingest log full ({depth} payloads waiting), refusing data from {request.remote_addr}")
+                return jsonify(success=False, depth=depth), 429, {"Retry-After": str(INGEST_RETRY_AFTER)}
+        key = request.headers.get("Idempotency-Key")
+        owner = f"stream:{uuid.uuid4().hex}"
+        staged = []
+
+        def write(lines: list, payloads: list):
+            if ingest_log is not None:
+                staged.append(ingest_log.stage(kind=IngestLog.POSTS_NDJSON, payload=b"\n".join(lines), owner=owner))
+            else:
+                self.get_elastic_db().save_data_batch(payloads=payloads)
+
+        nb_posts = 0
+        lines, payloads, batch_bytes = [], [], 0
+        writing = None
+        try:
+            async for line in self.iter_body_lines():
+                try:
+                    payload = json.loads(line)
+                except ValueError as err:
+                    raise BadRequest(f"Line {nb_posts + 1} isn't valid JSON: {err}")
+                try:
+                    validate_posts_payload(payload)
+                except ValueError as err:
+                    raise BadRequest(f"Line {nb_posts + 1} isn't a valid payload: {err}")
+                nb_posts += 1
+                lines.append(line)
+                if ingest_log is None:
+                    payloads.append(payload)
+                batch_bytes += len(line)
+                if batch_bytes >= INGEST_STREAM_BATCH_BYTES:
+                    # a single batch written at a time: the body isn't read faster than the posts are written
+                    if writing is not None:
+                        await writing
+                    writing = asyncio.ensure_future(asyncio.to_thread(write, lines, payloads))
+                    lines, payloads, batch_bytes = [], [], 0
+            if writing is not None:
+                await writing
+                writing = None
+            if lines:
+                await asyncio.to_thread(write, lines, payloads)
+            if ingest_log is not None and not await asyncio.to_thread(ingest_log.publish, owner=owner,
+                                                                      entry_ids=staged, key=key):
+                log.info(f"Payload {key} from {request.remote_addr} already received, not appended again")
+                return jsonify(success=True, duplicate=True), 200
+        except BaseException:
+            if writing is not None:
+                await asyncio.gather(writing, return_exceptions=True)
+            if staged:
+                # the entries of an incomplete body are removed, the reporter sends it again
+                await asyncio.to_thread(ingest_log.ack, owner=owner, entry_ids=staged)
+            raise
+        log.info(f"{nb_posts} posts received from {request.remote_addr}")
+        return jsonify(success=True, posts=nb_posts), 202 if ingest_log is not None else 200
+
+    async def write_behind(self, kind):
+        """
+        Appends the body of the request to the ingest log and acknowledges it, the drainer of the DatabasePool writes
+        it to the databases later. Refused (429 with a Retry-After header) above INGEST_HIGH_WATER_MARK waiting
+        payloads.
+
+        A body sent with an Idempotency-Key header is appended once: sent again with the same key, it is acknowledged
+        (200, duplicate=true) without being appended. A body that isn't a valid payload is refused (400) instead of
+        being left to the drainer.
+        """
+        ingest_log = self.db_pool.ingest_log
+        depth = await asyncio.to_thread(ingest_log.depth)
+        if depth >= INGEST_HIGH_WATER_MARK:
+            log.warning(f"Ingest log full ({depth} payloads waiting), refusing data from {request.remote_addr}")
+            return jsonify(success=False, depth=depth), 429, {"Retry-After": str(INGEST_RETRY_AFTER)}
+        payload = await self.get_body()
+        await asyncio.to_thread(self.check_payload, kind, payload)
+        key = request.headers.get("Idempotency-Key")
+        entry_id = await asyncio.to_thread(ingest_log.append, kind=kind, payload=payload, key=key)
+        if entry_id is None:
+            log.info(f"Payload {key} from {request.remote_addr} already received, not appended again")
+            return jsonify(success=True, duplicate=True), 200
+        return jsonify(success=True), 202
+
+    def get_elastic_db(self):
+        return self.db_pool.elastic_db
+
+    def get_neo4j_db(self):
+        return self.db_pool.neo4j_db
 
 
 app = Orchestrator(import_name="orchestrator")
 
 
+@app.errorhandler(UnsupportedContentEncoding)
+async def unsupported_content_encoding(err):
+    log.error(f"{request.remote_addr} sent a body encoded with {err}, not supported")
+    return jsonify(success=False, error=f"Unsupported Content-Encoding: {err}"), 415
+
+
 @app.route("/")
-def hello_world():
+async def hello_world():
     return "I'm orchestratin in here!!!"
 
 
 @app.route("/next", methods=['GET'])
-def get_next():
-    log.info(f"{request.remote_addr} - Asked for next channel")
+async def get_next():
+    """
+    Without parameters, returns the ID of the next channel to crawl or the wait flag.
+
+    Query parameters:
+        - spider_id: ID of the spider asking, holder of the lease.
+        - n: leases up to n channels, the response becomes a list:
+          [{"chan_id": int, "lease_expires": int, "max_msg_id": int}, ...], max_msg_id being the highest message ID of
+          the channel already ingested (0 if none): only the messages after it need to be crawled.
+        - wait: long polling, if nothing is to be crawled waits up to `wait` seconds (capped at LONG_POLL_MAX_WAIT) for
+          channels to be added before answering.
+    """
+    spider_id = request.args.get("spider_id")
+    nb_channels = request.args.get("n")
+    if nb_channels is not None:
+        try:
+            nb_channels = int(nb_channels)
+        except ValueError:
+            nb_channels = 0
+        if nb_channels <= 0:
+            return jsonify(success=False, error="n must be a positive integer"), 400
+    wait = min(request.args.get("wait", default=0, type=float), LONG_POLL_MAX_WAIT)
+    log.info(f"{request.remote_addr} ({spider_id}) - Asked for next channel (n={nb_channels}, wait={wait})")
     try:
-        db = app.get_elastic_db()
-        chan_id = db.get_next_channel_to_be_crawled()
-        log.info(f"{str(chan_id)} removed from queue sent to {request.remote_addr}")
-        return jsonify(chan_id)
-    except EmptyQueueException:
-        return str(WAIT_FLAG)
+        leases = await app.lease_channels(n=nb_channels if nb_channels is not None else 1, spider_id=spider_id,
+                                          wait=wait)
     except Exception as e:
         log.error(f"Cannot supply next in queue because: {e}")
-        return
+        return jsonify(success=False), 500
+
+    log.info(f"{[lease['chan_id'] for lease in leases]} removed from queue sent to {request.remote_addr}")
+    if nb_channels is not None:
+        return jsonify(leases)
+    if not leases:
+        return str(WAIT_FLAG)
+    return jsonify(leases[0]["chan_id"])
+
+
+@app.route("/stats", methods=['GET'])
+async def stats():
+    """
+    Scheduler, seen channels filter and bulk indexing counters of the worker process answering, and depth of the ingest
+    log (shared by the workers).
+    """
+    db = app.get_elastic_db()
+    ingest_log = app.db_pool.ingest_log
+    ingest = await asyncio.to_thread(ingest_log.stats) if ingest_log is not None else None
+    return jsonify(queue=db.scheduler.count_by_status(), seen_channels=db.seen_channels.stats(),
+                   bulk=db.bulk_stats, ingest=ingest)
+
+
+@app.route("/heartbeat", methods=['POST'])
+async def heartbeat():
+    """Renews the leases of the channels a spider is crawling. Body: {"spider_id": str, "chan_ids": [int]}"""
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(success=False, error="body must be a JSON object"), 400
+    spider_id = data.get("spider_id")
+    chan_ids = data.get("chan_ids")
+    if not isinstance(spider_id, str):
+        return jsonify(success=False, error="spider_id must be a string"), 400
+    if not isinstance(chan_ids, list) or not all(isinstance(chan_id, int) and not isinstance(chan_id, bool)
+                                                 for chan_id in chan_ids):
+        return jsonify(success=False, error="chan_ids must be a list of integers"), 400
+    log.debug(f"Heartbeat from {request.remote_addr} ({spider_id}) for {chan_ids}")
+    db = app.get_elastic_db()
+    result = await asyncio.to_thread(db.renew_leases, chan_ids=chan_ids, spider_id=spider_id)
+    return jsonify(result)
 
 
 @app.route("/save_data", methods=['POST'])
-def save_data():
+async def save_data():
     log.info(f"Saving posts from {request.remote_addr}")
-    data = request.json
+    if app.db_pool.ingest_log is not None:
+        return await app.write_behind(kind=IngestLog.POSTS)
+    data = await app.get_payload(kind=IngestLog.POSTS)
     db = app.get_elastic_db()
     for channel_id, posts in data.items():
-        db.save_data(channel_id=int(channel_id), posts=posts)
+        await asyncio.to_thread(db.save_data, channel_id=int(channel_id), posts=posts)
     return jsonify(success=True)
 
 
+@app.route("/save_data_stream", methods=['POST'])
+async def save_data_stream():
+    """
+    Same as /save_data, with the body sent as NDJSON (application/x-ndjson, usually with chunked transfer encoding): a
+    {chan_id: {post_id: post}} object per line, a post per line for the reporters. See Orchestrator.ingest_stream.
+    """
+    log.info(f"Saving streamed posts from {request.remote_addr}")
+    return await app.ingest_stream()
+
+
 @app.route("/save_data_xposted", methods=['POST'])
-def save_data_xposted():
+async def save_data_xposted():
     log.info(f"Saving xposted data from {request.remote_addr}")
-    data = request.json
+    if app.db_pool.ingest_log is not None:
+        return await app.write_behind(kind=IngestLog.XPOSTED)
+    data = await app.get_payload(kind=IngestLog.XPOSTED)
     channel_info = data["channel_info"]
     fwd_chan_list = data["fwd_chan_dict"]
 
     edb = app.get_elastic_db()
-    edb.save_data_xposted(channel_info=channel_info, fwd_chan_list=fwd_chan_list)
+    await asyncio.to_thread(edb.save_data_xposted, channel_info=channel_info, fwd_chan_list=fwd_chan_list)
 
     gdb = app.get_neo4j_db()
-    gdb.add_channel_info_and_fwd_channels(channel_info=channel_info, fwd_chan_list=fwd_chan_list)
+    await asyncio.to_thread(gdb.add_channel_info_and_fwd_channels, channel_info=channel_info,
+                            fwd_chan_list=fwd_chan_list, linked_chan_list=data.get("linked_chan_dict", []))
+    app.notify_queue_changed()
 
     return jsonify(success=True)
 
 
 if __name__ == '__main__':
     log.info("==================== SERVER STARTED ====================")
-    app.run(host=SERVER_HOST, port=SERVER_PORT, debug=True)
+    if SERVER_DEV_MODE is True:
+        # single process with the reloader, only meant for development
+        app.run(host=SERVER_HOST, port=SERVER_PORT, debug=True)
+    else:
+        log.info(f"Serving with {SERVER_WORKERS} worker processes")
+        config = Config()
+        config.application_path = "server:app"
+        config.bind = [f"{SERVER_HOST}:{SERVER_PORT}"]
+        config.workers = SERVER_WORKERS
+        config.loglevel = logging.getLevelName(log_level)
+        hypercorn_run(config)
@@ -1,13 +1,26 @@
 import os
 import sys
+import gzip
+import json
 import time
+import tempfile
+import threading
 import unittest
+import unittest.mock
 from unittest.mock import MagicMock
 import datetime
 import elasticsearch
+import neo4j.exceptions
+import zstandard
+from werkzeug.exceptions import RequestEntityTooLarge
 
-from esinter import (ElasticInteractor, EmptyQueueException, ELASTIC_HOST, ELASTIC_PORT, ELASTIC_PASSWORD,
-                     ELASTIC_USERNAME, ELASTIC_HTTP_CERT_PATH, SERVER_PORT, SERVER_HOST, WAIT_FLAG)
+from esinter import (BaseElasticInteractor, ElasticInteractor, EmptyQueueException, ELASTIC_HOST, ELASTIC_PORT,
+                     ELASTIC_PASSWORD, ELASTIC_USERNAME, ELASTIC_HTTP_CERT_PATH, SERVER_PORT, SERVER_HOST, WAIT_FLAG,
+                     ChannelStatus, BULK_THREADS)
+from scheduler import QueueScheduler
+from server import BoundedDecompressor, app
+from dbpool import DatabasePool
+from ingestlog import IngestLog
 
 TEST_POST_INDEX = "test_post_index"
 TEST_QUEUE_INDEX = "test_queue_index"
@@ -95,5 +108,376 @@ class TestOrchestrator(unittest.TestCase):
         self.assertEqual(total_chan_in_queue, 0)
 
 
+    def test_SameChannelInfoSavedTwiceIsCountedOnce(self):
+        channel_info = {"chan_id": 1214265894, "title": "SavedTwice", "username": "SavedTwice", "verified": True,
+                        "nb_participants": 2626, "min_msg_id": 1, "max_msg_id": 1000}
+        fwd_chan_list = [{"chan_username": "Forwarded", "chan_id": 42, "nb_of_forwards": 50}]
+        resp = self.es_client._save_channel_info(channel_id=1214265894, channel_info=channel_info,
+                                                 fwd_chan_list=fwd_chan_list)
+        self.assertEqual(resp['result'], "created")
+        saved = self.es_client.client.get(index=TEST_CHANNEL_INDEX, id=1214265894)['_source']
+
+        resp = self.es_client._save_channel_info(channel_id=1214265894, channel_info=channel_info,
+                                                 fwd_chan_list=fwd_chan_list)
+        self.assertEqual(resp['result'], "noop")
+        self.assertEqual(self.es_client.client.get(index=TEST_CHANNEL_INDEX, id=1214265894)['_source'], saved)
+
+        # incremental crawl overlapping the first one: only the forwards of its new messages are added
+        resp = self.es_client._save_channel_info(channel_id=1214265894,
+                                                 channel_info={**channel_info, "min_msg_id": 901, "max_msg_id": 1200},
+                                                 fwd_chan_list=[{**fwd_chan_list[0], "nb_of_forwards": 30}])
+        self.assertEqual(resp['result'], "updated")
+        saved = self.es_client.client.get(index=TEST_CHANNEL_INDEX, id=1214265894)['_source']
+        self.assertEqual(saved['x_posted_channels'], [{"username": "Forwarded", "xposts": 70}])
+        self.assertEqual((saved['min_msg_id'], saved['max_msg_id']), (1, 1200))
+
+
+    def test_XpostedSavedTwiceAddsPriorityOnce(self):
+        self.es_client._change_channel_crawling_status_to_crawled = MagicMock()
+        channel_info = {"chan_id": 123456789, "title": "AnotherChannel", "username": "AnotherChannel",
+                        "verified": True, "nb_participants": 2626, "min_msg_id": 1, "max_msg_id": 1000}
+        fwd_chan_list = [{"chan_username": "Forwarded", "chan_id": 42, "nb_of_forwards": 11}]
+        for _ in range(2):
+            # processed again: the drainer failed after saving it
+            self.es_client.save_data_xposted(channel_info=dict(channel_info), fwd_chan_list=fwd_chan_list)
+        self.assertEqual(self.es_client.client.get(index=TEST_QUEUE_INDEX, id=42)['_source']['priority'], 11)
+
+
+class TestQueueScheduler(unittest.TestCase):
+
+    @staticmethod
+    def queue_doc(chan_id, priority=1, status=ChannelStatus.to_crawl, time_added=0, time_crawling_started=0):
+        return {"priority": priority,
+                "status": status,
+                "time_added": time_added,
+                "time_crawling_started": time_crawling_started,
+                "username": f"chan_{chan_id}",
+                "chan_id": chan_id}
+
+    def test_HighestPriorityFirstThenOldestCrawled(self):
+        scheduler = QueueScheduler()
+        scheduler.replace_all([self.queue_doc(1, priority=5),
+                               self.queue_doc(2, priority=50),
+                               self.queue_doc(3, status=ChannelStatus.crawled, time_crawling_started=200),
+                               self.queue_doc(4, status=ChannelStatus.crawled, time_crawling_started=100),
+                               self.queue_doc(5, status=ChannelStatus.being_crawled)])
+
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=10, now=1000)["chan_id"], 2)
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=10, now=1000)["chan_id"], 1)
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=10, now=1000)["chan_id"], 4)
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=10, now=1000)["chan_id"], 3)
+        self.assertIsNone(scheduler.pop_next(min_crawl_interval=10, now=1000))
+        self.assertEqual(scheduler.count_by_status()[ChannelStatus.being_crawled], 5)
+
+    def test_CrawledChannelRespectsMinCrawlInterval(self):
+        scheduler = QueueScheduler()
+        scheduler.upsert(1, self.queue_doc(1, status=ChannelStatus.crawled, time_crawling_started=100))
+        self.assertIsNone(scheduler.pop_next(min_crawl_interval=1000, now=500))
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=1000, now=1100)["chan_id"], 1)
+
+    def test_UpdatedPriorityIsUsed(self):
+        scheduler = QueueScheduler()
+        scheduler.upsert(1, self.queue_doc(1, priority=10))
+        scheduler.upsert(2, self.queue_doc(2, priority=20))
+        scheduler.update(1, priority=30)
+        scheduler.remove(2)
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=0, now=0)["chan_id"], 1)
+        self.assertIsNone(scheduler.pop_next(min_crawl_interval=0, now=0))
+        self.assertEqual(len(scheduler), 1)
+
+    def test_ChangesDuringRebuildAreKept(self):
+        scheduler = QueueScheduler()
+        scheduler.upsert(1, self.queue_doc(1, priority=10))
+        scheduler.upsert(3, self.queue_doc(3, priority=1))
+
+        def documents():
+            yield self.queue_doc(1, priority=10)
+            # requests served while the queue index is read
+            scheduler.upsert(2, self.queue_doc(2, priority=50))
+            scheduler.update(1, priority=5)
+            scheduler.remove(3)
+            yield self.queue_doc(3, priority=1)
+
+        scheduler.replace_all(documents())
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=0, now=0)["chan_id"], 2)
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=0, now=0)["priority"], 5)
+        self.assertIsNone(scheduler.pop_next(min_crawl_interval=0, now=0))
+        self.assertEqual(len(scheduler), 2)
+
+    def test_RefreshKeepsChangesMadeSinceSnapshot(self):
+        scheduler = QueueScheduler()
+        scheduler.upsert(1, self.queue_doc(1, priority=10))
+        scheduler.upsert(2, self.queue_doc(2, priority=10))
+        since = scheduler.snapshot()
+        # requests served while the queue index is read: 1 picked, 2 updated
+        self.assertEqual(scheduler.pop_next(min_crawl_interval=0, now=0)["chan_id"], 1)
+        scheduler.update(2, priority=30)
+        self.assertEqual(scheduler.refresh([self.queue_doc(chan_id, priority=10) for chan_id in (1, 2, 3)],
+                                           since=since), 1)
+        self.assertEqual(scheduler.get(1)["status"], ChannelStatus.being_crawled)
+        self.assertEqual(scheduler.get(2)["priority"], 30)
+        self.assertEqual(scheduler.get(3)["priority"], 10)
+
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        # no request reaches Elasticsearch: the client is replaced in each test
+        self.es_client = BaseElasticInteractor(elastic_host="localhost", elastic_port=9200, elastic_username="",
+                                               elastic_password="", http_cert_path=None)
+        self.es_client.client = MagicMock()
+        self.es_client._last_scheduler_refresh = int(time.time())
+        self.es_client.scheduler.upsert(1, TestQueueScheduler.queue_doc(1))
+
+    def test_FailedClaimPutsCandidatesBack(self):
+        self.es_client.client.mget.side_effect = elasticsearch.ConnectionError("unreachable")
+        with self.assertRaises(elasticsearch.ConnectionError):
+            self.es_client.get_next_channels_to_be_crawled(n=1)
+        self.assertEqual(self.es_client.scheduler.count_by_status()[ChannelStatus.to_crawl], 1)
+        self.assertEqual(self.es_client.scheduler.pop_next(min_crawl_interval=0, now=0)["chan_id"], 1)
+
+    def test_RefreshDuringPopDoesntPickChannelsTwice(self):
+        # the queue index still has 1 `to_crawl`: its claim isn't written yet
+        self.es_client.client.search.return_value = {"hits": {"hits": [
+            {"_source": TestQueueScheduler.queue_doc(chan_id), "sort": [chan_id]} for chan_id in (1, 2)]}}
+        self.es_client._last_scheduler_refresh = 0
+        with unittest.mock.patch("esinter.MIN_CRAWL_INTERVAL", 0):
+            candidates = self.es_client._pop_candidates(n=3, now=int(time.time()))
+        self.assertEqual([document["chan_id"] for document in candidates], [1, 2])
+        self.assertEqual(self.es_client.scheduler.count_by_status()[ChannelStatus.being_crawled], 2)
+
+
+class TestBulkIndex(unittest.TestCase):
+
+    def test_ActionsReadAsChunksAreSent(self):
+        es_client = BaseElasticInteractor(elastic_host="localhost", elastic_port=9200, elastic_username="",
+                                          elastic_password="", http_cert_path=None)
+        unblock = threading.Event()
+
+        def bulk(operations):
+            unblock.wait()
+            return {"items": [{"index": {"status": 201}}] * operations.count(b'{"index"')}
+        es_client.client = MagicMock()
+        es_client.client.bulk.side_effect = bulk
+
+        nb_read = 0
+
+        def actions():
+            nonlocal nb_read
+            for i in range(1000):
+                nb_read += 1
+                yield {"_index": TEST_POST_INDEX, "_id": str(i), "_source": {"text": "a"}}
+
+        # one document per chunk
+        with unittest.mock.patch("esinter.BULK_MAX_BYTES", 1):
+            indexed = []
+            indexing = threading.Thread(target=lambda: indexed.append(es_client.bulk_index(actions())))
+            indexing.start()
+            time.sleep(0.5)
+            # the chunks in flight, the one waiting for a slot and the document read to close it
+            self.assertLessEqual(nb_read, 2 * BULK_THREADS + 2)
+            unblock.set()
+            indexing.join()
+        self.assertEqual(indexed, [1000])
+
+
+class TestBoundedDecompressor(unittest.TestCase):
+
+    BODY = b"".join(b'{"1": {"%d": {"text": "post"}}}\n' % i for i in range(10000))
+
+    def test_DecompressedPieceByPiece(self):
+        for encoding, compressed in (("gzip", gzip.compress(self.BODY)),
+                                     ("zstd", zstandard.ZstdCompressor().compress(self.BODY))):
+            decompressor = BoundedDecompressor(encoding, max_size=len(self.BODY), piece_size=4096)
+            # received in several parts
+            pieces = [piece for start in range(0, len(compressed), 1000)
+                      for piece in decompressor.decompress(compressed[start:start + 1000])]
+            self.assertEqual(b"".join(pieces), self.BODY)
+            self.assertLessEqual(max(len(piece) for piece in pieces), 4096)
+
+    def test_DecompressionBombRefused(self):
+        bomb = bytes(2 ** 30)
+        for encoding, compressed in (("gzip", gzip.compress(bomb[:2 ** 27])),
+                                     ("zstd", zstandard.ZstdCompressor().compress(bomb))):
+            decompressor = BoundedDecompressor(encoding, max_size=2 ** 20, max_slice_output=None)
+            with self.assertRaises(RequestEntityTooLarge):
+                for _ in decompressor.decompress(compressed):
+                    pass
+            self.assertLessEqual(decompressor.size, 2 ** 20 + 2 ** 16)
+        # no limit on the whole body: each slice of the input is
+        with self.assertRaises(RequestEntityTooLarge):
+            list(BoundedDecompressor("zstd", max_slice_output=2 ** 20).decompress(compressed))
+
+
+class TestIngestLog(unittest.TestCase):
+
+    def test_PayloadWithSameKeyAppendedOnce(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ingest_log = IngestLog(path=os.path.join(folder, "ingest_log.sqlite3"), claim_timeout=600, key_ttl=3600)
+            self.assertIsNotNone(ingest_log.append(kind=IngestLog.POSTS, payload=b"{}", key="a"))
+            self.assertIsNone(ingest_log.append(kind=IngestLog.POSTS, payload=b"{}", key="a"))
+            self.assertIsNotNone(ingest_log.append(kind=IngestLog.XPOSTED, payload=b"{}", key="b"))
+            # without key: always appended
+            self.assertIsNotNone(ingest_log.append(kind=IngestLog.POSTS, payload=b"{}"))
+            self.assertIsNotNone(ingest_log.append(kind=IngestLog.POSTS, payload=b"{}"))
+            self.assertEqual(ingest_log.depth(), 4)
+
+            # drained, the key is still remembered
+            entries = ingest_log.claim(owner="test", limit=10)
+            ingest_log.ack(owner="test", entry_ids=[entry_id for entry_id, _, _ in entries])
+            self.assertIsNone(ingest_log.append(kind=IngestLog.POSTS, payload=b"{}", key="a"))
+
+            ingest_log.key_ttl = -1
+            self.assertEqual(ingest_log.expire_keys(), 2)
+            self.assertIsNotNone(ingest_log.append(kind=IngestLog.POSTS, payload=b"{}", key="a"))
+
+    def test_XpostedWaitsForOlderPostsOfOtherDrainers(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ingest_log = IngestLog(path=os.path.join(folder, "ingest_log.sqlite3"), claim_timeout=600, key_ttl=3600)
+            posts = ingest_log.append(kind=IngestLog.POSTS, payload=b"{}")
+            xposted = ingest_log.append(kind=IngestLog.XPOSTED, payload=b"{}")
+            # the posts are claimed by another drainer, but not the channel info
+            self.assertEqual(len(ingest_log.claim(owner="drainer-1", limit=1)), 1)
+            later_posts = ingest_log.append(kind=IngestLog.POSTS, payload=b"{}")
+            self.assertEqual([entry_id for entry_id, _, _ in ingest_log.claim(owner="drainer-2", limit=10)],
+                             [later_posts])
+            # posts written: the channel info can be drained
+            ingest_log.ack(owner="drainer-1", entry_ids=[posts])
+            self.assertEqual([entry_id for entry_id, _, _ in ingest_log.claim(owner="drainer-1", limit=10)],
+                             [xposted])
+
+    def test_StagedEntriesDrainedOncePublished(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ingest_log = IngestLog(path=os.path.join(folder, "ingest_log.sqlite3"), claim_timeout=600, key_ttl=3600)
+            staged = [ingest_log.stage(kind=IngestLog.POSTS_NDJSON, payload=b'{"1": {"2": {}}}', owner="stream")
+                      for _ in range(3)]
+            self.assertEqual(ingest_log.claim(owner="drainer", limit=10), [])
+            self.assertTrue(ingest_log.publish(owner="stream", entry_ids=staged, key="a"))
+            # at most max_bytes bytes of payloads, at least one entry
+            self.assertEqual(len(ingest_log.claim(owner="drainer", limit=10, max_bytes=1)), 1)
+            self.assertEqual(len(ingest_log.claim(owner="drainer", limit=10)), 2)
+
+            # the same body streamed again: its entries are removed
+            staged = [ingest_log.stage(kind=IngestLog.POSTS_NDJSON, payload=b'{"1": {"2": {}}}', owner="stream")]
+            self.assertFalse(ingest_log.publish(owner="stream", entry_ids=staged, key="a"))
+            self.assertEqual(ingest_log.depth(), 3)
+
+
+
+class TestIngestDrain(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        # no request reaches the databases: their clients are mocks
+        with unittest.mock.patch("dbpool.ElasticInteractor"), unittest.mock.patch("dbpool.GraphDB"), \
+                unittest.mock.patch("dbpool.INGEST_LOG_PATH", os.path.join(self.folder.name, "ingest_log.sqlite3")):
+            self.db_pool = DatabasePool(write_behind=True)
+        self.ingest_log = self.db_pool.ingest_log
+        self.indexed = []
+        self.db_pool.elastic_db.save_data_batch.side_effect = lambda payloads: self.indexed.extend(payloads)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    @staticmethod
+    def channel_info(chan_id) -> bytes:
+        return json.dumps({"channel_info": {"chan_id": chan_id, "title": "title", "username": f"chan_{chan_id}",
+                                            "verified": False, "nb_participants": 1},
+                           "fwd_chan_dict": [], "linked_chan_dict": []}).encode()
+
+    def test_InvalidEntriesMovedToDeadLetters(self):
+        self.ingest_log.append(kind=IngestLog.POSTS, payload=b'{"notanid": {"1": {}}}')
+        self.ingest_log.append(kind=IngestLog.POSTS, payload=b'{"1": {"1": {}}}')
+        self.ingest_log.append(kind=IngestLog.XPOSTED, payload=b'{"channel_info": {"chan_id": 2}}')
+        self.ingest_log.append(kind=IngestLog.XPOSTED, payload=self.channel_info(1))
+        self.assertEqual(self.db_pool.drain_ingest_log(), 2)
+        self.assertEqual(self.ingest_log.depth(), 0)
+        self.assertEqual(self.indexed, [{"1": {"1": {}}}])
+        self.assertEqual([kind for _, kind, _, _, _ in self.ingest_log.dead_letters()],
+                         [IngestLog.POSTS, IngestLog.XPOSTED])
+
+    def test_RefusedEntryDoesntBlockTheOthers(self):
+        def add_channels(channels):
+            if any(channel_info["chan_id"] == 2 for channel_info, _, _ in channels):
+                raise neo4j.exceptions.ConstraintError("refused")
+        self.db_pool.neo4j_db.add_channels_info_and_fwd_channels.side_effect = add_channels
+        self.ingest_log.append(kind=IngestLog.XPOSTED, payload=self.channel_info(2))
+        self.ingest_log.append(kind=IngestLog.POSTS, payload=b'{"1": {"1": {}}}')
+        self.ingest_log.append(kind=IngestLog.XPOSTED, payload=self.channel_info(1))
+        with unittest.mock.patch("dbpool.INGEST_MAX_ATTEMPTS", 2):
+            self.assertEqual(self.db_pool.drain_ingest_log(), 2)
+            # given back, one attempt counted
+            self.assertEqual(self.ingest_log.depth(), 1)
+            self.assertEqual(self.ingest_log.dead_letters(), [])
+            self.assertEqual(self.db_pool.drain_ingest_log(), 0)
+        self.assertEqual(self.ingest_log.depth(), 0)
+        self.assertEqual([(json.loads(payload)["channel_info"]["chan_id"], attempts)
+                          for _, _, payload, attempts, _ in self.ingest_log.dead_letters()], [(2, 2)])
+        self.assertEqual(self.indexed, [{"1": {"1": {}}}])
+
+    def test_UnreachableDatabaseCountsNoAttempt(self):
+        self.db_pool.neo4j_db.add_channels_info_and_fwd_channels.side_effect = neo4j.exceptions.ServiceUnavailable()
+        self.ingest_log.append(kind=IngestLog.XPOSTED, payload=self.channel_info(1))
+        with unittest.mock.patch("dbpool.INGEST_MAX_ATTEMPTS", 1):
+            for _ in range(3):
+                with self.assertRaises(neo4j.exceptions.ServiceUnavailable):
+                    self.db_pool.drain_ingest_log()
+        self.assertEqual(self.ingest_log.depth(), 1)
+        self.assertEqual(self.ingest_log.dead_letters(), [])
+
+        # the database is back
+        self.db_pool.neo4j_db.add_channels_info_and_fwd_channels.side_effect = None
+        self.assertEqual(self.db_pool.drain_ingest_log(), 1)
+        self.assertEqual(self.ingest_log.depth(), 0)
+
+
+
+class TestIngestRequests(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        # requests are served without the databases: only the ingest log is real
+        app.db_pool = MagicMock()
+        app.db_pool.ingest_log = IngestLog(path=os.path.join(self.folder.name, "ingest_log.sqlite3"),
+                                           claim_timeout=600, key_ttl=3600)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.db_pool = None
+        self.folder.cleanup()
+
+    async def test_InvalidPayloadsRefused(self):
+        for route, body in (("/save_data", b'{"notanid": {"1": {}}}'),
+                            ("/save_data", b'{"1": [1, 2]}'),
+                            ("/save_data", b"not json"),
+                            ("/save_data_xposted", b'{"channel_info": {"chan_id": 1}}'),
+                            ("/save_data_xposted", TestIngestDrain.channel_info("notanid")),
+                            ("/save_data_stream", b'{"1": {"1": {}}}\n{"notanid": {"1": {}}}\n')):
+            response = await self.client.post(route, data=body)
+            self.assertEqual(response.status_code, 400, (route, body))
+        self.assertEqual(app.db_pool.ingest_log.depth(), 0)
+
+        response = await self.client.post("/save_data", data=b'{"1": {"1": {}}}')
+        self.assertEqual(response.status_code, 202)
+        response = await self.client.post("/save_data_xposted", data=TestIngestDrain.channel_info(1))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(app.db_pool.ingest_log.depth(), 2)
+
+    async def test_InvalidHeartbeatRefused(self):
+        for body in ({"data": b"not json"},
+                     {"json": [1, 2]},
+                     {"json": {"spider_id": "spider"}},
+                     {"json": {"spider_id": "spider", "chan_ids": ["1"]}},
+                     {"json": {"chan_ids": [1]}}):
+            response = await self.client.post("/heartbeat", **body)
+            self.assertEqual(response.status_code, 400, body)
+        app.db_pool.elastic_db.renew_leases.assert_not_called()
+
+        app.db_pool.elastic_db.renew_leases.return_value = {"renewed": [1], "lost": []}
+        response = await self.client.post("/heartbeat", json={"spider_id": "spider", "chan_ids": [1]})
+        self.assertEqual(response.status_code, 200)
+        app.db_pool.elastic_db.renew_leases.assert_called_once_with(chan_ids=[1], spider_id="spider")
+
+
 if __name__ == '__main__':
     unittest.main()
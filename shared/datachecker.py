@@ -1,20 +1,29 @@
 TEMPLATE_POSTS = {"text": str,
                   "forwards": int,  # nb of time this post was forwarded
+                  "views": int,
                   "reply": bool,
                   "id": int,
                   "forwarded_from": str,    # fwd_chan_id
                   "urls": [str],
                   "domains": [str],
+                  "tme_links": [str],   # usernames of the channels linked with t.me/<username>
+                  "mentions": [str],
+                  "hashtags": [str],
                   "date": int}
 
 TEMPLATE_CHANNEL_INFO = {"channel_info": {"chan_id": int,
                                           "title": str,
                                           "username": str,
                                           "verified": bool,
-                                          "nb_participants": int},
+                                          "nb_participants": int,
+                                          "min_msg_id": int,    # range of the message IDs crawled, 0 if none
+                                          "max_msg_id": int,
+                                          "spider_id": str},    # holder of the lease, optional
                          "fwd_chan_dict": [{"chan_username": str,
                                             "chan_id": int,
-                                            "nb_of_forwards": int}]}
+                                            "nb_of_forwards": int}],
+                         "linked_chan_dict": [{"chan_username": str,
+                                               "nb_of_links": int}]}
 
 
 def validate_list(list_to_validate, type_in_list):
@@ -40,7 +49,7 @@ def validate_posts(posts: dict):
 
 
 def validate_channel_info(info: dict):
-    assert len(info) == len(TEMPLATE_CHANNEL_INFO)
+    assert set(info) <= set(TEMPLATE_CHANNEL_INFO)
 
     # verifying the channel_info
     for key, val in info["channel_info"].items():
@@ -52,6 +61,12 @@ def validate_channel_info(info: dict):
         for key, val in i.items():
             assert type(val) is TEMPLATE_CHANNEL_INFO['fwd_chan_dict'][0][key]
 
+    # verifying the linked_chan_dict, not sent by spiders older than the t.me links
+    for i in info.get("linked_chan_dict", []):
+        assert len(i) == len(TEMPLATE_CHANNEL_INFO['linked_chan_dict'][0])
+        for key, val in i.items():
+            assert type(val) is TEMPLATE_CHANNEL_INFO['linked_chan_dict'][0][key]
+
 
 if __name__ == '__main__':
     import pickle
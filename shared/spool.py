@@ -0,0 +1,194 @@
+"""
+Spool files: the data the crawler leaves in DATA_STORAGE_FOLDER for the reporter to send to the orchestrator.
+
+    {"format": "voyager-spool", "version": 1, "kind": "posts", "chan_id": 123, "frames": 2, "key": "9f0c..."}\\n
+    zstd stream of NDJSON frames:
+        {"4567": {"text": ..., "id": 4567, ...}}\\n
+        {"4568": {"text": ..., "id": 4568, ...}}\\n
+
+The header is a line of plain JSON, the reporter knows what the file holds without decompressing it. Every frame is a
+JSON object with a single member, the JSON payload sent to the orchestrator is the object made of the members of all
+the frames (nested under the channel ID for the posts: {"123": {"4567": {...}, "4568": {...}}}). The reporter builds
+it from the frames as they are decompressed, without decoding them (see SpoolReader.payload).
+
+The key is drawn when the file is written and sent with it as idempotency key: the orchestrator ingests a file once,
+whatever the number of times the reporter sends it. Files written before the keys have none.
+
+A reader refuses the files of a version above its own, files of older versions must stay readable.
+"""
+
+import io
+import json
+import uuid
+
+import zstandard
+
+SPOOL_FORMAT = "voyager-spool"
+SPOOL_VERSION = 1
+SPOOL_EXTENSION = ".spool"
+# kinds of spool files
+POSTS = "posts"                 # {chan_id: {post_id: post}}, see datachecker.TEMPLATE_POSTS
+CHANNEL_INFO = "channel_info"   # see datachecker.TEMPLATE_CHANNEL_INFO
+
+COMPRESSION_LEVEL = 3
+# longest header accepted, anything longer isn't a spool file
+MAX_HEADER_SIZE = 4096
+# size of the pieces of payload yielded by SpoolReader.payload (and of the chunks of the HTTP request sending them)
+PAYLOAD_PIECE_SIZE = 2 ** 16
+
+
+class SpoolError(Exception):
+    "Raised when a file isn't a spool file this version can read"
+    pass
+
+
+def encode(kind, members: dict, chan_id=None, level=COMPRESSION_LEVEL) -> bytes:
+    """
+    Content of the spool file of `members`, one frame per member.
+    :param kind: POSTS or CHANNEL_INFO
+    """
+    header = {"format": SPOOL_FORMAT, "version": SPOOL_VERSION, "kind": kind, "chan_id": chan_id,
+              "frames": len(members), "key": uuid.uuid4().hex}
+    # the text of the posts is mostly not latin: kept in UTF-8 rather than escaped
+    frames = b"".join(json.dumps({str(key): value}, ensure_ascii=False).encode() + b"\n"
+                      for key, value in members.items())
+    return json.dumps(header).encode() + b"\n" + zstandard.ZstdCompressor(level=level).compress(frames)
+
+
+def encode_posts(chan_id, posts: dict[int: dict]) -> bytes:
+    return encode(POSTS, posts, chan_id=chan_id)
+
+
+def encode_channel_info(info: dict) -> bytes:
+    return encode(CHANNEL_INFO, info, chan_id=info["channel_info"]["chan_id"])
+
+
+def _members(frames, piece: bytearray):
+    """Adds the members of the frames to `piece`, separated by commas. Yields `piece` whenever it is full."""
+    separator = b""
+    for frame in frames:
+        # the member of the frame, without its braces
+        piece += separator
+        piece += frame[1:-1]
+        separator = b", "
+        if len(piece) >= PAYLOAD_PIECE_SIZE:
+            yield bytes(piece)
+            piece.clear()
+
+
+def posts_payload(readers: list):
+    """
+    Yields the JSON payload of several spool files of posts in pieces of PAYLOAD_PIECE_SIZE bytes, the frames aren't
+    decoded. The posts of a channel are gathered under its ID, whatever the number of files they come from.
+    """
+    channels = {}
+    for reader in readers:
+        channels.setdefault(reader.header["chan_id"], []).append(reader)
+    piece = bytearray(b"{")
+    for i, (chan_id, chan_readers) in enumerate(channels.items()):
+        piece += b", " if i > 0 else b""
+        piece += json.dumps(str(chan_id)).encode() + b": {"
+        yield from _members((frame for reader in chan_readers for frame in reader.frames()), piece)
+        piece += b"}"
+    piece += b"}"
+    yield bytes(piece)
+
+
+def posts_ndjson(readers: list):
+    """
+    Yields the posts of several spool files of posts as NDJSON, a {chan_id: {post_id: post}} line per post (the body of
+    /save_data_stream), in pieces of PAYLOAD_PIECE_SIZE bytes. The frames aren't decoded.
+    """
+    piece = bytearray()
+    for reader in readers:
+        prefix = b"{" + json.dumps(str(reader.header["chan_id"])).encode() + b": "
+        for frame in reader.frames():
+            piece += prefix
+            piece += frame
+            piece += b"}\n"
+            if len(piece) >= PAYLOAD_PIECE_SIZE:
+                yield bytes(piece)
+                piece.clear()
+    yield bytes(piece)
+
+
+class SpoolReader:
+    """
+    Reads a spool file frame by frame, only a piece of the decompressed stream is in memory at a time. The frames can
+    be read once: frames, payload or read, only one of them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._frames_read = False
+        self._file = open(path, "rb")
+        try:
+            self.header = self._read_header()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _read_header(self) -> dict:
+        line = self._file.readline(MAX_HEADER_SIZE)
+        try:
+            header = json.loads(line)
+        except ValueError:
+            raise SpoolError(f"{self.path} has no spool header")
+        if not isinstance(header, dict) or header.get("format") != SPOOL_FORMAT:
+            raise SpoolError(f"{self.path} isn't a spool file")
+        if header.get("version", 0) > SPOOL_VERSION:
+            raise SpoolError(f"{self.path} is a spool file of version {header.get('version')}, "
+                             f"only versions up to {SPOOL_VERSION} can be read")
+        return header
+
+    @property
+    def kind(self):
+        return self.header["kind"]
+
+    @property
+    def key(self):
+        """Idempotency key of the file, None for the files written before the keys"""
+        return self.header.get("key")
+
+    def frames(self):
+        """Yields the frames as they are decompressed: the bytes of their JSON, without the new line."""
+        if self._frames_read:
+            raise SpoolError(f"The frames of {self.path} were already read")
+        self._frames_read = True
+        reader = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(self._file), PAYLOAD_PIECE_SIZE)
+        try:
+            for line in reader:
+                frame = line.rstrip(b"\n")
+                if not frame.startswith(b"{") or not frame.endswith(b"}"):
+                    raise SpoolError(f"{self.path} has an invalid frame: {frame[:100]}")
+                yield frame
+        except zstandard.ZstdError as err:
+            raise SpoolError(f"{self.path} can't be decompressed: {err}")
+
+    def payload(self):
+        """Yields the JSON payload of the file in pieces of PAYLOAD_PIECE_SIZE bytes, the frames aren't decoded."""
+        if self.kind == POSTS:
+            yield from posts_payload([self])
+            return
+        piece = bytearray(b"{")
+        yield from _members(self.frames(), piece)
+        piece += b"}"
+        yield bytes(piece)
+
+    def read(self) -> dict:
+        """The data of the file, as the crawler saved it ({chan_id: {post_id: post}} for the posts)."""
+        members = {}
+        for frame in self.frames():
+            members.update(json.loads(frame))
+        if self.kind == POSTS:
+            return {self.header["chan_id"]: {int(post_id): post for post_id, post in members.items()}}
+        return members
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,159 @@
+"""
+Waits for files to be added to a folder: written and closed, or renamed into it (ex: the .TEMP files of the crawler
+renamed once complete). With inotify on Linux the wait is woken up by the kernel as soon as a file is added and uses no
+CPU in between. Elsewhere, or on the file systems inotify can't watch (NFS...), the folder is polled: its modification
+time is checked every `poll_interval` seconds and it is only listed when it changed.
+
+Files added between two waits aren't missed: the inotify events are queued from the creation of the watcher, the
+listing of the poller is compared to the previous one.
+"""
+
+import os
+import time
+import errno
+import struct
+import ctypes
+import select
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")    # wd, mask, cookie, len (of the name following)
+READ_SIZE = 2 ** 16
+
+
+def _load_inotify():
+    """libc if it has inotify (Linux, glibc or musl), else None"""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FolderWatcher:
+
+    def __init__(self, path, accept=None, polling=False, poll_interval=1.0):
+        """
+        :param accept: function(file name) -> bool, the files it refuses don't wake up the waits
+        :param polling: polls the folder even if inotify is available
+        """
+        self.path = path
+        self.accept = accept if accept is not None else (lambda name: True)
+        self.poll_interval = poll_interval
+        self._fd = None
+        libc = None if polling else _load_inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                self._fd = fd
+            else:
+                err = ctypes.get_errno()
+                if fd >= 0:
+                    os.close(fd)
+                log.warning(f"Can't watch {path} with inotify ({errno.errorcode.get(err, err)}), polling it instead")
+        # poller state: modification time and content of the folder at the last listing
+        self._mtime = None
+        self._names = set()
+        if self._fd is None:
+            self._poll()
+        log.info(f"Watching {path} with {'inotify' if self._fd is not None else 'polling'}")
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._fd is not None
+
+    def _read_events(self) -> bool:
+        """Reads the pending inotify events, True if one of them is a file accepted (or if events were lost)."""
+        added = False
+        while True:
+            try:
+                buffer = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                return added
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                # queue overflow: files may have been added without their event, the caller lists the folder anyway
+                if mask & IN_Q_OVERFLOW or self.accept(name):
+                    added = True
+
+    def _poll(self) -> bool:
+        """Lists the folder if it was modified, True if a file accepted was added since the last listing."""
+        mtime = os.stat(self.path).st_mtime_ns
+        # a modification in the same tick of a coarse clock as the last listing doesn't change the modification time
+        if mtime == self._mtime and time.time_ns() - mtime > 2 * 10 ** 9:
+            return False
+        self._mtime = mtime
+        names = set(os.listdir(self.path))
+        added = any(self.accept(name) for name in names - self._names)
+        self._names = names
+        return added
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Blocks until a file accepted is added to the folder, `timeout` seconds at most (None: no limit).
+        :return: False if the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if self._fd is not None:
+                readable, _, _ = select.select([self._fd], [], [], remaining)
+                if readable and self._read_events():
+                    return True
+            else:
+                if self._poll():
+                    return True
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    async def wait_async(self, timeout=None) -> bool:
+        """Same as wait, without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - loop.time())
+            if self._fd is not None:
+                # the watcher may be closed before this wait is cancelled
+                fd = self._fd
+                readable = loop.create_future()
+                loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+                try:
+                    await asyncio.wait_for(readable, timeout=remaining)
+                except asyncio.TimeoutError:
+                    return False
+                finally:
+                    loop.remove_reader(fd)
+                if self._read_events():
+                    return True
+            else:
+                if self._poll():
+                    return True
+                await asyncio.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+            if deadline is not None and loop.time() >= deadline:
+                return False
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
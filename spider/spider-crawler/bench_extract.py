@@ -0,0 +1,87 @@
+"""
+Speed of the extraction of URLs, domains, t.me links, mentions and hashtags from the text of the posts: one regex per
+kind of token and urlparse on every URL (how the crawler used to work, plus the scans it would have needed for the
+t.me links, mentions and hashtags) vs the single scan of extractor.extract with its memoized hostnames.
+
+The posts are generated locally and shaped like channel posts: a few links to a small set of news sites and channels,
+mentions, hashtags, non-latin text and emojis. Ex:
+
+    python bench_extract.py --posts 50000 --rounds 3
+"""
+
+import re
+import time
+import random
+import argparse
+from urllib.parse import urlparse
+
+import extractor
+
+HTTP_URL_REG = re.compile(
+    r"https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*)")
+TME_REG = re.compile(r"(?<![\w./@])(?:https?://)?(?:www\.)?(?:t|telegram)\.me/([a-zA-Z0-9_+/]+)")
+MENTION_REG = re.compile(r"(?<![\w@])@([a-zA-Z]\w{3,31})\b")
+HASHTAG_REG = re.compile(r"(?<![\w#&])#(\w*[^\W\d]\w*)")
+
+SITES = ["www.reuters.com", "apnews.com", "www.bbc.co.uk", "ria.ru", "tass.ru", "www.youtube.com", "youtu.be",
+         "twitter.com", "x.com", "www.rt.com", "meduza.io", "kyivindependent.com"]
+CHANNELS = [f"channel_{i}" for i in range(200)]
+WORDS = ["the", "breaking", "news", "report", "война", "новости", "сегодня", "заявил", "президент", "україна",
+         "attack", "official", "source", "🔥", "⚡️", "‼️", "👇", "video", "photo", "update"]
+
+
+def make_post(rng) -> str:
+    words = rng.choices(WORDS, k=rng.randint(10, 120))
+    for _ in range(rng.choice([0, 0, 1, 1, 1, 2, 3])):
+        words.insert(rng.randrange(len(words) + 1),
+                     f"https://{rng.choice(SITES)}/{rng.choice(WORDS)}/{rng.randint(1, 10 ** 6)}?utm_source=telegram")
+    for _ in range(rng.choice([0, 0, 0, 1, 2])):
+        words.insert(rng.randrange(len(words) + 1),
+                     rng.choice(["https://t.me/", "t.me/", "t.me/s/"]) + rng.choice(CHANNELS)
+                     + rng.choice(["", f"/{rng.randint(1, 10 ** 5)}"]))
+    for _ in range(rng.choice([0, 0, 1])):
+        words.insert(rng.randrange(len(words) + 1), "@" + rng.choice(CHANNELS))
+    for _ in range(rng.choice([0, 0, 1, 2])):
+        words.insert(rng.randrange(len(words) + 1), "#" + rng.choice(WORDS[:13]))
+    return " ".join(words)
+
+
+def extract_multi_pass(text: str) -> tuple:
+    urls = [m.group(0) for m in HTTP_URL_REG.finditer(text)]
+    domains = [urlparse(url=url).hostname for url in urls]
+    tme_links = [m.group(1).split("/")[0] for m in TME_REG.finditer(text)]
+    mentions = [m.group(1) for m in MENTION_REG.finditer(text)]
+    hashtags = [m.group(1) for m in HASHTAG_REG.finditer(text)]
+    return urls, domains, tme_links, mentions, hashtags
+
+
+def run(func, posts, rounds) -> float:
+    """Best posts/s out of `rounds` passes on the corpus."""
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for text in posts:
+            func(text)
+        best = min(best, time.perf_counter() - start)
+    return len(posts) / best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Extraction benchmark',
+                                     description='Posts/s of the multi-pass extraction vs extractor.extract.')
+    parser.add_argument('--posts', type=int, default=50000, help='Posts in the corpus.')
+    parser.add_argument('--rounds', type=int, default=3, help='Passes on the corpus, the best one is kept.')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    posts = [make_post(rng) for _ in range(args.posts)]
+
+    multi_pass = run(extract_multi_pass, posts, args.rounds)
+    single_pass = run(extractor.extract, posts, args.rounds)
+    cache = extractor.hostname_cache_info()
+
+    print(f"{args.posts} posts, {sum(len(text) for text in posts) / args.posts:.0f} characters per post")
+    print(f"{'multi-pass':<12} {multi_pass:>10.0f} posts/s")
+    print(f"{'single-pass':<12} {single_pass:>10.0f} posts/s")
+    print(f"Speedup: {single_pass / multi_pass:.2f}x, hostname cache hit rate: "
+          f"{cache.hits / max(cache.hits + cache.misses, 1):.1%} ({cache.currsize} hostnames)")
@@ -0,0 +1,125 @@
+"""
+Memory used by the chunks of messages the crawler buffers, with Telethon messages kept until the chunk is processed
+(how the crawler used to work) or converted to PostRecord as soon as they are fetched.
+
+Messages are generated locally (real Telethon Message objects, with entities, a forward header and a web page preview
+like most channel posts), no Telegram account is needed. Each mode runs in its own process so the peak RSS of one
+doesn't hide the other. Ex:
+
+    python bench_memory.py --chunk-size 1000 --chunks 5
+
+The peak of one chunk is what a crawl holds per chunk in its pipeline (up to PIPELINE_DEPTH + 1 chunks per channel,
+CRAWL_CONCURRENCY channels at the same time).
+"""
+
+import sys
+import json
+import random
+import argparse
+import datetime
+import resource
+import tracemalloc
+import subprocess
+
+from telethon import TelegramClient
+from telethon.sessions import MemorySession
+from telethon.tl.types import Message, PeerChannel, MessageFwdHeader, MessageEntityUrl, MessageEntityBold, Channel, \
+    ChatPhotoEmpty, MessageMediaWebPage, WebPage
+
+from records import PostRecord
+
+PAGE_SIZE = 100
+FWD_CHANNELS = 50
+
+
+def make_page(client, first_id, nb_messages, text_size) -> list:
+    """A page of messages as returned by get_messages: newest first, entities resolved."""
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    channels = {}
+    page = []
+    for msg_id in range(first_id, first_id - nb_messages, -1):
+        url = f"https://example.com/article/{msg_id}"
+        text = "".join(random.choices("abcdefghijklmnopqrstuvwxyz     ", k=text_size)) + " " + url
+        fwd_from = None
+        if msg_id % 3 == 0:
+            fwd_chan_id = msg_id % FWD_CHANNELS + 1
+            channels[-1000000000000 - fwd_chan_id] = Channel(id=fwd_chan_id, title=f"Channel {fwd_chan_id}",
+                                                             photo=ChatPhotoEmpty(), date=now,
+                                                             username=f"channel_{fwd_chan_id}", access_hash=fwd_chan_id)
+            fwd_from = MessageFwdHeader(date=now, from_id=PeerChannel(fwd_chan_id), channel_post=msg_id)
+        media = MessageMediaWebPage(webpage=WebPage(id=msg_id, url=url, display_url=url[8:], hash=0,
+                                                    type="article", site_name="Example", title=f"Article {msg_id}",
+                                                    description=text[:200], attributes=[]))
+        msg = Message(id=msg_id, peer_id=PeerChannel(1), date=now, message=text, fwd_from=fwd_from, media=media,
+                      views=random.randint(0, 100000), forwards=random.randint(0, 1000),
+                      entities=[MessageEntityBold(offset=0, length=10),
+                                MessageEntityUrl(offset=len(text) - len(url), length=len(url))])
+        page.append(msg)
+    for msg in page:
+        msg._finish_init(client, channels, None)
+    return page
+
+
+def fill_chunk(client, mode, first_id, chunk_size, text_size) -> list:
+    """Fetches pages until a chunk is full, like Spider._fetch_range."""
+    buffer = []
+    while len(buffer) < chunk_size:
+        page = make_page(client, first_id=first_id - len(buffer), nb_messages=min(PAGE_SIZE, chunk_size - len(buffer)),
+                         text_size=text_size)
+        if mode == "records":
+            buffer.extend(PostRecord.from_message(msg) for msg in page)
+        else:
+            buffer.extend(page)
+        del page
+    return buffer
+
+
+def run_mode(mode, chunk_size, nb_chunks, text_size) -> dict:
+    random.seed(42)
+    client = TelegramClient(MemorySession(), api_id=1, api_hash="benchmark")
+    peaks = []
+    first_id = nb_chunks * chunk_size
+    for _ in range(nb_chunks):
+        tracemalloc.start()
+        chunk = fill_chunk(client, mode=mode, first_id=first_id, chunk_size=chunk_size, text_size=text_size)
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append((held, peak))
+        first_id -= chunk_size
+        del chunk
+    return {"mode": mode,
+            "held_per_chunk": max(held for held, _ in peaks),
+            "peak_per_chunk": max(peak for _, peak in peaks),
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Crawler memory benchmark',
+                                     description='Memory held per chunk with Telethon messages vs PostRecord.')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Messages per chunk (CHUNK_SIZE).')
+    parser.add_argument('--chunks', type=int, default=5, help='Chunks filled per mode.')
+    parser.add_argument('--text-size', type=int, default=600, help='Characters of text per message.')
+    parser.add_argument('--mode', type=str, choices=['messages', 'records'], default=None,
+                        help='Runs a single mode in this process and prints its result in JSON.')
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        print(json.dumps(run_mode(mode=args.mode, chunk_size=args.chunk_size, nb_chunks=args.chunks,
+                                  text_size=args.text_size)))
+        sys.exit(0)
+
+    results = []
+    for mode in ("messages", "records"):
+        out = subprocess.run([sys.executable, __file__, "--mode", mode, "--chunk-size", str(args.chunk_size),
+                              "--chunks", str(args.chunks), "--text-size", str(args.text_size)],
+                             check=True, capture_output=True, text=True)
+        results.append(json.loads(out.stdout))
+
+    print(f"CHUNK_SIZE={args.chunk_size}, {args.chunks} chunks, {args.text_size} characters per message")
+    print(f"{'mode':<10} {'held/chunk (MiB)':>17} {'peak/chunk (MiB)':>17} {'bytes/message':>14} {'max RSS (MiB)':>14}")
+    for result in results:
+        print(f"{result['mode']:<10} {result['held_per_chunk'] / 2 ** 20:>17.2f} "
+              f"{result['peak_per_chunk'] / 2 ** 20:>17.2f} {result['held_per_chunk'] / args.chunk_size:>14.0f} "
+              f"{result['max_rss_kib'] / 1024:>14.1f}")
+    before, after = results
+    print(f"Memory held per chunk divided by {before['held_per_chunk'] / max(after['held_per_chunk'], 1):.1f}")
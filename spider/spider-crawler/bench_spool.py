@@ -0,0 +1,111 @@
+"""
+Bytes on disk and time to write/read the chunk files, pickle (what the crawler used to write) vs spool files (see
+shared/spool.py). Reading is what the reporter does before sending a chunk: unpickle and encode the JSON body for
+pickle files, forward the frames for spool files (full decode only in debug mode, to validate the posts).
+
+The chunks are made of generated real-shaped posts (see bench_extract.py) processed like the crawler does. Needs
+shared/ in the path, ex:
+
+    PYTHONPATH=../../shared python bench_spool.py --chunk-size 1000 --chunks 20
+"""
+
+import os
+import json
+import time
+import pickle
+import random
+import argparse
+import tempfile
+
+from extractor import extract
+from bench_extract import make_post
+from spool import encode_posts, SpoolReader
+
+
+def make_chunk(rng, chan_id, first_id, chunk_size) -> dict:
+    """{chan_id: {post_id: post}} as returned by Spider._process_posts"""
+    posts = {}
+    for post_id in range(first_id, first_id - chunk_size, -1):
+        text = make_post(rng)
+        urls, domains, tme_links, mentions, hashtags = extract(text)
+        posts[post_id] = {"text": text,
+                          "forwards": rng.randint(0, 500),
+                          "views": rng.randint(0, 200000),
+                          "reply": False,
+                          "id": post_id,
+                          "forwarded_from": str(rng.randint(10 ** 9, 2 * 10 ** 9)) if rng.random() < 0.2 else "",
+                          "urls": urls,
+                          "domains": domains,
+                          "tme_links": tme_links,
+                          "mentions": mentions,
+                          "hashtags": hashtags,
+                          "date": 1700000000 + post_id * 60}
+    return {chan_id: posts}
+
+
+def read_pickle(path) -> bytes:
+    with open(path, "rb") as f:
+        content = pickle.loads(f.read())
+    # what requests.post(json=...) sends
+    return json.dumps(content).encode()
+
+
+def decode_pickle(path) -> dict:
+    with open(path, "rb") as f:
+        return pickle.loads(f.read())
+
+
+def forward_spool(path) -> bytes:
+    with SpoolReader(path) as spool:
+        return b"".join(spool.payload())
+
+
+def decode_spool(path) -> dict:
+    with SpoolReader(path) as spool:
+        return spool.read()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Spool benchmark',
+                                     description='Size and encode/decode time of the chunk files, pickle vs spool.')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Posts per chunk (CHUNK_SIZE).')
+    parser.add_argument('--chunks', type=int, default=20, help='Chunks written and read per format.')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    chunks = [make_chunk(rng, chan_id=1234567890, first_id=(i + 1) * args.chunk_size, chunk_size=args.chunk_size)
+              for i in range(args.chunks)]
+    totals = {name: {"bytes": 0, "encode": 0.0, "read": 0.0, "decode": 0.0} for name in ("pickle", "spool")}
+    with tempfile.TemporaryDirectory() as folder:
+        for i, chunk in enumerate(chunks):
+            (chan_id, posts), = chunk.items()
+            for name, encode in (("pickle", pickle.dumps), ("spool", lambda c: encode_posts(chan_id, posts))):
+                content, seconds = timed(encode, chunk)
+                path = os.path.join(folder, f"chunk_{i}.{name}")
+                with open(path, "wb") as f:
+                    f.write(content)
+                totals[name]["bytes"] += len(content)
+                totals[name]["encode"] += seconds
+            body, seconds = timed(read_pickle, os.path.join(folder, f"chunk_{i}.pickle"))
+            totals["pickle"]["read"] += seconds
+            _, seconds = timed(decode_pickle, os.path.join(folder, f"chunk_{i}.pickle"))
+            totals["pickle"]["decode"] += seconds
+            forwarded, seconds = timed(forward_spool, os.path.join(folder, f"chunk_{i}.spool"))
+            totals["spool"]["read"] += seconds
+            assert json.loads(forwarded) == json.loads(body)
+            _, seconds = timed(decode_spool, os.path.join(folder, f"chunk_{i}.spool"))
+            totals["spool"]["decode"] += seconds
+
+    print(f"{args.chunks} chunks of {args.chunk_size} posts, "
+          f"{len(json.dumps(chunks[0]).encode()) / 2 ** 10:.0f} KiB of JSON per chunk")
+    print(f"{'format':<8} {'KiB/chunk':>10} {'write ms':>9} {'send ms':>8} {'decode ms':>10}")
+    for name, total in totals.items():
+        print(f"{name:<8} {total['bytes'] / args.chunks / 2 ** 10:>10.1f} {total['encode'] / args.chunks * 1000:>9.1f} "
+              f"{total['read'] / args.chunks * 1000:>8.1f} {total['decode'] / args.chunks * 1000:>10.1f}")
+    print("send: from the file to the JSON body of the request. decode: from the file to Python objects")
@@ -0,0 +1,106 @@
+import os
+import json
+import logging
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+
+class CrawlCheckpoint:
+    """
+    Progress of the crawl of a channel, saved after every chunk written so a crawl interrupted (crash, restart) goes on
+    from where it stopped instead of fetching the channel again.
+
+    For each range of message IDs (see Spider._partitions): the index of the next chunk, the lowest message ID written
+    (the fetch resumes with it as offset_id) and whether the range is done. The forwards and t.me links counted and
+    the range of message IDs of the chunks written are kept too, the channel info sent at the end covers the whole
+    crawl.
+    """
+
+    def __init__(self, path, chan_id, watermark, partitions: list[tuple]):
+        self.path = path
+        self.chan_id = chan_id
+        self.watermark = watermark
+        self.partitions = [{"min_id": range_min,
+                            "max_id": range_max,
+                            "next_chunk": 0,
+                            "offset_id": 0,      # 0: nothing written yet
+                            "fetched": 0,
+                            "done": False}
+                           for range_min, range_max in partitions]
+        self.fwd_chan_dict = defaultdict(int)       # (chan_username, chan_id): nb of forwards
+        self.linked_chan_dict = defaultdict(int)    # chan_username: nb of t.me links
+        self.min_msg_id = None
+        self.max_msg_id = None
+
+    def chunk_written(self, part, messages: list, forwarded_channels: dict, new_posts: list, linked_channels=None,
+                      fetched=None):
+        """
+        Records a chunk saved.
+        :param messages: Telegram messages of the chunk
+        :param forwarded_channels: forwards counted in the chunk, see Spider._process_posts
+        :param linked_channels: t.me links counted in the chunk, see Spider._process_posts
+        :param new_posts: IDs of the posts of the chunk above the watermark
+        :param fetched: messages of the range fetched from Telegram up to the last one of the chunk, the ones without
+        text (not in the chunk) included: what the fetch counts in MAX_MSG_CRAWL when it resumes. None: only the
+        messages of the chunk are counted.
+        """
+        partition = self.partitions[part]
+        partition["next_chunk"] += 1
+        if fetched is not None:
+            partition["fetched"] = fetched
+        else:
+            partition["fetched"] += len(messages)
+        if messages:
+            partition["offset_id"] = min(msg.id for msg in messages)
+        for key, nb_fwd in forwarded_channels.items():
+            self.fwd_chan_dict[key] += nb_fwd
+        for chan_username, nb_links in (linked_channels or {}).items():
+            self.linked_chan_dict[chan_username] += nb_links
+        if new_posts:
+            chunk_min, chunk_max = min(new_posts), max(new_posts)
+            self.min_msg_id = chunk_min if self.min_msg_id is None else min(self.min_msg_id, chunk_min)
+            self.max_msg_id = chunk_max if self.max_msg_id is None else max(self.max_msg_id, chunk_max)
+
+    def part_done(self, part):
+        self.partitions[part]["done"] = True
+
+    def save(self):
+        data = {"chan_id": self.chan_id,
+                "watermark": self.watermark,
+                "partitions": self.partitions,
+                "fwd_chan_dict": [[chan_username, fwd_chan_id, nb_fwd]
+                                  for (chan_username, fwd_chan_id), nb_fwd in self.fwd_chan_dict.items()],
+                "linked_chan_dict": self.linked_chan_dict,
+                "min_msg_id": self.min_msg_id,
+                "max_msg_id": self.max_msg_id}
+        # written under a temporary name then renamed, a crash never leaves half a checkpoint
+        temp_path = self.path + ".TEMP"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+    @classmethod
+    def load(cls, path):
+        """Returns the checkpoint saved at `path`, None if there is none or it can't be read."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            checkpoint = cls(path=path, chan_id=data["chan_id"], watermark=data["watermark"], partitions=[])
+            checkpoint.partitions = data["partitions"]
+            for chan_username, fwd_chan_id, nb_fwd in data["fwd_chan_dict"]:
+                checkpoint.fwd_chan_dict[(chan_username, fwd_chan_id)] = nb_fwd
+            # checkpoints saved before the t.me links were counted don't have them
+            checkpoint.linked_chan_dict.update(data.get("linked_chan_dict", {}))
+            checkpoint.min_msg_id = data["min_msg_id"]
+            checkpoint.max_msg_id = data["max_msg_id"]
+        except (OSError, ValueError, KeyError) as err:
+            log.error(f"Couldn't read the checkpoint {path}, crawling the channel from the start: {err}")
+            return None
+        return checkpoint
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,13 +1,22 @@
 import os
-import re
 import json
 import time
-import pickle
+import asyncio
+import contextlib
 import logging
+import multiprocessing
 from collections import defaultdict
-from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
 
 from telegram import Client
+from entitycache import EntityCache
+from sessionpool import SessionPool, PooledSession
+from checkpoint import CrawlCheckpoint
+from records import PostRecord
+from extractor import extract, hostname_cache_info
+from pipelinestats import PipelineStats
+from spool import encode_posts, encode_channel_info, SPOOL_EXTENSION
+from watcher import FolderWatcher
 
 log_datefmt = os.getenv("DATE_FORMAT", default="%Y-%m-%d %H:%M:%S")
 log_formatting = os.getenv("LOG_FORMATING", default="%(levelname)s-[%(asctime)s] [%(thread)d] %(message)s")
@@ -36,11 +45,57 @@ CHUNK_SIZE = int(os.getenv("CHUNK_SIZE"))
 DATA_STORAGE_FOLDER = os.getenv("DATA_STORAGE_FOLDER", "../devland/")
 USERNAME_STORAGE_FOLDER = os.getenv("USERNAME_STORAGE_FOLDER", "../devland/test_usr_folder/")
 ERROR_GETTING_NAME_FLAG = os.getenv("ERROR_GETTING_NAME_FLAG")
+# Telegram sessions (accounts) the requests are spread over, comma separated. Each needs its <name>.session file.
+SESSION_NAMES = [name.strip() for name in os.getenv("SESSION_NAMES", default="Voyager").split(",") if name.strip()]
+# Requests per second allowed per session on average, in bursts of SESSION_BURST requests at most. Lowered
+# automatically for a session when Telegram answers with flood waits.
+SESSION_RATE = float(os.getenv("SESSION_RATE", default=2))
+SESSION_BURST = float(os.getenv("SESSION_BURST", default=10))
+# Messages per request to Telegram (100 at most)
+PAGE_SIZE = 100
+# A channel crawled before only has its messages after the last one ingested fetched. The REFRESH_WINDOW messages
+# before it are fetched again to update their views and forwards counters (not counted again in the graph).
+REFRESH_WINDOW = int(os.getenv("REFRESH_WINDOW", default=0))
+# Channels with more than PARTITION_THRESHOLD message IDs to fetch are split into ranges of PARTITION_SIZE message IDs,
+# PARTITION_CONCURRENCY ranges being fetched at the same time (through any session of the pool).
+PARTITION_THRESHOLD = int(os.getenv("PARTITION_THRESHOLD", default=20000))
+PARTITION_SIZE = int(os.getenv("PARTITION_SIZE", default=5000))
+PARTITION_CONCURRENCY = int(os.getenv("PARTITION_CONCURRENCY", default=4))
+# Channels resolved by each session (access hash, username, title), saved at ENTITY_CACHE_PATH and shared by all the
+# crawls. ENTITY_CACHE_SIZE channels at most, the least recently used ones are dropped first.
+ENTITY_CACHE_PATH = os.getenv("ENTITY_CACHE_PATH", default="entity_cache.sqlite3")
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", default=100000))
+# Number of channels crawled at the same time over the connection of the session.
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", default=4))
+# Chunks of messages fetched from Telegram waiting to be processed and saved, per channel.
+PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", default=2))
+# Worker processes the chunks are processed and serialized by (shared by all the channels crawled). 0: processed by
+# threads of the crawler process, which share its GIL with the fetch.
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", default=0))
+# "true" polls USERNAME_STORAGE_FOLDER every WATCH_POLL_INTERVAL seconds instead of watching it with inotify (for the
+# file systems inotify can't watch, like NFS)
+WATCH_POLLING = json.loads(os.getenv("WATCH_POLLING", default="false"))
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", default=1))
 
 
 class Spider:
-    http_url_reg = re.compile(
-        r"https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*)")
+    def __init__(self):
+        # one client (and connection to Telegram) per session for all the channels crawled, the pool handles the flood
+        # waits itself: Telethon must not sleep on them
+        sessions = []
+        for name in SESSION_NAMES:
+            entity_cache = EntityCache(path=ENTITY_CACHE_PATH, session=name, max_size=ENTITY_CACHE_SIZE)
+            client = Client(session_name=name, api_id=API_ID, api_hash=API_HASH, max_msg_crawl=MAX_MSG_CRAWL,
+                            chunk_size=CHUNK_SIZE, entity_cache=entity_cache, flood_sleep_threshold=0)
+            sessions.append(PooledSession(name=name, client=client, rate=SESSION_RATE, burst=SESSION_BURST))
+        self.pool = SessionPool(sessions)
+        # None: the chunks are processed by the default thread pool of the event loop
+        self.executor = None
+        if PROCESS_WORKERS > 0:
+            # spawned workers: forking the crawler (event loop, Telethon connections, threads holding locks) isn't safe
+            self.executor = ProcessPoolExecutor(max_workers=PROCESS_WORKERS,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        self.stats = PipelineStats()
 
     @staticmethod
     def _fusion_forward_chan_dict(dict1: defaultdict, dict2: defaultdict):
@@ -49,116 +104,390 @@ class Spider:
             dict1[k] += v
         return dict1
 
-    def crawl_channel(self, chan_id):
+    async def start(self):
+        for session in self.pool.sessions:
+            await session.client.start()
+
+    async def close(self):
+        for session in self.pool.sessions:
+            await session.client.close()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    async def crawl_channel(self, chan_id, watermark=0, checkpoint_path=None, spider_id=None):
+        """
+        Crawls a channel with a pipeline of 3 stages: chunks of messages are fetched from Telegram by a task, processed
+        by the worker processes (PROCESS_WORKERS) and saved in the order they were fetched by the write stage. The
+        queues between the stages are bounded (PIPELINE_DEPTH): the fetch waits when the workers or the disk fall
+        behind. See PipelineStats for the throughput of each stage.
+
+        Large channels are partitioned (see _partitions): each range of message IDs is fetched by its own task and
+        saved as its own series of chunks.
+        :param watermark: highest message ID of the channel already ingested, only the messages after it
+        (and the REFRESH_WINDOW ones before) are fetched. 0 if the channel was never crawled.
+        :param checkpoint_path: where the progress of the crawl is saved (see CrawlCheckpoint). If a checkpoint is
+        already there, the crawl goes on from it.
+        :param spider_id: holder of the lease on the channel, sent back with the channel info: the orchestrator doesn't
+        mark the channel crawled if its lease expired and it was handed to another spider meanwhile.
+        """
         log.info(f"Getting info on channel: {chan_id}")
-        fwd_chan_dict = defaultdict(int)
-        client = Client(session_name="Voyager", api_id=API_ID, api_hash=API_HASH, max_msg_crawl=MAX_MSG_CRAWL,
-                        chunk_size=CHUNK_SIZE)
-        chan_id, title, username, verified, nb_participants = client.get_channel_info(chan_id)
+        # ValueError: the session can't resolve the channel, another one may
+        chan_id, title, username, verified, nb_participants = await self.pool.call(
+            lambda session: session.client.get_channel_info(chan_id), skip_on=(ValueError,))
         log.info(f"Crawling channel (chan_id, title, username, verified, nb_participants)"
                  f"{[chan_id, title, username, verified, nb_participants]}")
-        for count, chunk in enumerate(client.crawl_channel(chan_id)):
-            log.info(f"Processing chunk #{count}")
-            processed_posts, forwarded_channels = self._process_posts(chunk, tl_client=client)
-            fwd_chan_dict = self._fusion_forward_chan_dict(fwd_chan_dict, forwarded_channels)
-
-            log.info(f"Saving chunk #{count}")
-            filename = f"{username}-chunk_{count}.pickle"
-            filepath = os.path.join(DATA_STORAGE_FOLDER, filename)
-            self._save_processed_info({chan_id: processed_posts}, filepath)
+
+        checkpoint = CrawlCheckpoint.load(checkpoint_path) if checkpoint_path is not None else None
+        if checkpoint is not None and checkpoint.chan_id == chan_id:
+            # the watermark of the interrupted crawl: the forwards already counted were counted with it
+            watermark = checkpoint.watermark
+            log.info(f"Resuming the crawl of {chan_id} from its checkpoint: {checkpoint.partitions}")
+        else:
+            min_id = max(0, watermark - REFRESH_WINDOW) if watermark else 0
+            partitions = await self._partitions(chan_id=chan_id, username=username, min_id=min_id,
+                                                watermark=watermark)
+            checkpoint = CrawlCheckpoint(path=checkpoint_path, chan_id=chan_id, watermark=watermark,
+                                         partitions=partitions)
+        todo = [part for part, partition in enumerate(checkpoint.partitions) if not partition["done"]]
+
+        # raw chunks: fetch -> process
+        chunks = asyncio.Queue(maxsize=PIPELINE_DEPTH * max(1, min(len(todo), PARTITION_CONCURRENCY)))
+        # chunks being processed, in the order they were fetched: process -> write
+        processed = asyncio.Queue(maxsize=PIPELINE_DEPTH + max(1, PROCESS_WORKERS))
+        # the ranges wait for their turn, at most PARTITION_CONCURRENCY fetched at the same time
+        fetch_slots = asyncio.Semaphore(PARTITION_CONCURRENCY)
+        fetchers = {part: asyncio.create_task(self._fetch_chunks(chan_id=chan_id, username=username, chunks=chunks,
+                                                                 part=part, fetch_slots=fetch_slots,
+                                                                 **checkpoint.partitions[part]))
+                    for part in todo}
+        stages = [asyncio.create_task(self._process_chunks(chan_id=chan_id, username=username, watermark=watermark,
+                                                           chunks=chunks, processed=processed, fetchers=fetchers,
+                                                           checkpoint=checkpoint)),
+                  asyncio.create_task(self._write_chunks(chan_id=chan_id, username=username, processed=processed,
+                                                         checkpoint=checkpoint, checkpoint_path=checkpoint_path))]
+        try:
+            # raises the first error of a stage right away, the crawl stops without waiting for the others
+            await asyncio.gather(*stages)
+        finally:
+            for task in list(fetchers.values()) + stages:
+                task.cancel()
         log.info(f"Finished crawling channel: {chan_id}. Saving channel info.")
+        # range of the new message IDs crawled, the forwards counted in the graph are keyed by it
+        min_msg_id = checkpoint.min_msg_id
+        max_msg_id = checkpoint.max_msg_id
 
         # changing the fwd_chan_dict to a nicer format
-        fwd_chan_dict = self.nicify_fwd_chan_info(fwd_chan_dict=fwd_chan_dict)
+        fwd_chan_dict = self.nicify_fwd_chan_info(fwd_chan_dict=checkpoint.fwd_chan_dict)
 
         # save the channel info
         channel_info = {"channel_info": {"chan_id": chan_id,
                                          "title": title,
                                          "username": username,
                                          "verified": verified,
-                                         "nb_participants": nb_participants},
-                        "fwd_chan_dict": fwd_chan_dict}
-        filename = f"{username}-channel_info.pickle"
+                                         "nb_participants": nb_participants,
+                                         "min_msg_id": min_msg_id if min_msg_id is not None else 0,
+                                         "max_msg_id": max_msg_id if max_msg_id is not None else 0},
+                        "fwd_chan_dict": fwd_chan_dict,
+                        "linked_chan_dict": [{"chan_username": chan_username, "nb_of_links": nb_links}
+                                             for chan_username, nb_links in checkpoint.linked_chan_dict.items()]}
+        if spider_id is not None:
+            channel_info["channel_info"]["spider_id"] = spider_id
+        filename = f"{username}-{chan_id}-channel_info{SPOOL_EXTENSION}"
         filepath = os.path.join(DATA_STORAGE_FOLDER, filename)
-        self._save_processed_info(data=channel_info, path=filepath)
+        await asyncio.to_thread(self._write_file, encode_channel_info(channel_info), filepath)
+        if checkpoint_path is not None:
+            checkpoint.remove()
+        for session in self.pool.sessions:
+            log.info(f"Entity cache of {session.name}: {session.client.entity_cache.stats()}")
+        log.info(f"Session pool: {self.pool.stats()}")
+        log.info(f"Pipeline: {self.stats.stats()}")
+        if PROCESS_WORKERS == 0:
+            # with worker processes, the URLs are parsed and cached in them: this process' cache stays empty
+            log.info(f"Hostname cache: {hostname_cache_info()}")
+
+    async def _partitions(self, chan_id, username, min_id, watermark) -> list[tuple]:
+        """Ranges of message IDs to fetch, see partition_ranges. The ID of the latest message is asked to Telegram."""
+        latest = await self.pool.call(
+            lambda session: session.client.get_messages_page(chan_id, limit=1, username=username),
+            skip_on=(ValueError,))
+        if not latest:
+            return [(min_id, 0)]
+        partitions = partition_ranges(latest_id=latest[0].id, min_id=min_id, watermark=watermark)
+        if len(partitions) > 1:
+            log.info(f"Channel {chan_id} partitioned: {partitions[0][1] - partitions[-1][0]} message IDs in "
+                     f"{len(partitions)} ranges")
+        return partitions
+
+    async def _fetch_chunks(self, chan_id, username, chunks: asyncio.Queue, min_id=0, max_id=0, part=0,
+                            fetch_slots=None, offset_id=0, fetched=0, **_):
+        """
+        Puts the chunks of messages of the channel (newer than `min_id`, up to `max_id` if not 0) in `chunks` as
+        (part, chunk, fetched): CHUNK_SIZE messages, the last one may be smaller or empty. Then (part, None, None) once
+        the range was fully fetched. Every page of messages is a request of its own to the session pool, the pages of a
+        channel may be fetched by different sessions.
+        :param fetch_slots: semaphore held while fetching
+        :param offset_id: resumes the fetch from there (lowest message ID already written), 0 to start from `max_id`
+        :param fetched: messages already written, counted in MAX_MSG_CRAWL
+        """
+        try:
+            async with fetch_slots if fetch_slots is not None else contextlib.nullcontext():
+                await self._fetch_range(chan_id=chan_id, username=username, chunks=chunks, min_id=min_id,
+                                        max_id=max_id, part=part, offset_id=offset_id, fetched=fetched)
+        except asyncio.CancelledError:
+            # crawl_channel stopped: nobody reads the queue anymore, putting in it could wait forever
+            raise
+        except BaseException:
+            # sent on error, crawl_channel then gets the error when awaiting this task
+            await chunks.put((part, None, None))
+            raise
+        else:
+            await chunks.put((part, None, None))
+
+    async def _fetch_range(self, chan_id, username, chunks: asyncio.Queue, min_id, max_id, part, offset_id, fetched):
+        buffer = []
+        # messages fetched up to each message of the buffer, the ones without text included (counted in MAX_MSG_CRAWL)
+        buffer_fetched = []
+        # messages older than offset_id are returned
+        if not offset_id and max_id:
+            offset_id = max_id + 1
+        while fetched < MAX_MSG_CRAWL:
+            limit = min(PAGE_SIZE, MAX_MSG_CRAWL - fetched)
+            with self.stats["fetch"].working():
+                page = await self.pool.call(
+                    lambda session: session.client.get_messages_page(chan_id, offset_id=offset_id, limit=limit,
+                                                                     username=username, min_id=min_id),
+                    skip_on=(ValueError,))
+            if not page:
+                break
+            offset_id = page[-1].id
+            last_page = len(page) < limit
+            # skipping messages with no text (admin decision to change names, only images, etc.). The Telethon messages
+            # are converted right away and dropped: only the compact records wait in the buffer and the pipeline.
+            for nb_fetched, msg in enumerate(page, start=fetched + 1):
+                if msg.raw_text is not None:
+                    buffer.append(PostRecord.from_message(msg, error_flag=ERROR_GETTING_NAME_FLAG))
+                    buffer_fetched.append(nb_fetched)
+            fetched += len(page)
+            del page
+            while len(buffer) >= CHUNK_SIZE:
+                await self._put_chunk(chunks, part, buffer[:CHUNK_SIZE], fetched=buffer_fetched[CHUNK_SIZE - 1])
+                buffer = buffer[CHUNK_SIZE:]
+                buffer_fetched = buffer_fetched[CHUNK_SIZE:]
+            if last_page:
+                break
+        # the last chunk will probably not be the exact buffer size, we still need to put it
+        await self._put_chunk(chunks, part, buffer, fetched=fetched)
+
+    async def _put_chunk(self, chunks: asyncio.Queue, part, chunk, fetched):
+        """:param fetched: messages of the range fetched up to the last one of the chunk, see CrawlCheckpoint"""
+        # backpressure: the fetch waits here while the process and write stages are behind
+        with self.stats["fetch"].blocking():
+            await chunks.put((part, chunk, fetched))
+        self.stats["fetch"].add(chunks=1, messages=len(chunk))
+
+    async def _process_chunks(self, chan_id, username, watermark, chunks: asyncio.Queue, processed: asyncio.Queue,
+                              fetchers: dict, checkpoint: CrawlCheckpoint):
+        """
+        Process stage of the crawl: hands the chunks fetched to the worker processes (see process_chunk) and passes
+        them on to the write stage as (part, chunk index, chunk, fetched, future of the result), in the order they were
+        fetched. Then (part, None, None, None, None) once a range was fully fetched.
+        """
+        loop = asyncio.get_running_loop()
+        # index of the next chunk of each range
+        next_chunk = {part: checkpoint.partitions[part]["next_chunk"] for part in fetchers}
+        finished = 0
+        while finished < len(fetchers):
+            part, chunk, fetched = await chunks.get()
+            if chunk is None:
+                # raises the error of the fetcher, if any
+                await fetchers[part]
+                await processed.put((part, None, None, None, None))
+                finished += 1
+                continue
+            log.info(f"Processing chunk #{next_chunk[part]} of {chan_id} (part {part})")
+            processing = loop.run_in_executor(self.executor, process_chunk, chan_id, chunk, watermark, username)
+            # waits while PIPELINE_DEPTH + PROCESS_WORKERS chunks are being processed or written: the raw chunks queue
+            # fills up and the fetch waits too
+            await processed.put((part, next_chunk[part], chunk, fetched, processing))
+            next_chunk[part] += 1
+
+    async def _write_chunks(self, chan_id, username, processed: asyncio.Queue, checkpoint: CrawlCheckpoint,
+                            checkpoint_path):
+        """Write stage of the crawl: saves the chunks processed and the progress of the crawl, in the fetch order."""
+        nb_parts = len(checkpoint.partitions)
+        nb_todo = sum(not partition["done"] for partition in checkpoint.partitions)
+        finished = 0
+        while finished < nb_todo:
+            with self.stats["write"].blocking():
+                part, count, chunk, fetched, processing = await processed.get()
+                if processing is not None:
+                    data, forwarded_channels, linked_channels, new_posts, seconds = await processing
+            if chunk is None:
+                checkpoint.part_done(part)
+                if checkpoint_path is not None:
+                    await asyncio.to_thread(checkpoint.save)
+                finished += 1
+                continue
+            self.stats["process"].add(chunks=1, messages=len(chunk), busy=seconds)
+
+            with self.stats["write"].working():
+                log.info(f"Saving chunk #{count} of {chan_id} (part {part})")
+                # the chan_id keeps apart the files of channels without username crawled at the same time
+                if nb_parts == 1:
+                    filename = f"{username}-{chan_id}-chunk_{count}{SPOOL_EXTENSION}"
+                else:
+                    filename = f"{username}-{chan_id}-part_{part}-chunk_{count}{SPOOL_EXTENSION}"
+                filepath = os.path.join(DATA_STORAGE_FOLDER, filename)
+                await asyncio.to_thread(self._write_file, data, filepath)
+                # a crash before the checkpoint is saved only means this chunk is fetched and written again
+                checkpoint.chunk_written(part, messages=chunk, forwarded_channels=forwarded_channels,
+                                         linked_channels=linked_channels, new_posts=new_posts, fetched=fetched)
+                if checkpoint_path is not None:
+                    await asyncio.to_thread(checkpoint.save)
+            self.stats["write"].add(chunks=1, messages=len(chunk))
+
+    async def crawl_file(self, fpath):
+        """
+        Crawls the channel of the file `fpath` (written by the dispatcher), removes it once done. The file holds
+        {"chan_id": int, "max_msg_id": int, "spider_id": str} in JSON, or only the channel ID (older dispatchers).
+
+        The progress of the crawl is saved in `<fpath>.checkpoint`. A `.crawling` file (crawl interrupted by a crash
+        or a restart) is crawled again from its checkpoint.
+        """
+        if fpath.endswith(".crawling"):
+            new_fpath = fpath
+            fpath = fpath.removesuffix(".crawling")
+        else:
+            new_fpath = fpath + ".crawling"
+            # we rename the file containing the username we are currently crawling
+            os.rename(src=fpath, dst=new_fpath)
+        with open(new_fpath, 'r') as g:
+            content = json.load(g)
+        if isinstance(content, int):
+            content = {"chan_id": content, "max_msg_id": 0}
+        channel_id = content["chan_id"]
+        max_msg_id = content.get("max_msg_id", 0)
+        log.info(f"Channel ID from {fpath} => {channel_id} (messages ingested up to {max_msg_id}). Crawling it.")
+        try:
+            await self.crawl_channel(chan_id=channel_id, watermark=max_msg_id, checkpoint_path=fpath + ".checkpoint",
+                                     spider_id=content.get("spider_id"))
+        except Exception as err:
+            log.error(f"Error while crawling {channel_id}")
+            raise err
+        else:
+            os.remove(new_fpath)
+
+    async def run(self):
+        """
+        Crawls the channels dispatched to the spider, CRAWL_CONCURRENCY at the same time. The crawls interrupted by
+        the previous run (.crawling files) are resumed first. Sleeps until a crawl finishes or, with a free slot, until
+        the dispatcher adds a file.
+        """
+        crawls = set()
+        # created before the first listing: the files added in the meantime wake up the first wait
+        watcher = FolderWatcher(USERNAME_STORAGE_FOLDER, accept=is_dispatched_file, polling=WATCH_POLLING,
+                                poll_interval=WATCH_POLL_INTERVAL)
+        # interrupted crawls, once started they are like any other crawl
+        to_resume = sorted(os.path.join(USERNAME_STORAGE_FOLDER, fname)
+                           for fname in os.listdir(USERNAME_STORAGE_FOLDER) if fname.endswith(".crawling"))
+        try:
+            while True:
+                while to_resume and len(crawls) < CRAWL_CONCURRENCY:
+                    fpath = to_resume.pop()
+                    log.info(f"Resuming interrupted crawl {fpath}")
+                    crawls.add(asyncio.create_task(self.crawl_file(fpath)))
+                for fname in os.listdir(USERNAME_STORAGE_FOLDER):
+                    if len(crawls) >= CRAWL_CONCURRENCY or to_resume:
+                        break
+                    if not is_dispatched_file(fname):
+                        continue
+                    log.info(f"Found file {fname}")
+                    crawls.add(asyncio.create_task(self.crawl_file(os.path.join(USERNAME_STORAGE_FOLDER, fname))))
+
+                waits = set(crawls)
+                new_file = None
+                if len(crawls) < CRAWL_CONCURRENCY:
+                    new_file = asyncio.create_task(watcher.wait_async())
+                    waits.add(new_file)
+                # a free slot is filled as soon as a crawl finishes
+                done, _ = await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+                if new_file is not None:
+                    new_file.cancel()
+                for crawl in done & crawls:
+                    crawls.remove(crawl)
+                    # a failed crawl stops the crawler, as it always did
+                    crawl.result()
+        finally:
+            watcher.close()
 
     @classmethod
-    def _process_posts(cls, posts: list, tl_client) -> tuple[dict[int:dict], defaultdict[str, int]]:
+    def _process_posts(cls, posts: list, count_forwards_after=0, own_username="") -> tuple[dict[int:dict],
+                                                                                         defaultdict[str, int],
+                                                                                         defaultdict[str, int]]:
         """
-        Transforms the post object into a dictionary and a default dict with the channel which message are
-        forwarded in these posts.
-        Message API:
-        https://docs.telethon.dev/en/stable/quick-references/objects-reference.html?highlight=message#message
-        :param posts:
+        Transforms the post object into a dictionary, a default dict with the channel which message are
+        forwarded in these posts and one with the channels linked (t.me links) in these posts. Only the posts whose ID
+        is above `count_forwards_after` are counted.
+        :param posts: PostRecord (see _fetch_range)
+        :param own_username: username of the channel crawled, its links to itself aren't counted
         :return:
         """
         processed_posts = {}
         forwarded_channels = defaultdict(int)
+        linked_channels = defaultdict(int)
+        own_username = own_username.lower()
         for po in posts:
             try:
-                urls = [m.group(0) for m in cls.http_url_reg.finditer(po.text)]
-                domains = [cls.extract_domain_from_url(url) for url in urls]
+                # URLs, domains, t.me links, mentions and hashtags in a single scan of the text
+                urls, domains, tme_links, mentions, hashtags = extract(po.text)
 
                 # Never use a key that begins with "_", it will mess up the bulk index process in esinter.py
 
                 info = {"text": po.text,
                         # "forward": None,
                         "forwards": po.forwards,  # nb of time this post was forwarded
+                        "views": po.views,
                         "reply": po.is_reply,
                         "id": po.id,
                         "forwarded_from": "",
                         "urls": urls,
                         "domains": domains,
-                        "date": int(po.date.timestamp())}
-
-                if po.forward is not None and po.forward.chat is not None:
-                    # if this message is forwarded from a convo with a user, the info will be in forward.sender.first_name.
-                    # Thus, this will fail.
-                    try:
-                        fwd_chan_username = po.forward.chat.username
-                        fwd_chan_id = po.forward.chat_id
-
-                        # sometimes username is none, we want to keep the same type of data in the dict though
-                        fwd_chan_username = fwd_chan_username if fwd_chan_username is not None else ""
-
-                    except AttributeError as err:
-                        log.warning(f"Error getting fwd chan name: {err}")
-                        log.exception(err)
-                        log.warning("Post info below")
-                        for key, val in vars(po).items():
-                            log.warning(f"{key}: \t{val}")
-                        fwd_chan_username = ERROR_GETTING_NAME_FLAG
+                        "tme_links": tme_links,
+                        "mentions": mentions,
+                        "hashtags": hashtags,
+                        "date": po.date}
+
+                if po.fwd_chan_id is not None:
+                    fwd_chan_username = po.fwd_chan_username
+                    fwd_chan_id = po.fwd_chan_id
                     info["forwarded_from"] = str(fwd_chan_id)
-                    if fwd_chan_username != ERROR_GETTING_NAME_FLAG:
+                    if fwd_chan_username != ERROR_GETTING_NAME_FLAG and po.id > count_forwards_after:
                         forwarded_channels[(fwd_chan_username, fwd_chan_id)] += 1
+                if po.id > count_forwards_after:
+                    for linked_username in tme_links:
+                        # usernames are case-insensitive: t.me/Name and t.me/name count for the same channel
+                        if linked_username.lower() != own_username:
+                            linked_channels[linked_username.lower()] += 1
 
                 processed_posts[po.id] = info
             except Exception as e:
                 log.error(f"Exception raised when processing post: {e}. See raw posts underneath.")
-                for key, val in vars(po).items():
+                for key, val in po.as_dict().items():
                     log.error(f"{key}: \t{val}")
                 raise e
-        return processed_posts, forwarded_channels
+        return processed_posts, forwarded_channels, linked_channels
 
     @staticmethod
-    def _save_processed_info(data, path):
+    def _write_file(content: bytes, path):
         log.info(f"Saving data at {path}")
         finished_path = path
         temp_path = path + ".TEMP"
         # we write the file with a temporary filename, then change it once file is completely written. Else the
         # dispatcher will attempt to read it before it's done.
         with open(temp_path, "wb") as f:
-            pickle.dump(data, file=f)
+            f.write(content)
         os.rename(temp_path, finished_path)
 
-    @staticmethod
-    def extract_domain_from_url(url):
-        try:
-            return urlparse(url=url).hostname
-        except Exception as err:
-            log.error(f"Coulnd't get domain from URL: {url}. Skipping.")
-            log.exception(err)
-
     @staticmethod
     def nicify_fwd_chan_info(fwd_chan_dict: dict) -> list[dict]:
         """
@@ -181,28 +510,60 @@ class Spider:
         return ret
 
 
+def is_dispatched_file(fname):
+    """Files written by the dispatcher, not the files marked as being crawled nor the checkpoints of the crawls"""
+    return not (fname.endswith(".crawling") or fname.endswith(".checkpoint") or fname.endswith(".TEMP"))
+
+
+def partition_ranges(latest_id, min_id, watermark) -> list[tuple]:
+    """
+    Ranges of message IDs to fetch: [(range_min, range_max), ...], each range holding the messages whose ID is above
+    range_min and up to range_max (0: no upper bound).
+
+    Message IDs are sequential in a channel (minus the deleted messages), the ID of the latest message tells how many
+    messages are to be fetched. A channel never crawled (watermark 0) has its MAX_MSG_CRAWL latest message IDs fetched.
+    A channel crawled before has the MAX_MSG_CRAWL message IDs after `min_id` fetched, its oldest new messages first:
+    if more were posted, the next crawl goes on from the new watermark, no message is skipped.
+
+    Up to PARTITION_THRESHOLD message IDs, a single range: fetched from its highest message as usual. Above, the
+    message IDs are split in ranges of PARTITION_SIZE.
+    :param latest_id: ID of the latest message of the channel
+    :param min_id: only the messages after it are fetched
+    :param watermark: highest message ID already ingested, 0 if none
+    """
+    highest_id = min(latest_id, min_id + MAX_MSG_CRAWL) if watermark else latest_id
+    lowest_id = max(min_id, highest_id - MAX_MSG_CRAWL)
+    if highest_id - lowest_id <= PARTITION_THRESHOLD:
+        return [(min_id, highest_id if highest_id < latest_id else 0)]
+    return [(max(lowest_id, range_max - PARTITION_SIZE), range_max)
+            for range_max in range(highest_id, lowest_id, -PARTITION_SIZE)]
+
+
+def process_chunk(chan_id, chunk: list, watermark, username) -> tuple:
+    """
+    Processes a chunk of PostRecord (see Spider._process_posts) and encodes the posts as a spool file (see
+    shared/spool.py). Run by the worker processes: only the encoded posts and the counters go back to the crawler.
+    :return: (spool file of the posts, forwarded channels, linked channels, IDs of the posts above the watermark,
+    seconds spent)
+    """
+    start = time.perf_counter()
+    processed_posts, forwarded_channels, linked_channels = Spider._process_posts(chunk, count_forwards_after=watermark,
+                                                                                 own_username=username)
+    # the posts of the refresh window were already counted
+    new_posts = [post_id for post_id in processed_posts if post_id > watermark]
+    data = encode_posts(chan_id, processed_posts)
+    return data, forwarded_channels, linked_channels, new_posts, time.perf_counter() - start
+
+
+async def main():
+    spd = Spider()
+    await spd.start()
+    try:
+        await spd.run()
+    finally:
+        await spd.close()
+
+
 if __name__ == '__main__':
     log.info("=================================== Crawler started! ===================================")
-    while True:
-        spd = Spider()
-        for fname in os.listdir(USERNAME_STORAGE_FOLDER):
-            log.info(f"Found file {fname}")
-            fpath = os.path.join(USERNAME_STORAGE_FOLDER, fname)
-            # we don't take into account file marked as being used in a crawl
-            if fpath.endswith(".crawling"):
-                continue
-            with open(fpath, 'r') as g:
-                channel_id = int(g.read())
-            log.info(f"Channel ID from {fname} => {channel_id}. Crawling it.")
-            # we rename the file containing the username we are currently crawling
-            new_fpath = fpath + ".crawling"
-            os.rename(src=fpath, dst=new_fpath)
-            try:
-                spd.crawl_channel(chan_id=channel_id)
-            except Exception as err:
-                log.error(f"Error while crawling {channel_id}")
-                raise err
-            else:
-                os.remove(new_fpath)
-
-        time.sleep(2)
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+import time
+import sqlite3
+import logging
+from collections import OrderedDict, namedtuple
+
+log = logging.getLogger(__name__)
+
+CachedEntity = namedtuple('CachedEntity', ["id", "access_hash", "username", "title"])
+
+
+class EntityCache:
+    """
+    LRU cache of the channels resolved by a Telegram session (id -> access hash, username, title), kept in memory and
+    saved in a SQLite file so it survives restarts.
+
+    With the access hash, a channel can be used (crawled, its info fetched) without asking Telegram to resolve it
+    again. Access hashes are only valid for the account that obtained them: entries are stored per session.
+    """
+
+    def __init__(self, path: str, session: str, max_size: int):
+        self.session = session
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entities = OrderedDict()     # id: CachedEntity, least recently used first
+        self._usernames = {}               # lowercase username: id
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entities ("
+                           "session TEXT NOT NULL, "
+                           "id INTEGER NOT NULL, "
+                           "access_hash INTEGER NOT NULL, "
+                           "username TEXT, "
+                           "title TEXT, "
+                           "last_used REAL NOT NULL, "
+                           "PRIMARY KEY (session, id))")
+        rows = self._conn.execute("SELECT id, access_hash, username, title FROM entities WHERE session = ? "
+                                  "ORDER BY last_used DESC LIMIT ?", (session, max_size)).fetchall()
+        for row in reversed(rows):
+            self._add(CachedEntity(*row))
+        log.info(f"Entity cache loaded from {path}: {len(self._entities)} entities")
+
+    def __len__(self):
+        return len(self._entities)
+
+    def get(self, name_or_id):
+        """Returns the CachedEntity of a channel ID or username, None if it isn't cached."""
+        if isinstance(name_or_id, str):
+            entity_id = self._usernames.get(name_or_id.lower())
+        else:
+            entity_id = name_or_id
+        entity = self._entities.get(entity_id)
+        if entity is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entities.move_to_end(entity_id)
+        self._conn.execute("UPDATE entities SET last_used = ? WHERE session = ? AND id = ?",
+                           (time.time(), self.session, entity_id))
+        return entity
+
+    def put(self, entity_id: int, access_hash: int, username: str, title: str):
+        entity = CachedEntity(entity_id, access_hash, username, title)
+        if self._entities.get(entity_id) == entity:
+            # already known, saves a write
+            self._entities.move_to_end(entity_id)
+            return
+        self._add(entity)
+        self._conn.execute("INSERT OR REPLACE INTO entities (session, id, access_hash, username, title, last_used) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", (self.session, *entity, time.time()))
+        while len(self._entities) > self.max_size:
+            evicted_id, evicted = self._entities.popitem(last=False)
+            self._forget_username(evicted)
+            self._conn.execute("DELETE FROM entities WHERE session = ? AND id = ?", (self.session, evicted_id))
+
+    def _add(self, entity: CachedEntity):
+        previous = self._entities.pop(entity.id, None)
+        if previous is not None:
+            self._forget_username(previous)
+        self._entities[entity.id] = entity
+        if entity.username:
+            self._usernames[entity.username.lower()] = entity.id
+
+    def _forget_username(self, entity: CachedEntity):
+        if entity.username and self._usernames.get(entity.username.lower()) == entity.id:
+            del self._usernames[entity.username.lower()]
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {"entities": len(self._entities), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hit_rate(), 3)}
+
+    def close(self):
+        self._conn.close()
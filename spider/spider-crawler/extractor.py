@@ -0,0 +1,99 @@
+import re
+import logging
+from functools import lru_cache
+from collections import namedtuple
+from urllib.parse import urlparse
+
+log = logging.getLogger(__name__)
+
+Extraction = namedtuple('Extraction', ["urls", "domains", "tme_links", "mentions", "hashtags"])
+
+# Size of the cache of the hostnames parsed, the same domains come back in most posts
+HOSTNAME_CACHE_SIZE = 4096
+
+# One pattern for everything that is extracted, each post is scanned once. At a given position the alternatives are
+# tried in order: a t.me link starting with http(s) is a URL (its channel is read from the URL afterwards), the
+# fragment of a URL is not a hashtag, etc.
+TOKEN_REG = re.compile(
+    # same URLs as the crawler always extracted
+    r"(?P<url>https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*))"
+    # t.me links written without http(s)://
+    r"|(?<![\w./@])(?:www\.)?(?:t|telegram)\.me/(?P<tme_path>[a-zA-Z0-9_+/]+)"
+    # not the end of an email address
+    r"|(?<![\w@])@(?P<mention>[a-zA-Z]\w{3,31})\b"
+    r"|(?<![\w#&])#(?P<hashtag>\w*[^\W\d]\w*)"
+)
+NETLOC_REG = re.compile(r"[^/?#]*")
+TME_HOSTS = {"t.me", "www.t.me", "telegram.me", "www.telegram.me"}
+# first part of a t.me path that isn't a public channel (private invites, stickers, previews...)
+TME_RESERVED = {"joinchat", "addstickers", "addemoji", "addlist", "share", "proxy", "socks", "iv", "c", "s", "boost",
+                "setlanguage", "addtheme", "login", "confirmphone", "invoice", "contact", "bg", "m"}
+TME_USERNAME_REG = re.compile(r"[a-zA-Z]\w{3,31}")
+
+
+@lru_cache(maxsize=HOSTNAME_CACHE_SIZE)
+def _hostname(netloc: str):
+    try:
+        return urlparse(f"http://{netloc}").hostname
+    except Exception as err:
+        log.error(f"Couldn't get domain from netloc: {netloc}. Skipping.")
+        log.exception(err)
+
+
+def _split_url(url: str) -> tuple:
+    """(hostname, path) of a URL matched by TOKEN_REG, the hostname being memoized on the network location."""
+    netloc_start = url.find("//") + 2
+    netloc_end = NETLOC_REG.match(url, netloc_start).end()
+    return _hostname(url[netloc_start:netloc_end]), url[netloc_end:]
+
+
+def extract_domain_from_url(url: str):
+    """Same as urlparse(url).hostname, memoized."""
+    return _split_url(url)[0]
+
+
+def tme_channel(path: str):
+    """Username of the public channel a t.me path points to (ex: "channel/123", "s/channel"), None if there is none."""
+    parts = path.split("?", 1)[0].split("#", 1)[0].strip("/").split("/")
+    if parts[0] == "s" and len(parts) > 1:
+        # web preview of a channel: t.me/s/<channel>
+        parts = parts[1:]
+    if parts[0].lower() in TME_RESERVED or not TME_USERNAME_REG.fullmatch(parts[0]):
+        return None
+    return parts[0]
+
+
+def extract(text: str) -> Extraction:
+    """
+    URLs (with their hostname), channels of the t.me links, @mentions and #hashtags of a post, in a single scan.
+    Every list is in the order of the text, duplicates included.
+    """
+    urls = []
+    domains = []
+    tme_links = []
+    mentions = []
+    hashtags = []
+    for match in TOKEN_REG.finditer(text):
+        kind = match.lastgroup
+        if kind == "url":
+            url = match.group("url")
+            domain, path = _split_url(url)
+            urls.append(url)
+            domains.append(domain)
+            if domain in TME_HOSTS:
+                channel = tme_channel(path)
+                if channel is not None:
+                    tme_links.append(channel)
+        elif kind == "tme_path":
+            channel = tme_channel(match.group("tme_path"))
+            if channel is not None:
+                tme_links.append(channel)
+        elif kind == "mention":
+            mentions.append(match.group("mention"))
+        else:
+            hashtags.append(match.group("hashtag"))
+    return Extraction(urls, domains, tme_links, mentions, hashtags)
+
+
+def hostname_cache_info():
+    return _hostname.cache_info()
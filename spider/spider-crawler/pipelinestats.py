@@ -0,0 +1,74 @@
+import time
+import contextlib
+
+
+class StageCounter:
+    """
+    Throughput of a stage of the crawl pipeline: chunks and messages it handled, seconds spent working on them (summed
+    over the tasks or workers of the stage) and seconds spent blocked on the other stages.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = 0
+        self.messages = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def add(self, chunks=0, messages=0, busy=0.0, blocked=0.0):
+        self.chunks += chunks
+        self.messages += messages
+        self.busy += busy
+        self.blocked += blocked
+
+    @contextlib.contextmanager
+    def working(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy += time.perf_counter() - start
+
+    @contextlib.contextmanager
+    def blocking(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.blocked += time.perf_counter() - start
+
+    def stats(self) -> dict:
+        return {"chunks": self.chunks,
+                "messages": self.messages,
+                "busy": round(self.busy, 2),
+                "blocked": round(self.blocked, 2),
+                # what a single task/worker of the stage handles per second
+                "msg_per_busy_s": round(self.messages / self.busy, 1) if self.busy else 0.0}
+
+
+class PipelineStats:
+    """
+    Counters of the stages of the crawl pipeline, for all the channels crawled since the crawler started:
+        - fetch: pages requested to the session pool, blocked when the queue of raw chunks is full (backpressure)
+        - process: chunks turned into posts and serialized, by the worker processes (or threads)
+        - write: chunks and checkpoints written, blocked when waiting for the process stage
+
+    The slowest stage is the one with the lowest msg_per_busy_s times its number of tasks/workers. A fetch stage
+    blocked most of the time means the processing or the disk can't keep up, a write stage blocked most of the time
+    means they wait for Telegram.
+    """
+    STAGES = ("fetch", "process", "write")
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {name: StageCounter(name) for name in self.STAGES}
+
+    def __getitem__(self, name) -> StageCounter:
+        return self.stages[name]
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        stats = {name: stage.stats() for name, stage in self.stages.items()}
+        stats["elapsed"] = round(elapsed, 1)
+        stats["msg_per_s"] = round(self.stages["write"].messages / elapsed, 1) if elapsed else 0.0
+        return stats
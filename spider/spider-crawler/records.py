@@ -0,0 +1,60 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PostRecord:
+    """
+    What the crawler keeps of a Telegram message. A Telethon Message holds its media, entities, raw TL objects and a
+    reference to the client: messages are converted to records as soon as they are fetched so chunks only hold these.
+    """
+    __slots__ = ("id", "text", "forwards", "views", "is_reply", "date", "fwd_chan_id", "fwd_chan_username")
+
+    def __init__(self, id, text, forwards, views, is_reply, date, fwd_chan_id=None, fwd_chan_username=None):
+        self.id = id
+        self.text = text
+        self.forwards = forwards
+        self.views = views
+        self.is_reply = is_reply
+        self.date = date                            # timestamp
+        self.fwd_chan_id = fwd_chan_id              # None if the message isn't forwarded from a channel
+        self.fwd_chan_username = fwd_chan_username  # "" if the channel has no username
+
+    @classmethod
+    def from_message(cls, msg, error_flag=None):
+        """
+        :param msg: Telethon Message
+        :param error_flag: username given to the forwarded channels whose username can't be read
+        (ERROR_GETTING_NAME_FLAG of the crawler)
+        """
+        fwd_chan_id = None
+        fwd_chan_username = None
+        if msg.forward is not None and msg.forward.chat is not None:
+            fwd_chan_id = msg.forward.chat_id
+            # if this message is forwarded from a convo with a user, the info will be in forward.sender.first_name.
+            # Thus, this will fail.
+            try:
+                fwd_chan_username = msg.forward.chat.username
+                # sometimes username is none, we want to keep the same type of data in the dict though
+                fwd_chan_username = fwd_chan_username if fwd_chan_username is not None else ""
+            except AttributeError as err:
+                log.warning(f"Error getting fwd chan name: {err}")
+                log.exception(err)
+                log.warning("Post info below")
+                for key, val in vars(msg).items():
+                    log.warning(f"{key}: \t{val}")
+                fwd_chan_username = error_flag
+        return cls(id=msg.id,
+                   text=msg.text,
+                   forwards=msg.forwards,
+                   views=msg.views if msg.views is not None else 0,
+                   is_reply=msg.is_reply,
+                   date=int(msg.date.timestamp()),
+                   fwd_chan_id=fwd_chan_id,
+                   fwd_chan_username=fwd_chan_username)
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"PostRecord({self.as_dict()})"
@@ -0,0 +1,138 @@
+import time
+import asyncio
+import logging
+
+from telethon.errors import FloodWaitError
+
+log = logging.getLogger(__name__)
+
+
+class NoSessionAvailable(Exception):
+    "Raised when every session of the pool was excluded for a request"
+    pass
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, in bursts of `capacity` requests at most."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, now) -> float:
+        """Seconds until a request is allowed."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class PooledSession:
+    """A Telegram session (telegram.Client) of the pool, with its rate limit and what we learned about it."""
+
+    def __init__(self, name, client, rate: float, burst: float):
+        self.name = name
+        self.client = client
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate=rate, capacity=burst)
+        # no request is sent through the session before that time (time.monotonic), set by flood waits
+        self.penalty_until = 0.0
+        self.requests = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    def available_in(self, now) -> float:
+        return max(self.penalty_until - now, self.bucket.wait_time(now))
+
+    def stats(self) -> dict:
+        return {"requests": self.requests,
+                "rate": round(self.bucket.rate, 3),
+                "flood_waits": self.flood_waits,
+                "flood_wait_seconds": self.flood_wait_seconds,
+                "penalised_for": round(max(0.0, self.penalty_until - time.monotonic()), 1)}
+
+
+class SessionPool:
+    """
+    Spreads the requests of the crawler over several Telegram sessions (accounts), each request goes to the session
+    available the soonest.
+
+    A token bucket limits the rate of requests of each session. When Telegram answers with a FloodWaitError, the session
+    gets no request until the wait is over and its rate is halved. Each successful request then gives back a little of
+    the configured rate: every session converges to the rate its account can sustain, and a penalised session doesn't
+    stall the crawls, they go on with the other sessions.
+    """
+    # part of the configured rate given back after each successful request, and lowest rate after flood waits
+    RATE_INCREASE = 0.05
+    MIN_RATE = 0.05
+
+    def __init__(self, sessions: list[PooledSession]):
+        self.sessions = sessions
+
+    async def acquire(self, exclude=()) -> PooledSession:
+        """Waits for the session available the soonest (not in `exclude`, a set of names) and takes a token."""
+        while True:
+            candidates = [session for session in self.sessions if session.name not in exclude]
+            if not candidates:
+                raise NoSessionAvailable
+            now = time.monotonic()
+            session = min(candidates, key=lambda candidate: candidate.available_in(now))
+            wait = session.available_in(now)
+            if wait <= 0:
+                session.bucket.take(now)
+                session.requests += 1
+                return session
+            # other requests may take the token meanwhile, the choice is made again after waiting
+            await asyncio.sleep(wait)
+
+    def report_flood_wait(self, session: PooledSession, seconds: int):
+        session.penalty_until = max(session.penalty_until, time.monotonic() + seconds)
+        session.bucket.rate = max(session.max_rate * self.MIN_RATE, session.bucket.rate / 2)
+        session.flood_waits += 1
+        session.flood_wait_seconds += seconds
+        log.warning(f"Session {session.name} must wait {seconds}s (flood wait), rate lowered to "
+                    f"{session.bucket.rate:.3f} requests/s")
+
+    def report_success(self, session: PooledSession):
+        session.bucket.rate = min(session.max_rate, session.bucket.rate + session.max_rate * self.RATE_INCREASE)
+
+    async def call(self, request, skip_on=()):
+        """
+        Returns `await request(session)`, sent through the session available the soonest. On a FloodWaitError the
+        session is penalised and the request is sent again, through another session if one is available sooner.
+        :param request: coroutine function taking a PooledSession
+        :param skip_on: exceptions meaning the session can't handle this request (ex: channel unknown to the account),
+        it is then sent through the other sessions. The last one is raised if none can.
+        """
+        excluded = set()
+        last_error = None
+        while True:
+            try:
+                session = await self.acquire(exclude=excluded)
+            except NoSessionAvailable:
+                if last_error is None:
+                    raise
+                raise last_error
+            try:
+                result = await request(session)
+            except FloodWaitError as err:
+                self.report_flood_wait(session, err.seconds)
+                continue
+            except skip_on as err:
+                log.info(f"Session {session.name} can't handle the request ({err}), trying another one")
+                excluded.add(session.name)
+                last_error = err
+                continue
+            self.report_success(session)
+            return result
+
+    def stats(self) -> dict:
+        return {session.name: session.stats() for session in self.sessions}
@@ -2,9 +2,9 @@ import json
 import pickle
 import logging
 
-from telethon.utils import get_display_name
-from telethon.tl.types import PeerChannel, PeerChat, Message
-from telethon.sync import TelegramClient
+from telethon.utils import get_display_name, get_peer_id, resolve_id
+from telethon.tl.types import PeerChannel, PeerChat, Message, Channel, InputPeerChannel
+from telethon import TelegramClient
 from telethon.hints import Entity
 
 log = logging.getLogger(__name__)
@@ -18,43 +18,112 @@ ChannelInfo = namedtuple('ChannelInfo', ["id", "title", "username", "verified",
 # https://www.google.com/search?q=get+bot+token+telegram&oq=get+bot+token+telegram&aqs=chrome..69i57.11334j0j1&sourceid=chrome&ie=UTF-8
 
 class Client:
-    def __init__(self, session_name, api_id, api_hash, max_msg_crawl, chunk_size):
-        self.client = TelegramClient(session_name, api_id=api_id, api_hash=api_hash)
+    def __init__(self, session_name, api_id, api_hash, max_msg_crawl, chunk_size, entity_cache=None,
+                 flood_sleep_threshold=60):
+        """
+        Asyncio client, several channels can be crawled at the same time over its single connection. To be created
+        inside the event loop, then start() connects to Telegram once for the whole life of the crawler (Telethon
+        reconnects by itself if it drops). Call close() when done.
+        :param entity_cache: EntityCache of the session, channels found in it are used without resolving them.
+        :param flood_sleep_threshold: Telethon sleeps by itself on flood waits up to that many seconds, longer ones
+        raise a FloodWaitError. 0 to always get the error (ex: when a SessionPool handles them).
+        """
+        self.client = TelegramClient(session_name, api_id=api_id, api_hash=api_hash,
+                                     flood_sleep_threshold=flood_sleep_threshold)
         self.MAX_MSG_CRAWL = max_msg_crawl
         self.CHUNK_SIZE = chunk_size
-
-    def _get_channel_entity(self, name_or_id):
+        self.entity_cache = entity_cache
+
+    async def start(self):
+        await self.client.start()
+
+    async def close(self):
+        await self.client.disconnect()
+        if self.entity_cache is not None:
+            self.entity_cache.close()
+
+    def remember_entity(self, entity):
+        """Adds a channel to the entity cache, ex: the channels the crawled posts are forwarded from."""
+        # "min" channels come with an access hash we can't use
+        if self.entity_cache is None or not isinstance(entity, Channel) or entity.min or entity.access_hash is None:
+            return
+        self.entity_cache.put(entity_id=get_peer_id(entity), access_hash=entity.access_hash, username=entity.username,
+                              title=entity.title)
+
+    def _get_cached_input_channel(self, name_or_id):
+        """InputPeerChannel built from the entity cache, None if the channel isn't in it."""
+        if self.entity_cache is None:
+            return None
+        if isinstance(name_or_id, int) and name_or_id > 0:
+            # bare channel ID (ex: Channel.id), the cache is keyed by the marked ID (-100...)
+            name_or_id = get_peer_id(PeerChannel(name_or_id))
+        cached = self.entity_cache.get(name_or_id)
+        if cached is None:
+            return None
+        return InputPeerChannel(channel_id=resolve_id(cached.id)[0], access_hash=cached.access_hash)
+
+    async def _get_channel_entity(self, name_or_id):
         try:
-            with self.client:
-                res = self.client.get_entity(name_or_id)
+            res = await self.client.get_entity(name_or_id)
             if res is None:
                 raise Exception(f"Error getting channel entity from {name_or_id} ({type(name_or_id)})")
             else:
+                self.remember_entity(res)
                 return res
         except ValueError as e:
             log.error(f"Could not get client info with name_or_id: {name_or_id}")
             raise e
 
-    def get_channel_info(self, name_or_id):
-        chan = self._get_channel_entity(name_or_id)
+    async def get_input_channel(self, name_or_id, username=None):
+        """
+        Input peer of a channel for this session: from the entity cache, else resolved. An ID is only known to the
+        sessions that already met the channel, the others resolve it with its `username` (if it has one).
+        """
+        input_channel = self._get_cached_input_channel(name_or_id)
+        if input_channel is not None:
+            return input_channel
+        try:
+            return await self._get_channel_entity(name_or_id=name_or_id)
+        except ValueError:
+            if not username:
+                raise
+            return await self._get_channel_entity(name_or_id=username)
+
+    async def get_messages_page(self, channel, offset_id=0, limit=100, username=None, min_id=0):
+        """
+        One request for the `limit` messages of the channel older than `offset_id` (0: the latest ones) and newer than
+        `min_id`, newest first. The channels the messages are forwarded from are added to the entity cache, they may be
+        crawled later.
+        """
+        chan = await self.get_input_channel(channel, username=username)
+        messages = await self.client.get_messages(chan, limit=limit, offset_id=offset_id, min_id=min_id)
+        for msg in messages:
+            if msg.forward is not None and msg.forward.chat is not None:
+                self.remember_entity(msg.forward.chat)
+        return messages
+
+    async def get_channel_info(self, name_or_id):
+        # the info (number of participants...) must be up to date: always asked to Telegram, but with the cached access
+        # hash a single request is enough, the channel doesn't have to be resolved first
+        input_channel = self._get_cached_input_channel(name_or_id)
+        chan = await self._get_channel_entity(input_channel if input_channel is not None else name_or_id)
         nb_participants = chan.participants_count if chan.participants_count is not None else 0
         username = chan.username if chan.username is not None else ""
 
         return ChannelInfo(chan.id, chan.title, username, chan.verified, nb_participants)
 
-    def is_channel_user(self, name_or_id):
-        if type(self._get_channel_entity(name_or_id=name_or_id)) is Entity[0]:  # Entity[0] are Telethon user
+    async def is_channel_user(self, name_or_id):
+        if type(await self._get_channel_entity(name_or_id=name_or_id)) is Entity[0]:  # Entity[0] are Telethon user
             return True
         else:
             return False
 
-    def get_users_from_channel(self, channel):
-        with self.client:
-            for user in self.client.iter_participants(entity=channel):
-                log.debug(f"User: {user}")
-                yield user
+    async def get_users_from_channel(self, channel):
+        async for user in self.client.iter_participants(entity=channel):
+            log.debug(f"User: {user}")
+            yield user
 
-    def get_messages_from_channel(self, channel, skip_no_text_msg=True, reverse=False):
+    async def get_messages_from_channel(self, channel, skip_no_text_msg=True, reverse=False):
         """
 
         :param channel: A channel Entity (obtained with _get_channel_entity)
@@ -62,15 +131,14 @@ class Client:
         :param reverse: To start from older messages, mostly here for testing.
         :return:
         """
-        with self.client:
-            for msg in self.client.iter_messages(entity=channel, limit=self.MAX_MSG_CRAWL, reverse=reverse):
-                if skip_no_text_msg is True and msg.raw_text is None:
-                    continue
-                log.debug(f"MSG raw text: {msg.raw_text[:30]}".replace('\n', ""))
+        async for msg in self.client.iter_messages(entity=channel, limit=self.MAX_MSG_CRAWL, reverse=reverse):
+            if skip_no_text_msg is True and msg.raw_text is None:
+                continue
+            log.debug(f"MSG raw text: {msg.raw_text[:30]}".replace('\n', ""))
 
-                yield msg
+            yield msg
 
-    def crawl_channel(self, channel):
+    async def crawl_channel(self, channel):
         """
         get channel
         get messages
@@ -78,9 +146,12 @@ class Client:
         :param channel: a name or ID from a channel
         :return:
         """
-        chan = self._get_channel_entity(name_or_id=channel)
+        # already resolved by get_channel_info most of the time
+        chan = self._get_cached_input_channel(channel)
+        if chan is None:
+            chan = await self._get_channel_entity(name_or_id=channel)
         buffer = []
-        for count, msg in enumerate(self.get_messages_from_channel(chan)):
+        async for msg in self.get_messages_from_channel(chan):
             buffer.append(msg)
             if len(buffer) == self.CHUNK_SIZE:
                 yield buffer
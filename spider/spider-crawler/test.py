@@ -0,0 +1,224 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+
+from telethon.errors import FloodWaitError
+
+from sessionpool import SessionPool, PooledSession, TokenBucket
+from checkpoint import CrawlCheckpoint
+from extractor import extract
+from pipelinestats import PipelineStats
+from records import PostRecord
+from spool import SpoolReader
+import crawler
+
+
+class FakeClient:
+    """Stands for a telegram.Client, answers with a FloodWaitError for the first `flood_waits` requests."""
+
+    def __init__(self, flood_waits=0, flood_wait_seconds=30, unknown_channel=False):
+        self.flood_waits = flood_waits
+        self.flood_wait_seconds = flood_wait_seconds
+        self.unknown_channel = unknown_channel
+        self.requests = 0
+
+    async def get_messages_page(self, channel, offset_id=0, limit=100, username=None):
+        self.requests += 1
+        if self.unknown_channel:
+            raise ValueError(f"Could not find the input entity for {channel}")
+        if self.flood_waits > 0:
+            self.flood_waits -= 1
+            raise FloodWaitError(request=None, capture=self.flood_wait_seconds)
+        return list(range(offset_id, offset_id + limit))
+
+
+def get_page(session):
+    return session.client.get_messages_page(1, offset_id=0, limit=3)
+
+
+class TestSessionPool(unittest.IsolatedAsyncioTestCase):
+
+    async def test_flood_wait_routes_to_other_session(self):
+        flooded = PooledSession(name="flooded", client=FakeClient(flood_waits=1), rate=100, burst=10)
+        healthy = PooledSession(name="healthy", client=FakeClient(), rate=100, burst=10)
+        # the flooded session is picked first: fuller bucket
+        healthy.bucket.tokens = 5
+        pool = SessionPool([flooded, healthy])
+
+        self.assertEqual(await pool.call(get_page), [0, 1, 2])
+        self.assertEqual(flooded.client.requests, 1)
+        self.assertEqual(healthy.client.requests, 1)
+        self.assertEqual(flooded.flood_waits, 1)
+        self.assertEqual(flooded.bucket.rate, 50)
+        self.assertGreater(flooded.stats()["penalised_for"], 25)
+
+        # penalised for 30s: the following requests all go to the other session
+        for _ in range(5):
+            await pool.call(get_page)
+        self.assertEqual(flooded.client.requests, 1)
+        self.assertEqual(healthy.client.requests, 6)
+
+    async def test_rate_recovers_after_successes(self):
+        session = PooledSession(name="session", client=FakeClient(flood_waits=1, flood_wait_seconds=0), rate=100,
+                                burst=100)
+        pool = SessionPool([session])
+        await pool.call(get_page)
+        self.assertEqual(session.bucket.rate, 100 / 2 + 100 * SessionPool.RATE_INCREASE)
+        for _ in range(20):
+            await pool.call(get_page)
+        self.assertEqual(session.bucket.rate, 100)
+
+    async def test_skip_on_tries_other_sessions(self):
+        unknown = PooledSession(name="unknown", client=FakeClient(unknown_channel=True), rate=100, burst=10)
+        known = PooledSession(name="known", client=FakeClient(), rate=100, burst=10)
+        known.bucket.tokens = 5
+        pool = SessionPool([unknown, known])
+        self.assertEqual(await pool.call(get_page, skip_on=(ValueError,)), [0, 1, 2])
+
+        # no session can handle it: the error is raised
+        pool = SessionPool([unknown])
+        with self.assertRaises(ValueError):
+            await pool.call(get_page, skip_on=(ValueError,))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = bucket._updated
+        self.assertEqual(bucket.wait_time(now), 0)
+        bucket.take(now)
+        bucket.take(now)
+        self.assertAlmostEqual(bucket.wait_time(now), 0.5)
+        self.assertEqual(bucket.wait_time(now + 0.5), 0)
+
+
+class TestCrawlCheckpoint(unittest.TestCase):
+
+    def test_resumes_from_saved_progress(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "channel.dat.checkpoint")
+            checkpoint = CrawlCheckpoint(path=path, chan_id=5, watermark=100, partitions=[(1000, 2000), (100, 1000)])
+            messages = [SimpleNamespace(id=msg_id) for msg_id in range(2000, 1900, -1)]
+            # 30 messages without text were fetched with them
+            checkpoint.chunk_written(0, messages=messages, forwarded_channels={("chan", 7): 3},
+                                     new_posts=[msg.id for msg in messages], fetched=130)
+            checkpoint.part_done(1)
+            checkpoint.save()
+
+            resumed = CrawlCheckpoint.load(path)
+            self.assertEqual(resumed.watermark, 100)
+            self.assertEqual(resumed.partitions[0]["next_chunk"], 1)
+            # the fetch goes on with the messages older than the last one written
+            self.assertEqual(resumed.partitions[0]["offset_id"], 1901)
+            self.assertEqual(resumed.partitions[0]["fetched"], 130)
+            self.assertTrue(resumed.partitions[1]["done"])
+            self.assertEqual(resumed.fwd_chan_dict[("chan", 7)], 3)
+            self.assertEqual((resumed.min_msg_id, resumed.max_msg_id), (1901, 2000))
+
+            resumed.remove()
+            self.assertIsNone(CrawlCheckpoint.load(path))
+
+
+class TestFetchChunks(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_fetch_doesnt_wait_on_full_queue(self):
+        chunks = asyncio.Queue(maxsize=1)
+        await chunks.put((0, [], 0))
+        fetching = asyncio.Event()
+
+        async def fetch_range(**_):
+            fetching.set()
+            await asyncio.sleep(3600)
+        spider = SimpleNamespace(_fetch_range=fetch_range)
+        task = asyncio.create_task(crawler.Spider._fetch_chunks(spider, chan_id=1, username="chan", chunks=chunks))
+        await fetching.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(task, timeout=1)
+
+
+@mock.patch.multiple(crawler, MAX_MSG_CRAWL=1000, PARTITION_THRESHOLD=300, PARTITION_SIZE=250)
+class TestPartitionRanges(unittest.TestCase):
+
+    def test_first_crawl_fetches_latest_messages(self):
+        self.assertEqual(crawler.partition_ranges(latest_id=200, min_id=0, watermark=0), [(0, 0)])
+        self.assertEqual(crawler.partition_ranges(latest_id=5000, min_id=0, watermark=0),
+                         [(4750, 5000), (4500, 4750), (4250, 4500), (4000, 4250)])
+
+    def test_incremental_crawl_goes_on_from_watermark(self):
+        # REFRESH_WINDOW of 50: fetched after min_id 950
+        self.assertEqual(crawler.partition_ranges(latest_id=1100, min_id=950, watermark=1000), [(950, 0)])
+        # more than MAX_MSG_CRAWL new messages: the ones right after the watermark first, the next crawl goes on
+        self.assertEqual(crawler.partition_ranges(latest_id=1200, min_id=950, watermark=1000), [(950, 0)])
+        self.assertEqual(crawler.partition_ranges(latest_id=5000, min_id=950, watermark=1000),
+                         [(1700, 1950), (1450, 1700), (1200, 1450), (950, 1200)])
+        with mock.patch.object(crawler, "PARTITION_THRESHOLD", 2000):
+            self.assertEqual(crawler.partition_ranges(latest_id=5000, min_id=950, watermark=1000), [(950, 1950)])
+
+
+class TestPipelineStats(unittest.TestCase):
+
+    def test_stage_counters(self):
+        with mock.patch('pipelinestats.time.monotonic', return_value=0):
+            stats = PipelineStats()
+        stats["process"].add(chunks=2, messages=400, busy=4.0)
+        with mock.patch('pipelinestats.time.perf_counter', side_effect=[10.0, 12.0, 20.0, 21.0]):
+            with stats["write"].blocking():
+                pass
+            with stats["write"].working():
+                stats["write"].add(chunks=2, messages=400)
+
+        with mock.patch('pipelinestats.time.monotonic', return_value=8):
+            result = stats.stats()
+        self.assertEqual(result["process"], {"chunks": 2, "messages": 400, "busy": 4.0, "blocked": 0.0,
+                                             "msg_per_busy_s": 100.0})
+        self.assertEqual(result["write"], {"chunks": 2, "messages": 400, "busy": 1.0, "blocked": 2.0,
+                                           "msg_per_busy_s": 400.0})
+        self.assertEqual(result["fetch"]["msg_per_busy_s"], 0.0)
+        # throughput of the whole pipeline: messages written
+        self.assertEqual((result["elapsed"], result["msg_per_s"]), (8, 50.0))
+
+
+class TestProcessChunk(unittest.TestCase):
+
+    def test_posts_encoded_and_new_ones_counted(self):
+        chunk = [PostRecord(id=11, text="see t.me/Other and t.me/MyChannel", forwards=1, views=10, is_reply=False,
+                            date=1700000000, fwd_chan_id=7, fwd_chan_username="source"),
+                 # refresh window: saved again, not counted again
+                 PostRecord(id=9, text="t.me/other", forwards=0, views=5, is_reply=True, date=1600000000,
+                            fwd_chan_id=7, fwd_chan_username="source")]
+        data, forwarded_channels, linked_channels, new_posts, seconds = crawler.process_chunk(
+            chan_id=5, chunk=chunk, watermark=10, username="mychannel")
+
+        self.assertEqual(dict(forwarded_channels), {("source", 7): 1})
+        # case-insensitive, links to itself not counted
+        self.assertEqual(dict(linked_channels), {"other": 1})
+        self.assertEqual(new_posts, [11])
+        self.assertGreaterEqual(seconds, 0)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "chunk")
+            with open(path, "wb") as f:
+                f.write(data)
+            with SpoolReader(path) as reader:
+                posts = reader.read()[5]
+        self.assertEqual(sorted(posts), [9, 11])
+        self.assertEqual(posts[11]["forwarded_from"], "7")
+        self.assertEqual(posts[9]["tme_links"], ["other"])
+
+
+class TestExtractor(unittest.TestCase):
+
+    def test_extract(self):
+        text = ("Read https://www.example.com/a?b=1#top and t.me/s/news_channel, see https://t.me/other_chan/12 "
+                "or t.me/joinchat/xyz. Ask @someone (not me@mail.com) #Ukraine #2024 #war2024")
+        extraction = extract(text)
+        self.assertEqual(extraction.urls, ["https://www.example.com/a?b=1#top", "https://t.me/other_chan/12"])
+        self.assertEqual(extraction.domains, ["www.example.com", "t.me"])
+        self.assertEqual(extraction.tme_links, ["news_channel", "other_chan"])
+        self.assertEqual(extraction.mentions, ["someone"])
+        self.assertEqual(extraction.hashtags, ["Ukraine", "war2024"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import os
+import json
+import math
+import random
+import socket
 import logging
 import time
 import hashlib
+import threading
 
 import requests
 
@@ -25,11 +30,16 @@ log.addHandler(stream_handler)
 log.addHandler(file_handler)
 
 
-def get_next_chan(host, port, wait_flag, relief_time) -> str:
+def backoff_delay(error_count, relief_time, max_backoff) -> float:
+    """Exponential backoff, capped at max_backoff, with full jitter so spiders don't all retry at the same time."""
+    return random.uniform(0, min(max_backoff, relief_time * 2 ** error_count))
+
+
+def get_next_chan(host, port, wait_flag, relief_time, spider_id=None) -> str:
     error_count = 0
     while True:
         try:
-            resp = requests.get(f"http://{host}:{port}/next")
+            resp = requests.get(f"http://{host}:{port}/next", params={"spider_id": spider_id})
             resp.raise_for_status()
             result = resp.text
             if result != wait_flag:
@@ -45,24 +55,173 @@ def get_next_chan(host, port, wait_flag, relief_time) -> str:
             result = wait_flag
         if result == wait_flag:
             error_count += 1
-            total_sleep = relief_time * 2 ** error_count
-            log.info(f"Got wait signal - Sleeping for {total_sleep} seconds")
+            total_sleep = backoff_delay(error_count=error_count, relief_time=relief_time, max_backoff=MAX_BACKOFF)
+            log.info(f"Got wait signal - Sleeping for {total_sleep:.1f} seconds")
             time.sleep(total_sleep)
 
 
 def store_chan_username(folder, username):
     filename = hashlib.sha256(username.encode("utf8")).hexdigest() + ".dat"
-    with open(os.path.join(folder, filename), 'w') as f:
+    filepath = os.path.join(folder, filename)
+    with open(filepath, 'w') as f:
         f.write(username)
+    return filepath
+
+
+def store_lease(folder, lease: dict, spider_id=None):
+    """
+    Writes a leased channel for the crawler: {"chan_id": int, "max_msg_id": int, "spider_id": str} in JSON, max_msg_id
+    being the highest message ID already ingested and spider_id the holder of the lease (sent back with the channel
+    info). Same file name as store_chan_username.
+    """
+    filename = hashlib.sha256(str(lease["chan_id"]).encode("utf8")).hexdigest() + ".dat"
+    filepath = os.path.join(folder, filename)
+    # written under a temporary name then renamed: the crawler is woken up by the rename, the file is complete
+    temp_path = filepath + ".TEMP"
+    with open(temp_path, 'w') as f:
+        json.dump({"chan_id": lease["chan_id"], "max_msg_id": lease.get("max_msg_id", 0), "spider_id": spider_id}, f)
+    os.replace(temp_path, filepath)
+    return filepath
+
+
+def read_dispatched_channel(filepath) -> dict:
+    """Reads a file written by store_lease, or by store_chan_username (channel ID only: no watermark)."""
+    with open(filepath, 'r') as f:
+        content = json.load(f)
+    if isinstance(content, int):
+        return {"chan_id": content, "max_msg_id": 0}
+    return content
+
+
+class Prefetcher:
+    """
+    Keeps a buffer of leased channels in the folder of the crawler, so it never waits on the orchestrator.
+
+    The size of the buffer follows the throughput of the crawler: enough channels to keep it busy for `horizon`
+    seconds, between 1 and `max_buffer`. Channels are leased in batches (/next?n=K) with long polling: when the queue
+    is empty the orchestrator holds the request until channels are added, instead of the dispatcher sleeping and
+    asking again.
+    """
+
+    def __init__(self, host, port, folder, spider_id, relief_time, max_backoff, max_buffer, horizon, long_poll_wait,
+                 check_interval):
+        self.url = f"http://{host}:{port}/next"
+        self.folder = folder
+        self.spider_id = spider_id
+        self.relief_time = relief_time
+        self.max_backoff = max_backoff
+        self.max_buffer = max_buffer
+        self.horizon = horizon
+        self.long_poll_wait = long_poll_wait
+        self.check_interval = check_interval
+        self.session = requests.Session()
 
+        # files of the channels waiting for or being crawled. The folder is only listed once, then followed in memory.
+        self.pending = set()
+        for fname in os.listdir(folder):
+            if fname.endswith(".dat") or fname.endswith(".dat.crawling"):
+                self.pending.add(os.path.join(folder, fname.removesuffix(".crawling")))
+        # average time (in seconds) the crawler takes per channel, None until a crawl finished
+        self.avg_crawl_time = None
+        self._last_completion = time.monotonic()
+        self._last_check = self._last_completion
+        # path: when the crawl of the channel was seen started (.crawling file), the time the channel waited in the
+        # buffer isn't crawl time
+        self._started = {}
 
-def check_dispatched_channels(folder):
-    """Returns the number of channels the dispatcher added to be crawled."""
-    total_files = 0
+    def target_size(self) -> int:
+        if self.avg_crawl_time is None:
+            return self.max_buffer
+        return max(1, min(self.max_buffer, math.ceil(self.horizon / max(self.avg_crawl_time, 1e-3))))
+
+    def prune_finished(self):
+        """
+        Forgets the channels whose file was removed by the crawler, and updates its throughput: time between two
+        completions, not counting the time the crawler had nothing to crawl.
+        """
+        now = time.monotonic()
+        for path in list(self.pending):
+            if os.path.exists(path):
+                continue
+            if os.path.exists(path + ".crawling"):
+                self._started.setdefault(path, now)
+                continue
+            self.pending.remove(path)
+            # not seen crawling: it started after the previous check
+            started = self._started.pop(path, self._last_check)
+            crawl_time = now - max(self._last_completion, started)
+            self._last_completion = now
+            if self.avg_crawl_time is None:
+                self.avg_crawl_time = crawl_time
+            else:
+                # exponentially weighted, recent crawls count more
+                self.avg_crawl_time = 0.7 * self.avg_crawl_time + 0.3 * crawl_time
+        self._last_check = now
+
+    def lease(self, n) -> list[dict]:
+        """:return: [{"chan_id": int, "lease_expires": int, "max_msg_id": int}, ...]"""
+        resp = self.session.get(self.url, params={"n": n, "wait": self.long_poll_wait, "spider_id": self.spider_id},
+                                timeout=self.long_poll_wait + 30)
+        resp.raise_for_status()
+        return resp.json()
+
+    def run(self):
+        error_count = 0
+        while True:
+            self.prune_finished()
+            missing = self.target_size() - len(self.pending)
+            if missing <= 0:
+                time.sleep(self.check_interval)
+                continue
+            try:
+                leases = self.lease(n=missing)
+            except (requests.exceptions.RequestException, ValueError) as err:
+                error_count += 1
+                total_sleep = backoff_delay(error_count=error_count, relief_time=self.relief_time,
+                                            max_backoff=self.max_backoff)
+                log.error(f"Error getting next channels: {err} - Sleeping for {total_sleep:.1f} seconds")
+                time.sleep(total_sleep)
+                continue
+            error_count = 0
+            # an empty list means the long poll timed out: we can ask again right away
+            for lease in leases:
+                log.info(f"Got channel ID = {lease['chan_id']} (messages ingested up to {lease.get('max_msg_id', 0)})")
+                self.pending.add(store_lease(folder=self.folder, lease=lease, spider_id=self.spider_id))
+
+
+def list_dispatched_channels(folder) -> list[int]:
+    """Returns the IDs of the channels waiting to be crawled or being crawled (.dat and .dat.crawling files)."""
+    chan_ids = []
     for fname in os.listdir(folder):
-        if fname.endswith(".dat"):
-            total_files += 1
-    return total_files
+        if not (fname.endswith(".dat") or fname.endswith(".dat.crawling")):
+            continue
+        try:
+            chan_ids.append(read_dispatched_channel(os.path.join(folder, fname))["chan_id"])
+        except (OSError, ValueError):
+            # removed by the crawler in the meantime, or still being written
+            continue
+    return chan_ids
+
+
+def send_heartbeats(host, port, folder, spider_id, heartbeat_interval):
+    """
+    Renews the lease of the dispatched channels every heartbeat_interval seconds. Without it, the orchestrator hands
+    these channels to another spider once their lease expires.
+    """
+    while True:
+        chan_ids = list_dispatched_channels(folder=folder)
+        if chan_ids:
+            try:
+                resp = requests.post(f"http://{host}:{port}/heartbeat",
+                                     json={"spider_id": spider_id, "chan_ids": chan_ids},
+                                     timeout=heartbeat_interval)
+                resp.raise_for_status()
+                lost = resp.json()["lost"]
+                if lost:
+                    log.warning(f"Lease lost on channels {lost}, they may be crawled by another spider.")
+            except requests.exceptions.RequestException as err:
+                log.error(f"Couldn't send heartbeat: {err}")
+        time.sleep(heartbeat_interval)
 
 
 host = os.getenv("HOST_CHANNEL", default="localhost")
@@ -71,18 +230,30 @@ wait_flag = os.getenv("WAIT_FLAG", default="wait_pls")
 relief_time = int(os.getenv("RELIEF_TIME", default=30))
 
 folder_save = os.getenv("USERNAME_STORAGE_FOLDER", os.path.dirname(os.path.realpath(__file__)))
-MAX_CHANNEL_TO_CRAWL = os.getenv("MAX_CHANNEL_TO_CRAWL", 3)
-WAIT_TIME = os.getenv("WAIT_TIME", 10)
+MAX_CHANNEL_TO_CRAWL = int(os.getenv("MAX_CHANNEL_TO_CRAWL", 3))
+# time between two checks of the buffer of channels, when it is full (in seconds)
+WAIT_TIME = int(os.getenv("WAIT_TIME", 10))
+# upper bound of the wait between two attempts after an error (in seconds)
+MAX_BACKOFF = int(os.getenv("MAX_BACKOFF", 300))
+# the buffer holds enough channels to keep the crawler busy for PREFETCH_HORIZON seconds (MAX_CHANNEL_TO_CRAWL at most)
+PREFETCH_HORIZON = int(os.getenv("PREFETCH_HORIZON", 60))
+# how long the orchestrator can hold a /next request when its queue is empty (in seconds)
+LONG_POLL_WAIT = int(os.getenv("LONG_POLL_WAIT", 30))
+# identifies this spider to the orchestrator, holder of the leases on the channels it crawls
+SPIDER_ID = os.getenv("SPIDER_ID", default=socket.gethostname())
+# should be well below LEASE_DURATION of the orchestrator
+HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", 60))
 
 if __name__ == '__main__':
     log.info("=================================== Dispatcher started ===================================")
     log.debug("Listing ENV var")
     for key, val in os.environ.items():
         log.debug(f"ENV: {key}:{val}")
-    while True:
-        if check_dispatched_channels(folder=folder_save) >= MAX_CHANNEL_TO_CRAWL:
-            log.info("Too many channels to crawl already. Waiting before asking for more.")
-            time.sleep(WAIT_TIME)
-        else:
-            usr = get_next_chan(host=host, port=port, wait_flag=wait_flag, relief_time=relief_time)
-            store_chan_username(folder=folder_save, username=usr)
+    heartbeat_thread = threading.Thread(target=send_heartbeats, name="heartbeat", daemon=True,
+                                        kwargs={"host": host, "port": port, "folder": folder_save,
+                                                "spider_id": SPIDER_ID, "heartbeat_interval": HEARTBEAT_INTERVAL})
+    heartbeat_thread.start()
+    prefetcher = Prefetcher(host=host, port=port, folder=folder_save, spider_id=SPIDER_ID, relief_time=relief_time,
+                            max_backoff=MAX_BACKOFF, max_buffer=MAX_CHANNEL_TO_CRAWL, horizon=PREFETCH_HORIZON,
+                            long_poll_wait=LONG_POLL_WAIT, check_interval=WAIT_TIME)
+    prefetcher.run()
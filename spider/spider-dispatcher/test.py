@@ -1,7 +1,10 @@
+import os
+import tempfile
 import unittest
 from unittest import mock
 
-from dispatcher import get_next_chan
+from dispatcher import get_next_chan, backoff_delay, Prefetcher, store_chan_username, store_lease, \
+    read_dispatched_channel
 
 
 class TestSpiderDispatcher(unittest.TestCase):
@@ -11,3 +14,58 @@ class TestSpiderDispatcher(unittest.TestCase):
         with mock.patch('requests.get') as mock_req:
             res = get_next_chan(host="", port="", wait_flag="", relief_time=30)
             mock_req.assert_called_once()
+
+    def test_backoff_is_capped(self):
+        for error_count in range(1, 50):
+            delay = backoff_delay(error_count=error_count, relief_time=30, max_backoff=300)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, 300)
+
+    def test_prefetcher_buffer_follows_crawler_throughput(self):
+        with tempfile.TemporaryDirectory() as folder:
+            prefetcher = Prefetcher(host="", port="", folder=folder, spider_id="test", relief_time=30,
+                                    max_backoff=300, max_buffer=10, horizon=60, long_poll_wait=30, check_interval=10)
+            # nothing known about the crawler yet
+            self.assertEqual(prefetcher.target_size(), 10)
+            prefetcher.avg_crawl_time = 30
+            self.assertEqual(prefetcher.target_size(), 2)
+            prefetcher.avg_crawl_time = 3600
+            self.assertEqual(prefetcher.target_size(), 1)
+
+    def test_prefetcher_crawl_time_excludes_wait_in_buffer(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with mock.patch('dispatcher.time.monotonic', return_value=0):
+                prefetcher = Prefetcher(host="", port="", folder=folder, spider_id="test", relief_time=30,
+                                        max_backoff=300, max_buffer=10, horizon=60, long_poll_wait=30,
+                                        check_interval=10)
+                path = store_lease(folder=folder, lease={"chan_id": 1, "lease_expires": 0})
+                prefetcher.pending.add(path)
+            # waited 1000 s in the buffer, then crawled in 30 s
+            os.rename(path, path + ".crawling")
+            with mock.patch('dispatcher.time.monotonic', return_value=1000):
+                prefetcher.prune_finished()
+            os.remove(path + ".crawling")
+            with mock.patch('dispatcher.time.monotonic', return_value=1030):
+                prefetcher.prune_finished()
+            self.assertEqual(prefetcher.avg_crawl_time, 30)
+            self.assertEqual(prefetcher.pending, set())
+
+    def test_prefetcher_leases_missing_channels(self):
+        with tempfile.TemporaryDirectory() as folder:
+            prefetcher = Prefetcher(host="", port="", folder=folder, spider_id="test", relief_time=30,
+                                    max_backoff=300, max_buffer=3, horizon=60, long_poll_wait=30, check_interval=10)
+            with mock.patch.object(prefetcher.session, 'get') as mock_get:
+                mock_get.return_value.json.return_value = [{"chan_id": 1, "lease_expires": 0},
+                                                           {"chan_id": 2, "lease_expires": 0}]
+                self.assertEqual([lease["chan_id"] for lease in prefetcher.lease(n=3)], [1, 2])
+                self.assertEqual(mock_get.call_args.kwargs["params"]["n"], 3)
+
+    def test_dispatched_channel_files(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = store_lease(folder=folder, lease={"chan_id": 12, "lease_expires": 0, "max_msg_id": 345},
+                               spider_id="spider-1")
+            self.assertEqual(read_dispatched_channel(path), {"chan_id": 12, "max_msg_id": 345, "spider_id": "spider-1"})
+            # files written before the watermarks existed only hold the channel ID
+            legacy_path = store_chan_username(folder=folder, username="12")
+            self.assertEqual(legacy_path, path)
+            self.assertEqual(read_dispatched_channel(legacy_path), {"chan_id": 12, "max_msg_id": 0})
@@ -0,0 +1,210 @@
+"""
+Posts/s shipped by the reporter to an orchestrator over a constrained link (limited bandwidth, latency), with the
+upload engine configured like the reporters used to work (a new connection per file, uncompressed JSON, one file at a
+time) and with each of its features turned on in turn.
+
+The spool files are generated locally: a few large channels crawled in full chunks and many small channels (a single
+chunk of a few posts, like most channels are). The orchestrator is stood in for by a Quart app decompressing and
+decoding the bodies, behind a proxy limiting the bandwidth and delaying every packet. Needs quart, hypercorn and
+shared/ in the path, ex:
+
+    PYTHONPATH=../../shared python bench_upload.py --bandwidth 1000 --latency 50
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+
+os.environ.setdefault("DEBUG_MODE_ACTIVE", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import requests
+import zstandard
+from quart import Quart, request, jsonify
+from hypercorn.config import Config
+from hypercorn.asyncio import serve
+
+import reporter
+from spool import encode_posts, encode_channel_info, SPOOL_EXTENSION
+
+SERVER_PORT = 33901
+PROXY_PORT = 33902
+WORDS = ["the", "breaking", "news", "report", "война", "новости", "сегодня", "заявил", "президент", "україна",
+         "attack", "official", "source", "🔥", "⚡️", "video", "photo", "update", "https://t.me/channel_42",
+         "https://www.reuters.com/world/article-12345"]
+
+received = {"requests": 0, "posts": 0}
+app = Quart("bench")
+
+
+@app.route("/save_data", methods=["POST"])
+@app.route("/save_data_xposted", methods=["POST"])
+async def save_data():
+    body = await request.get_data()
+    encoding = request.headers.get("Content-Encoding", "identity")
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    elif encoding == "zstd":
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    data = json.loads(body)
+    received["requests"] += 1
+    if request.path == "/save_data":
+        received["posts"] += sum(len(posts) for posts in data.values())
+    return jsonify(success=True)
+
+
+class ThrottledProxy:
+    """TCP proxy shaping both directions like a link of `bandwidth` bytes/s with `latency` seconds of one-way delay."""
+
+    def __init__(self, bandwidth, latency):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.bytes_up = 0
+        # time at which each direction of the link is free again (shared by all the connections)
+        self.link_free_at = {"up": 0.0, "down": 0.0}
+
+    async def handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", SERVER_PORT)
+        await asyncio.gather(self.pipe(client_reader, server_writer, "up"),
+                             self.pipe(server_reader, client_writer, "down"), return_exceptions=True)
+
+    async def pipe(self, reader, writer, direction):
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                deliver_at, data = await in_flight.get()
+                if data is None:
+                    writer.close()
+                    return
+                await asyncio.sleep(max(0.0, deliver_at - loop.time()))
+                writer.write(data)
+                await writer.drain()
+
+        delivery = asyncio.create_task(deliver())
+        while True:
+            data = await reader.read(2 ** 14)
+            if not data:
+                await in_flight.put((0, None))
+                break
+            if direction == "up":
+                self.bytes_up += len(data)
+            # serialization on the link, then propagation
+            start = max(loop.time(), self.link_free_at[direction])
+            self.link_free_at[direction] = start + len(data) / self.bandwidth
+            await asyncio.sleep(max(0.0, self.link_free_at[direction] - loop.time()))
+            await in_flight.put((self.link_free_at[direction] + self.latency, data))
+        await delivery
+
+
+def start_servers(proxy: ThrottledProxy):
+    async def main():
+        config = Config()
+        config.bind = [f"127.0.0.1:{SERVER_PORT}"]
+        config.loglevel = "WARNING"
+        await asyncio.start_server(proxy.handle, "127.0.0.1", PROXY_PORT)
+        # runs in a thread: no signal handlers, the server stops with the process
+        await serve(app, config, shutdown_trigger=asyncio.Event().wait)
+
+    threading.Thread(target=asyncio.run, args=(main(),), daemon=True).start()
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{SERVER_PORT}/", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    sys.exit("The server didn't start")
+
+
+def make_posts(rng, first_id, nb_posts) -> dict:
+    return {post_id: {"text": " ".join(rng.choices(WORDS, k=rng.randint(10, 100))),
+                      "forwards": rng.randint(0, 500),
+                      "views": rng.randint(0, 200000),
+                      "reply": False,
+                      "id": post_id,
+                      "forwarded_from": "",
+                      "urls": ["https://www.reuters.com/world/article-12345"],
+                      "domains": ["www.reuters.com"],
+                      "tme_links": ["channel_42"],
+                      "mentions": [],
+                      "hashtags": [],
+                      "date": 1700000000 + post_id}
+            for post_id in range(first_id, first_id + nb_posts)}
+
+
+def write_spool_files(folder, rng, large_channels, small_channels, chunk_size) -> int:
+    """Spool files of the crawl of the channels, returns the number of posts."""
+    total = 0
+    channels = [(chan_id, rng.randint(3, 8) * chunk_size + rng.randint(0, chunk_size)) for chan_id in
+                range(large_channels)]
+    channels += [(chan_id, rng.randint(5, 200)) for chan_id in range(large_channels, large_channels + small_channels)]
+    for chan_id, nb_posts in channels:
+        for count, first_id in enumerate(range(0, nb_posts, chunk_size)):
+            posts = make_posts(rng, first_id, min(chunk_size, nb_posts - first_id))
+            with open(os.path.join(folder, f"chan-{chan_id}-chunk_{count}{SPOOL_EXTENSION}"), "wb") as f:
+                f.write(encode_posts(chan_id, posts))
+        info = {"channel_info": {"chan_id": chan_id, "title": "t", "username": f"chan_{chan_id}", "verified": False,
+                                 "nb_participants": 1, "min_msg_id": 0, "max_msg_id": nb_posts},
+                "fwd_chan_dict": [], "linked_chan_dict": []}
+        with open(os.path.join(folder, f"chan-{chan_id}-channel_info{SPOOL_EXTENSION}"), "wb") as f:
+            f.write(encode_channel_info(info))
+        total += nb_posts
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Reporter upload benchmark',
+                                     description='Posts/s shipped over a constrained link, per upload configuration.')
+    parser.add_argument('--bandwidth', type=float, default=1000, help='KB/s of the link.')
+    parser.add_argument('--latency', type=float, default=50, help='One-way latency of the link, in ms.')
+    parser.add_argument('--large-channels', type=int, default=3, help='Channels crawled in several full chunks.')
+    parser.add_argument('--small-channels', type=int, default=100, help='Channels of a single small chunk.')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Posts per chunk (CHUNK_SIZE).')
+    parser.add_argument('--concurrency', type=int, default=4, help='UPLOAD_CONCURRENCY.')
+    args = parser.parse_args()
+
+    proxy = ThrottledProxy(bandwidth=args.bandwidth * 1000, latency=args.latency / 1000)
+    start_servers(proxy)
+    source = tempfile.mkdtemp()
+    nb_posts = write_spool_files(source, random.Random(42), large_channels=args.large_channels,
+                                 small_channels=args.small_channels, chunk_size=args.chunk_size)
+    nb_files = len(os.listdir(source))
+    print(f"{nb_files} files, {nb_posts} posts, link of {args.bandwidth:.0f} KB/s with {args.latency:.0f} ms latency")
+
+    configurations = [("before: new connection per file", dict(), True),
+                      ("keep-alive session", dict(), False),
+                      ("+ zstd bodies", dict(compression="zstd"), False),
+                      (f"+ {args.concurrency} concurrent uploads", dict(compression="zstd",
+                                                                       concurrency=args.concurrency), False),
+                      ("+ coalesced small chunks", dict(compression="zstd", concurrency=args.concurrency,
+                                                        coalesce_posts=args.chunk_size), False)]
+    print(f"{'configuration':<34} {'requests':>9} {'MB sent':>8} {'seconds':>8} {'posts/s':>8}")
+    for name, options, new_connections in configurations:
+        folder = tempfile.mkdtemp()
+        for fname in os.listdir(source):
+            shutil.copy(os.path.join(source, fname), folder)
+        reporter.DATA_STORAGE_FOLDER = folder
+        rep = reporter.Reporter(host="127.0.0.1", port=str(PROXY_PORT), debug_mode_active=False, **options)
+        if new_connections:
+            # the module-level requests.post the reporters used: a new connection for every request
+            rep.session = requests
+        received.update(requests=0, posts=0)
+        proxy.bytes_up = 0
+        start = time.perf_counter()
+        while rep.run() > 0:
+            pass
+        elapsed = time.perf_counter() - start
+        assert received["posts"] == nb_posts and not os.listdir(folder), received
+        print(f"{name:<34} {received['requests']:>9} {proxy.bytes_up / 10 ** 6:>8.2f} {elapsed:>8.1f} "
+              f"{nb_posts / elapsed:>8.0f}")
+        shutil.rmtree(folder)
+    shutil.rmtree(source)
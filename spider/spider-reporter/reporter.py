@@ -1,12 +1,22 @@
 import os
+import re
 import time
 import json
+import zlib
+import random
 import pickle
+import hashlib
 import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
+import zstandard
+from requests.adapters import HTTPAdapter
 
 from datachecker import validate_posts, validate_channel_info
+from spool import SpoolReader, SpoolError, posts_payload, posts_ndjson, SPOOL_EXTENSION, CHANNEL_INFO, POSTS
+from watcher import FolderWatcher
 
 log_datefmt = os.getenv("DATE_FORMAT", default="%Y-%m-%d %H:%M:%S")
 log_formatting = os.getenv("LOG_FORMATING", default="%(levelname)s-[%(asctime)s] [%(thread)d] %(message)s")
@@ -31,63 +41,373 @@ HOST = os.getenv("HOST_CHANNEL", default="localhost")
 PORT = os.getenv("PORT_CHANNEL", default="33445")
 DATA_STORAGE_FOLDER = os.getenv("DATA_STORAGE_FOLDER", "../devland/")
 DEBUG_MODE_ACTIVE = json.loads(os.getenv("DEBUG_MODE_ACTIVE"))
+# "true" polls DATA_STORAGE_FOLDER every WATCH_POLL_INTERVAL seconds instead of watching it with inotify (for the file
+# systems inotify can't watch, like NFS)
+WATCH_POLLING = json.loads(os.getenv("WATCH_POLLING", default="false"))
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", default=1))
+# Uploads sent to the orchestrator at the same time, each over its own keep-alive connection
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", default=4))
+# Compression of the uploads: zstd, gzip or none. zstd and gzip need an orchestrator decompressing them.
+UPLOAD_COMPRESSION = os.getenv("UPLOAD_COMPRESSION", default="zstd")
+UPLOAD_COMPRESSION_LEVEL = int(os.getenv("UPLOAD_COMPRESSION_LEVEL", default=3))
+# Files of posts with fewer posts than that (last chunk of a crawl, small channels) are sent together, up to
+# COALESCE_POSTS posts per request. 0: every file is sent alone.
+COALESCE_POSTS = int(os.getenv("COALESCE_POSTS", default=1000))
+# The files of a channel whose upload failed are sent again after a random delay of up to UPLOAD_RETRY_DELAY seconds,
+# doubled after each failure, at most UPLOAD_MAX_BACKOFF seconds. The files of the other channels are still sent.
+UPLOAD_RETRY_DELAY = float(os.getenv("UPLOAD_RETRY_DELAY", default=3))
+UPLOAD_MAX_BACKOFF = float(os.getenv("UPLOAD_MAX_BACKOFF", default=300))
+# Posts sent as NDJSON to /save_data_stream, a post per line: the orchestrator writes them as they are received instead
+# of decoding the whole body first. Needs an orchestrator with /save_data_stream.
+UPLOAD_POSTS_NDJSON = json.loads(os.getenv("UPLOAD_POSTS_NDJSON", default="true"))
+
+# files of the crawlers: {username}-{chan_id}-[part_{part}-]chunk_{count} and {username}-{chan_id}-channel_info, or
+# {username}-chunk_{count} and {username}-channel_info before the spool files
+DATA_FILE_NAME = re.compile(r"^(?P<channel>.+?)-(?:part_(?P<part>\d+)-)?(?:chunk_(?P<chunk>\d+)|channel_info)"
+                            r"\.(?:spool|pickle)$")
+
+
+def is_data_file(fname):
+    """Files written by the crawler, to be sent"""
+    return fname.endswith(SPOOL_EXTENSION) or fname.endswith(".pickle")
+
+
+def outbox_position(fname) -> tuple:
+    """
+    (channel, rank) of a file: the files of a channel are sent by increasing rank, its chunks in the order they were
+    written then its channel info. A name that isn't one of a crawler is a channel of its own.
+    """
+    match = DATA_FILE_NAME.match(fname)
+    if match is None:
+        return fname, (0, 0, 0)
+    if match["chunk"] is None:
+        # the channel info last: the channel is marked crawled and its forwards queued once its posts are saved
+        return match["channel"], (1, 0, 0)
+    return match["channel"], (0, int(match["part"] or 0), int(match["chunk"]))
+
+
+def is_channel_info(fname):
+    return outbox_position(fname)[1][0] == 1
+
+
+def idempotency_key(keys: list):
+    """
+    Idempotency key of a request sending files of the given keys (see shared/spool.py), the same as long as the same
+    files are sent together. None if a file has no key.
+    """
+    if not keys or None in keys:
+        return None
+    if len(keys) == 1:
+        return keys[0]
+    return hashlib.blake2b(" ".join(keys).encode(), digest_size=16).hexdigest()
+
+
+def backoff_delay(error_count, retry_delay, max_backoff) -> float:
+    """Exponential backoff, capped at max_backoff, with full jitter (same as the dispatcher)."""
+    return random.uniform(0, min(max_backoff, retry_delay * 2 ** error_count))
+
+
+def compressed(pieces, encoding):
+    """Compresses the pieces of a body as they come, with gzip or zstd (Content-Encoding)."""
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=UPLOAD_COMPRESSION_LEVEL).compressobj()
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(level=UPLOAD_COMPRESSION_LEVEL, wbits=31)   # gzip container
+    else:
+        raise ValueError(f"Unknown compression: {encoding}")
+    for piece in pieces:
+        out = compressor.compress(piece)
+        if out:
+            yield out
+    yield compressor.flush()
 
 
 class Reporter:
 
-    def __init__(self, host: str, port: str, debug_mode_active: bool):
+    def __init__(self, host: str, port: str, debug_mode_active: bool, concurrency=1, compression="none",
+                 coalesce_posts=0, retry_delay=UPLOAD_RETRY_DELAY, max_backoff=UPLOAD_MAX_BACKOFF, posts_ndjson=False):
+        """
+        :param concurrency: uploads sent at the same time, each over its own keep-alive connection
+        :param compression: "zstd", "gzip" or "none"
+        :param coalesce_posts: the files of posts with fewer posts are sent together, up to coalesce_posts posts per
+        request (0: every file is sent alone)
+        :param retry_delay: the files of a channel whose upload failed are sent again after up to retry_delay seconds,
+        doubled after each failure up to max_backoff seconds
+        :param posts_ndjson: the posts are sent as NDJSON to /save_data_stream rather than as JSON to /save_data
+        """
         self.host = host
         self.port = port
         self.debug_mode_active = debug_mode_active
+        self.compression = compression
+        self.coalesce_posts = coalesce_posts
+        self.posts_ndjson = posts_ndjson
+        self.retry_delay_base = retry_delay
+        self.max_backoff = max_backoff
+        # channel: (failed uploads in a row, time.monotonic() at which they can be sent again)
+        self.backoffs = {}
+        # files sent together that failed: sent again together, under the same idempotency key
+        self.failed_batches = []
+        # nothing is sent before, the orchestrator asked to come back later (Retry-After)
+        self.paused_until = 0.0
+        # connections kept alive between the uploads, as many as uploads sent at the same time
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload")
 
-    def save_data(self, data: dict[int: dict]):
-        resp = requests.post(url=f"http://{self.host}:{self.port}/save_data", json=data)
-        resp.raise_for_status()
-        log.debug(f"Sucessfully saved data!")
+    def save_data(self, data, key=None):
+        """
+        :param data: {chan_id: {post_id: post}}, or its JSON in pieces of bytes (see spool.posts_payload), or its
+        NDJSON with posts_ndjson (see spool.posts_ndjson)
+        :param key: idempotency key, the orchestrator ingests the data once whatever the number of times it is sent
+        """
+        if not self.posts_ndjson:
+            self._post(route="save_data", data=data, key=key)
+            return
+        if isinstance(data, dict):
+            data = b"".join(json.dumps({chan_id: {post_id: post}}).encode() + b"\n"
+                            for chan_id, posts in data.items() for post_id, post in posts.items())
+        self._post(route="save_data_stream", data=data, key=key, content_type="application/x-ndjson")
+
+    def save_data_xposted(self, data, key=None):
+        """:param data: see datachecker.TEMPLATE_CHANNEL_INFO, or its JSON in pieces of bytes"""
+        self._post(route="save_data_xposted", data=data, key=key)
 
-    def save_data_xposted(self, data: dict):
-        resp = requests.post(url=f"http://{self.host}:{self.port}/save_data_xposted", json=data)
+    def _post(self, route, data, key=None, content_type="application/json"):
+        headers = {"Content-Type": content_type}
+        if key is not None:
+            headers["Idempotency-Key"] = key
+        if isinstance(data, dict):
+            data = json.dumps(data).encode()
+        if self.compression != "none":
+            headers["Content-Encoding"] = self.compression
+            data = compressed([data] if isinstance(data, bytes) else data, encoding=self.compression)
+        # the pieces of a body are sent as they are read from the files, in chunks (chunked transfer encoding)
+        resp = self.session.post(url=f"http://{self.host}:{self.port}/{route}", data=data, headers=headers)
         resp.raise_for_status()
         log.debug(f"Sucessfully saved data!")
 
-    def run(self):
-        for fname in os.listdir(DATA_STORAGE_FOLDER):
-            if not fname.endswith(".pickle"):
+    def send_spool_files(self, filepaths: list):
+        """Sends spool files written by the crawler (see shared/spool.py): a file of channel info or files of posts."""
+        with contextlib.ExitStack() as stack:
+            spools = [stack.enter_context(SpoolReader(filepath)) for filepath in filepaths]
+            key = idempotency_key([spool.key for spool in spools])
+            if spools[0].kind == CHANNEL_INFO:
+                content = spools[0].read() if self.debug_mode_active is True else spools[0].payload()
+                self.send(content=content, is_channel_info=True, key=key)
+                return
+            if self.debug_mode_active is True:
+                content = {}
+                for spool in spools:
+                    for chan_id, posts in spool.read().items():
+                        content.setdefault(chan_id, {}).update(posts)
+            else:
+                # the frames are forwarded as they are decompressed, they aren't decoded
+                content = posts_ndjson(spools) if self.posts_ndjson else posts_payload(spools)
+            self.send(content=content, is_channel_info=False, key=key)
+
+    def send_pickle_file(self, filepath):
+        """Sends a pickle file, written by the crawlers older than the spool files."""
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        content = pickle.loads(content)
+        self.send(content=content, is_channel_info=filepath.endswith("-channel_info.pickle"))
+
+    def send(self, content, is_channel_info: bool, key=None):
+        if is_channel_info:
+            if self.debug_mode_active is True:
+                validate_channel_info(info=content)
+            self.save_data_xposted(data=content, key=key)
+        else:
+            if self.debug_mode_active is True:
+                validate_posts(posts=content)
+            self.save_data(data=content, key=key)
+
+    @staticmethod
+    def nb_posts(filepath):
+        """Number of posts of a spool file of posts, None for the other files."""
+        if not filepath.endswith(SPOOL_EXTENSION):
+            return None
+        try:
+            with SpoolReader(filepath) as spool:
+                return spool.header["frames"] if spool.kind == POSTS else None
+        except SpoolError:
+            # set aside when sent
+            return None
+
+    def batches(self, filepaths: list) -> list[list]:
+        """
+        Files sent together: the files of posts with fewer than coalesce_posts posts are gathered, up to coalesce_posts
+        posts. The other files are sent alone.
+        """
+        batches = []
+        small = []
+        small_posts = 0
+        for filepath in filepaths:
+            nb_posts = self.nb_posts(filepath)
+            if nb_posts is None or nb_posts >= self.coalesce_posts:
+                batches.append([filepath])
                 continue
-            log.info(f"Found file: {fname}. Saving it!")
-            filepath = os.path.join(DATA_STORAGE_FOLDER, fname)
-            with open(filepath, 'rb') as f:
-                content = f.read()
-            content = pickle.loads(content)
-            try:
-                if filepath.endswith("-channel_info.pickle"):
-                    if self.debug_mode_active is True:
-                        validate_channel_info(info=content)
-                    self.save_data_xposted(data=content)
-                else:
-                    if self.debug_mode_active is True:
-                        validate_posts(posts=content)
-                    self.save_data(data=content)
-                if self.debug_mode_active is False:
-                    log.info(f"{fname} was successfully saved. Deleting it.")
-                    os.remove(filepath)
-                else:
-                    log.info(f"{fname} was successfully saved. Renaming it.")
-                    # rename so we don't circle back to them
-                    os.rename(filepath, filepath+".processed")
-            except requests.HTTPError as err:
-                log.error(f"No HTTP200 when saving {fname}.\n"
-                          f"Response code: {err.response.status_code}.\n"
-                          f"Response text: {err.response.text}")
-                time.sleep(3)
-            except requests.RequestException as err:
-                log.error(f"Error saving {fname}. Error: {err}.")
-                log.exception("Traceback")
-                time.sleep(3)
+            if small and small_posts + nb_posts > self.coalesce_posts:
+                batches.append(small)
+                small = []
+                small_posts = 0
+            small.append(filepath)
+            small_posts += nb_posts
+        if small:
+            batches.append(small)
+        return batches
+
+    def send_batch(self, filepaths: list) -> bool:
+        """Sends files in a single request, returns False if they couldn't be sent (they are retried later)."""
+        fnames = [os.path.basename(filepath) for filepath in filepaths]
+        log.info(f"Saving {fnames}")
+        try:
+            if filepaths[0].endswith(SPOOL_EXTENSION):
+                self.send_spool_files(filepaths)
+            else:
+                self.send_pickle_file(filepaths[0])
+        except requests.HTTPError as err:
+            log.error(f"No HTTP200 when saving {fnames}.\n"
+                      f"Response code: {err.response.status_code}.\n"
+                      f"Response text: {err.response.text}")
+            retry_after = err.response.headers.get("Retry-After")
+            if retry_after is not None:
+                # 429: the orchestrator has too much data waiting to be saved and tells us when to come back
+                self.paused_until = max(self.paused_until, time.monotonic() + float(retry_after))
+            return False
+        except requests.RequestException as err:
+            log.error(f"Error saving {fnames}. Error: {err}.")
+            log.exception("Traceback")
+            return False
+        except SpoolError as err:
+            if len(filepaths) > 1:
+                # the invalid file is set aside when sent alone, the others are sent
+                return all([self.send_batch([filepath]) for filepath in filepaths])
+            # would fail again on every pass
+            log.error(f"Can't read {fnames[0]}, setting it aside: {err}")
+            os.rename(filepaths[0], filepaths[0] + ".invalid")
+            return True
+        for fname, filepath in zip(fnames, filepaths):
+            if self.debug_mode_active is False:
+                log.info(f"{fname} was successfully saved. Deleting it.")
+                os.remove(filepath)
+            else:
+                log.info(f"{fname} was successfully saved. Renaming it.")
+                # rename so we don't circle back to them
+                os.rename(filepath, filepath+".processed")
+        return True
+
+    @staticmethod
+    def outbox(filepaths: list) -> dict:
+        """{channel: [files of the channel, in the order they are sent]}, see outbox_position"""
+        channels = {}
+        for filepath in sorted(filepaths, key=lambda filepath: outbox_position(os.path.basename(filepath))):
+            channels.setdefault(outbox_position(os.path.basename(filepath))[0], []).append(filepath)
+        return channels
+
+    @staticmethod
+    def channels_of(filepaths: list) -> set:
+        return {outbox_position(os.path.basename(filepath))[0] for filepath in filepaths}
+
+    def run(self) -> int:
+        """
+        Sends the files in DATA_STORAGE_FOLDER, returns the number of requests that failed.
+
+        Each channel has its outbox: its chunks are sent first, its channel info once they are all saved. The channels
+        are sent at the same time (`concurrency` requests at most). A channel whose upload failed is left aside until
+        its backoff expires (see retry_delay), the other channels aren't held up.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return 0
+        filepaths = [os.path.join(DATA_STORAGE_FOLDER, fname) for fname in os.listdir(DATA_STORAGE_FOLDER)
+                     if is_data_file(fname)]
+        outbox = self.outbox(filepaths)
+        # the channels and batches whose files are gone (set aside, removed by hand) aren't retried
+        self.backoffs = {channel: backoff for channel, backoff in self.backoffs.items() if channel in outbox}
+        self.failed_batches = [batch for batch in self.failed_batches if set(batch) <= set(filepaths)]
+        ready = {channel: files for channel, files in outbox.items()
+                 if channel not in self.backoffs or self.backoffs[channel][1] <= now}
+        chunks = [filepath for files in ready.values() for filepath in files
+                  if not is_channel_info(os.path.basename(filepath))]
+
+        # a batch that failed is sent again once all its channels are ready, its files aren't sent with others
+        retried = [batch for batch in self.failed_batches if set(batch) <= set(chunks)]
+        self.failed_batches = [batch for batch in self.failed_batches if batch not in retried]
+        held = {filepath for batch in self.failed_batches for filepath in batch}
+        retried_files = set().union(*retried)
+        batches = retried + self.batches([filepath for filepath in chunks
+                                          if filepath not in held and filepath not in retried_files])
+
+        futures = {}
+        # requests of chunks not done yet, per channel. The channels with files held can't send their channel info.
+        remaining = dict.fromkeys(ready, 0)
+        failed = set()
+        held_channels = self.channels_of(held)
+
+        def send_channel_info(channel):
+            if channel in held_channels:
+                return
+            for filepath in ready[channel]:
+                if is_channel_info(os.path.basename(filepath)):
+                    futures[self.executor.submit(self.send_batch, [filepath])] = [filepath]
+
+        for batch in batches:
+            for channel in self.channels_of(batch):
+                remaining[channel] += 1
+            futures[self.executor.submit(self.send_batch, batch)] = batch
+        for channel in ready:
+            if remaining[channel] == 0:
+                send_channel_info(channel)
+
+        nb_failed = 0
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = futures.pop(future)
+                sent = future.result()
+                nb_failed += not sent
+                if not sent and len(batch) > 1:
+                    self.failed_batches.append(batch)
+                for channel in self.channels_of(batch):
+                    if not sent:
+                        failed.add(channel)
+                    if is_channel_info(os.path.basename(batch[0])):
+                        continue
+                    remaining[channel] -= 1
+                    if remaining[channel] == 0 and channel not in failed:
+                        send_channel_info(channel)
+
+        for channel in ready:
+            if channel in failed:
+                error_count = self.backoffs[channel][0] if channel in self.backoffs else 0
+                delay = backoff_delay(error_count=error_count, retry_delay=self.retry_delay_base,
+                                      max_backoff=self.max_backoff)
+                log.warning(f"Upload of {channel} failed {error_count + 1} time(s) in a row, retrying in {delay:.1f}s")
+                self.backoffs[channel] = (error_count + 1, time.monotonic() + delay)
+            else:
+                self.backoffs.pop(channel, None)
+        return nb_failed
+
+    def retry_delay(self):
+        """Seconds until the uploads that failed can be retried, None if none failed."""
+        retry_at = [retry_at for _, retry_at in self.backoffs.values()]
+        if self.paused_until > time.monotonic():
+            retry_at.append(self.paused_until)
+        if not retry_at:
+            return None
+        return max(0.0, min(retry_at) - time.monotonic())
 
 
 if __name__ == '__main__':
-    rep = Reporter(host=HOST, port=PORT, debug_mode_active=DEBUG_MODE_ACTIVE)
+    rep = Reporter(host=HOST, port=PORT, debug_mode_active=DEBUG_MODE_ACTIVE, concurrency=UPLOAD_CONCURRENCY,
+                   compression=UPLOAD_COMPRESSION, coalesce_posts=COALESCE_POSTS, retry_delay=UPLOAD_RETRY_DELAY,
+                   max_backoff=UPLOAD_MAX_BACKOFF, posts_ndjson=UPLOAD_POSTS_NDJSON)
     log.info("=================================== Reporter started! ===================================")
+    # created before the first listing: the files added in the meantime wake up the first wait
+    watcher = FolderWatcher(DATA_STORAGE_FOLDER, accept=is_data_file, polling=WATCH_POLLING,
+                            poll_interval=WATCH_POLL_INTERVAL)
     while True:
         rep.run()
+        # sleeps until the crawler adds a file, or until the uploads that failed can be retried
+        watcher.wait(timeout=rep.retry_delay())